@@ -1,7 +1,13 @@
 import carla
 import time, math
+import hashlib, json, os
+import logging, logging.handlers
+from contextlib import contextmanager
 import numpy as np
 
+# folder for the waypoint caches, one file per town and map version
+WAYPOINT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'waypoint-cache')
+
 class SpeedPID:
     def __init__(self, kp=0.4, ki=0.05, kd=0.0):
         self.kp = kp
@@ -201,7 +207,7 @@ def write_shape_info(bounding_box, name):
 def plot_points(world, points, color=carla.Color(255, 0, 0), size=0.1, life_time=6.0, z_offset=1.0):
     for p in points:
         pos = p
-        if isinstance(p, carla.Waypoint):
+        if hasattr(p, 'transform'):
             pos = p.transform.location
         world.debug.draw_point(
             pos + carla.Location(z=z_offset),                      # carla.Location
@@ -213,8 +219,8 @@ def plot_points(world, points, color=carla.Color(255, 0, 0), size=0.1, life_time
 def wp_location(waypoint):
     if isinstance(waypoint, carla.Vector3D):
         return waypoint
-    if isinstance(waypoint, carla.Waypoint):
-        return waypoint.transform.location
+    # carla.Waypoint or CachedWaypoint
+    return waypoint.transform.location
 
 def get_middle_rear_wheels_position(vehicle):
     physics_control = vehicle.get_physics_control()
@@ -246,3 +252,275 @@ def carla_vector3d_to_numpy(vec, _2d=False):
     if _2d:
         return np.array([vec.x, vec.y])
     return np.array([vec.x, vec.y, vec.z])
+
+def _transform_record(transform):
+    loc, rot = transform.location, transform.rotation
+    return [loc.x, loc.y, loc.z, rot.pitch, rot.yaw, rot.roll]
+
+def _record_transform(record):
+    x, y, z, pitch, yaw, roll = record
+    return carla.Transform(carla.Location(x=x, y=y, z=z),
+                           carla.Rotation(pitch=pitch, yaw=yaw, roll=roll))
+
+class CachedWaypoint:
+    """
+    Waypoint served by a WaypointCache.
+    It provides the attributes and queries of carla.Waypoint used by the scenario scripts,
+    answered from the cache without server round-trips once they have been resolved.
+    """
+    def __init__(self, cache, key, record):
+        self.cache = cache
+        self.key = key
+        self.road_id = record['road_id']
+        self.section_id = record['section_id']
+        self.lane_id = record['lane_id']
+        self.s = record['s']
+        self.lane_width = record['lane_width']
+        self.transform = _record_transform(record['transform'])
+
+    def next(self, distance):
+        return self.cache.query('next', self, distance)
+
+    def previous(self, distance):
+        return self.cache.query('previous', self, distance)
+
+    def next_until_lane_end(self, distance):
+        return self.cache.query('next_until_lane_end', self, distance)
+
+class WaypointCache:
+    """
+    Persistent cache of waypoint queries (get_waypoint, next, previous, next_until_lane_end)
+    and spawn points for one town.
+    The cache is a graph: each waypoint is stored once, keyed by its OpenDRIVE coordinates,
+    and each query maps a waypoint and a distance to the keys of the resulting waypoints.
+    It is saved to disk per town and map version (hash of the OpenDRIVE description),
+    so a changed map never reuses stale waypoints.
+    Queries that are not cached yet are resolved by the server and added to the cache.
+    Other attributes (e.g., `name`) are delegated to the wrapped carla.Map, so an instance
+    can be passed wherever the scripts expect `map_`.
+    """
+    def __init__(self, map_, cache_dir=WAYPOINT_CACHE_DIR):
+        self.map_ = map_
+        town = map_.name.split('/')[-1]
+        version = hashlib.sha1(map_.to_opendrive().encode()).hexdigest()[:12]
+        self.path = os.path.join(cache_dir, f"{town}-{version}.json")
+        self.waypoints = {}
+        self.queries = {}
+        self.locations = {}
+        self.spawn_points = None
+        self.modified = False
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                content = json.load(f)
+            self.waypoints = content['waypoints']
+            self.queries = content['queries']
+            self.locations = content['locations']
+            self.spawn_points = content['spawn_points']
+
+    def __getattr__(self, name):
+        return getattr(self.map_, name)
+
+    def save(self):
+        if not self.modified:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({
+                'waypoints': self.waypoints,
+                'queries': self.queries,
+                'locations': self.locations,
+                'spawn_points': self.spawn_points
+            }, f)
+        self.modified = False
+
+    def get_spawn_points(self):
+        if self.spawn_points is None:
+            self.spawn_points = [_transform_record(tf) for tf in self.map_.get_spawn_points()]
+            self.modified = True
+        return [_record_transform(record) for record in self.spawn_points]
+
+    def get_waypoint(self, location, cache=True):
+        """
+        :param cache: set to False for one-off locations (e.g., the current NPC position),
+                      which would only grow the cache
+        """
+        if not cache:
+            return self.map_.get_waypoint(location)
+        loc_key = f"{location.x:.2f},{location.y:.2f},{location.z:.2f}"
+        if loc_key not in self.locations:
+            self.locations[loc_key] = self._add(self.map_.get_waypoint(location))
+            self.modified = True
+        return self._waypoint(self.locations[loc_key])
+
+    def query(self, name, waypoint, distance):
+        """
+        Return the waypoints of `waypoint.<name>(distance)`.
+        """
+        query_key = f"{name}|{waypoint.key}|{distance}"
+        if query_key not in self.queries:
+            server_wp = self.map_.get_waypoint_xodr(waypoint.road_id, waypoint.lane_id, waypoint.s)
+            self.queries[query_key] = [self._add(wp) for wp in getattr(server_wp, name)(distance)]
+            self.modified = True
+        return [self._waypoint(key) for key in self.queries[query_key]]
+
+    def precompute(self, locations, distance=10.0, lane_ends=3):
+        """
+        Resolve the queries made by the scenario scripts for waypoints starting at the given
+        locations (e.g., the NPC spawn points): the waypoint itself, the one `distance` behind,
+        and the routes ahead of both across `lane_ends` consecutive lanes, as done by make_wp.
+        """
+        for location in locations:
+            wp = self.get_waypoint(location)
+            for start in [wp] + wp.previous(distance):
+                route = start.next_until_lane_end(distance)
+                for _ in range(lane_ends):
+                    # make_wp looks 5 m ahead of the last waypoint
+                    if not route or not route[-1].next(5.0):
+                        break
+                    route = make_wp(route[-1], self)
+        self.save()
+
+    def _add(self, waypoint):
+        key = f"{waypoint.road_id}:{waypoint.section_id}:{waypoint.lane_id}:{waypoint.s:.3f}"
+        if key not in self.waypoints:
+            self.waypoints[key] = {
+                'road_id': waypoint.road_id,
+                'section_id': waypoint.section_id,
+                'lane_id': waypoint.lane_id,
+                's': waypoint.s,
+                'lane_width': waypoint.lane_width,
+                'transform': _transform_record(waypoint.transform)
+            }
+            self.modified = True
+        return key
+
+    def _waypoint(self, key):
+        return CachedWaypoint(self, key, self.waypoints[key])
+
+class TickProfiler:
+    """
+    Wall-time measurements of the phases of the scenario tick loop:
+    - agent: inference of the AD agent (pcla.get_action)
+    - rpc: other client-server calls made by the loop (transforms, controls, spectator)
+    - npc: NPC control
+    - serialization: writing trace entries and files
+    - tick: waiting for world.tick()
+    A phase can be entered several times per tick; its durations are summed per tick.
+    The real-time factor is the simulated time divided by the wall time of the loop,
+    so a value below 1 means the campaign runs slower than real time.
+    """
+    PHASES = ('agent', 'rpc', 'npc', 'serialization', 'tick')
+    # histogram bin edges, in ms
+    BIN_EDGES_MS = [0, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')]
+
+    def __init__(self, dt):
+        """
+        :param dt: simulated time per tick, in seconds
+        """
+        self.dt = dt
+        self.durations = {phase: [] for phase in self.PHASES}
+        self.current = {phase: 0.0 for phase in self.PHASES}
+        self.ticks = 0
+        self.loop_start = time.perf_counter()
+        self.loop_time = 0.0
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current[name] = self.current.get(name, 0.0) + time.perf_counter() - start
+
+    def end_tick(self, simulated=True):
+        """
+        :param simulated: False if no simulation step was made since the previous call,
+                          e.g., when closing the loop by saving the trace
+        """
+        for name, duration in self.current.items():
+            if simulated or duration > 0:
+                self.durations.setdefault(name, []).append(duration)
+            self.current[name] = 0.0
+        if simulated:
+            self.ticks += 1
+        self.loop_time = time.perf_counter() - self.loop_start
+
+    def summary(self):
+        phases = {}
+        for name, durations in self.durations.items():
+            values = np.array(durations) * 1000.0
+            if len(values) == 0:
+                continue
+            counts, _ = np.histogram(values, bins=self.BIN_EDGES_MS)
+            phases[name] = {
+                'total_s': float(values.sum() / 1000.0),
+                'share': float(values.sum() / 1000.0 / self.loop_time) if self.loop_time > 0 else 0.0,
+                'mean_ms': float(values.mean()),
+                'p50_ms': float(np.percentile(values, 50)),
+                'p95_ms': float(np.percentile(values, 95)),
+                'max_ms': float(values.max()),
+                'histogram_ms': {
+                    'edges': [str(edge) for edge in self.BIN_EDGES_MS],
+                    'counts': counts.tolist()
+                }
+            }
+        sim_time = self.ticks * self.dt
+        return {
+            'ticks': self.ticks,
+            'sim_time_s': sim_time,
+            'wall_time_s': self.loop_time,
+            'real_time_factor': sim_time / self.loop_time if self.loop_time > 0 else 0.0,
+            'phases': phases
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"{summary['ticks']} ticks, simulated {summary['sim_time_s']:.1f} s "
+              f"in {summary['wall_time_s']:.1f} s (real-time factor {summary['real_time_factor']:.2f})")
+        for name, stats in summary['phases'].items():
+            print(f"  {name:<14} {stats['share'] * 100:5.1f}%  mean {stats['mean_ms']:7.2f} ms  "
+                  f"p95 {stats['p95_ms']:7.2f} ms  max {stats['max_ms']:8.2f} ms")
+
+class ScenarioLogger:
+    """
+    Structured log of a scenario run, written as one JSON object per line.
+    Per-tick states are sampled: only every `every` ticks is logged (0 disables them).
+    Events, i.e., state changes such as the NPC starting to move, the U-turn/swerve being
+    triggered or the scenario end, are always logged, and also printed if `echo_events` is set.
+    Records are buffered in memory and written to the file in batches of `buffer_size`.
+    """
+    def __init__(self, path, every=20, buffer_size=1000, echo_events=True):
+        self.every = every
+        self.echo_events = echo_events
+        self.file_handler = logging.FileHandler(path, mode='w')
+        self.file_handler.setFormatter(logging.Formatter('%(message)s'))
+        self.handler = logging.handlers.MemoryHandler(buffer_size, flushLevel=logging.CRITICAL,
+                                                      target=self.file_handler)
+        self.logger = logging.getLogger(f"scenario.{path}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+
+    def _log(self, kind, name, fields):
+        record = {'kind': kind, 'name': name}
+        record.update(fields)
+        self.logger.info(json.dumps(record))
+
+    def tick(self, tick, **fields):
+        if self.every > 0 and tick % self.every == 0:
+            self._log('tick', 'state', dict(tick=tick, **fields))
+
+    def event(self, name, **fields):
+        self._log('event', name, fields)
+        if self.echo_events:
+            print(f"{name}: " + ", ".join(f"{key}={value}" for key, value in fields.items()))
+
+    def close(self):
+        self.handler.flush()
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        self.file_handler.close()
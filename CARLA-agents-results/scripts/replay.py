@@ -1,53 +1,198 @@
 from sys import argv
 import carla
+import json, math, os, re
+from bench_common import write_info, write_shape_info
 
 def make_cli_args():
     import argparse
     parser = argparse.ArgumentParser(description="CARLA Replay Viewer")
-    parser.add_argument('input', type=str, help='Input replay file (e.g., input.rec)')
+    parser.add_argument('input', type=str, nargs='+',
+                        help='Input replay file (e.g., input.rec). Several files can be given in batch mode.')
     parser.add_argument('-f', '--time-factor', type=float, help='Time factor for replay speed', default=1.0)
     parser.add_argument('-s', '--start', type=float, help='Start time for replay', default=0.0)
     parser.add_argument('-d', '--duration', type=float, help='Duration for replay', default=0)
-    return parser.parse_args()
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Replay all input files back to back without rendering, '
+                             'and write the ego/NPC kinematics of each one as a JSON trace')
+    parser.add_argument('-o', '--output-dir', type=str,
+                        help='Folder for the JSON traces written in batch mode (required with --batch)')
+    parser.add_argument('-p', '--sample-period', type=float, default=0.05,
+                        help='Sampling period of the written traces in seconds, in batch mode (default: 0.05)')
+    args = parser.parse_args()
+    if args.batch and not args.output_dir:
+        parser.error("--output-dir is required with --batch")
+    return args
+
+def recorder_file_info(client, path):
+    """
+    Return (map name, duration in seconds) of a recorded log file.
+    """
+    info = client.show_recorder_file_info(path, False)
+    map_match = re.search(r"Map:\s*(\S+)", info)
+    duration_match = re.search(r"Duration:\s*([\d.]+)\s*seconds", info)
+    if not map_match or not duration_match:
+        raise ValueError(f"Cannot read map and duration of {path}:\n{info}")
+    return map_match.group(1), float(duration_match.group(1))
+
+def find_vehicles(world):
+    vehicles = world.get_actors().filter('vehicle.*')
+    ego = next((v for v in vehicles if v.attributes.get('role_name') == 'hero'), None)
+    npc = next((v for v in vehicles if v.attributes.get('role_name') != 'hero'), None)
+    return ego, npc
+
+def recorded_metadata(path):
+    """
+    Scenario metadata (U-turn/swerve waypoints), which log files do not contain, of the trace
+    recorded with a log file (the JSON file of the same name); None if there is no such valid trace.
+    """
+    try:
+        with open(os.path.splitext(path)[0] + '.json', 'r') as f:
+            return json.load(f)['metadata']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def behavior_point(data, turn_rate=1.0, min_speed=0.5):
+    """
+    U-turn/swerve point of an extracted trace, as in trace-analysis/recorder.py: the NPC front
+    at the last sample before its yaw rate exceeds `turn_rate` (deg/s) while it moves.
+    None if the NPC does not turn.
+    """
+    npc_size = next((item for item in data['groundtruth_size'] if item['name'] == 'npc1'), None)
+    entries = data['groundtruth_kinematic']
+    if npc_size is None:
+        return None
+    for entry, next_entry in zip(entries, entries[1:]):
+        npc, next_npc = entry['groundtruth_vehicles'][0], next_entry['groundtruth_vehicles'][0]
+        yaw = npc['pose']['rotation']['z']
+        yaw_change = (next_npc['pose']['rotation']['z'] - yaw + 180) % 360 - 180
+        speed = math.hypot(npc['twist']['linear']['x'], npc['twist']['linear']['y'])
+        if abs(yaw_change) > turn_rate * (next_entry['timestamp'] - entry['timestamp']) and speed > min_speed:
+            forward = npc_size['center']['x'] + npc_size['size']['x'] / 2
+            side = npc_size['center']['y']
+            cos, sin = math.cos(math.radians(yaw)), math.sin(math.radians(yaw))
+            position = npc['pose']['position']
+            return {'x': position['x'] + forward * cos - side * sin,
+                    'y': position['y'] + forward * sin + side * cos,
+                    'z': position['z']}
+    return None
+
+def extract_trace(client, path, start, duration, sample_period):
+    """
+    Replay a log file as fast as the server can tick, with rendering disabled,
+    and return the ego/NPC kinematics in the trace-analysis JSON schema.
+    The metadata is copied from the trace recorded with the log, if any; otherwise, the U-turn/swerve
+    point (by the file name) is rebuilt from the NPC motion, see behavior_point.
+    In synchronous mode, every tick advances the replay by `sample_period` seconds,
+    so the replay ends exactly at the end of the log instead of looping.
+    """
+    map_name, log_duration = recorder_file_info(client, path)
+    world = client.get_world()
+    if not world.get_map().name.endswith(map_name):
+        world = client.load_world(map_name)
+
+    settings = world.get_settings()
+    settings.synchronous_mode = True
+    settings.no_rendering_mode = True
+    settings.fixed_delta_seconds = sample_period
+    world.apply_settings(settings)
+
+    end = log_duration if duration <= 0 else min(start + duration, log_duration)
+    client.set_replayer_time_factor(1.0)
+    client.replay_file(path, start, 0, 0)
+
+    data = {
+        'groundtruth_kinematic': [],
+        'groundtruth_size': [],
+        'metadata': { }
+    }
+    ego, npc = None, None
+    time_acc = 0.0
+    replay_time = start
+    while replay_time < end:
+        world.tick()
+        replay_time += sample_period
+        if ego is None or npc is None:
+            ego, npc = find_vehicles(world)
+            if ego is None or npc is None:
+                continue
+            data['groundtruth_size'] = [
+                write_shape_info(ego.bounding_box, 'ego'),
+                write_shape_info(npc.bounding_box, 'npc1')
+            ]
+        data['groundtruth_kinematic'].append(write_info(data, time_acc, ego, npc))
+        time_acc += sample_period
+
+    client.stop_replayer(False)
+    world.tick()
+
+    metadata = recorded_metadata(path)
+    if metadata is not None:
+        data['metadata'] = metadata
+    else:
+        name = os.path.basename(path)
+        key = 'swerve_point' if name.startswith('swerve') else 'uturn_point' if name.startswith('uturn') else None
+        point = behavior_point(data) if key else None
+        if point is not None:
+            data['metadata'][key] = point
+        else:
+            print(f"[WARNING] {path}: no U-turn/swerve point, the trace cannot be analyzed")
+    return data
+
+def run_batch(client, args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    for path in args.input:
+        print(f"Replaying {path}...")
+        data = extract_trace(client, path, args.start, args.duration, args.sample_period)
+        out_path = os.path.join(args.output_dir,
+                                os.path.splitext(os.path.basename(path))[0] + ".json")
+        with open(out_path, 'w') as f:
+            json.dump(data, f, indent=None)
+        print(f"Written {len(data['groundtruth_kinematic'])} samples to {out_path}")
 
 if __name__ == '__main__':
     args = make_cli_args()
     try:
         client = carla.Client('localhost', 2000)
         client.set_timeout(10.0)
-        client.load_world("Town10HD")
-        print(client.show_recorder_file_info(args.input, False))
-
-        world = client.get_world()
-        settings = world.get_settings()
-        traffic_manager = client.get_trafficmanager(8000)
-        traffic_manager.set_synchronous_mode(True)
-        settings.synchronous_mode = True
-        settings.fixed_delta_seconds = 0.05
-        
-        client.set_replayer_time_factor(args.time_factor)
-        client.replay_file(args.input, args.start, args.duration, 0)
-
-        spectator = world.get_spectator()
-        ego = None
-        ttc = 1e9
-
-        while True:
-            world.tick()
-
-            if ego is None: 
-                vehicles = world.get_actors().filter('vehicle.*')
-                ego = next((v for v in vehicles if v.attributes.get('role_name') == 'hero'), None)
-            else:
-                ego_transform = ego.get_transform()
-                spectator_location = ego_transform.location - ego_transform.get_forward_vector()*6.0 + carla.Location(z=4.0)
-                spectator_transform = carla.Transform(spectator_location, carla.Rotation(pitch=-15.0,yaw=ego_transform.rotation.yaw))
-                spectator.set_transform(spectator_transform)
+
+        if args.batch:
+            world = client.get_world()
+            settings = world.get_settings()
+            run_batch(client, args)
+        else:
+            client.load_world("Town10HD")
+            print(client.show_recorder_file_info(args.input[0], False))
+
+            world = client.get_world()
+            settings = world.get_settings()
+            traffic_manager = client.get_trafficmanager(8000)
+            traffic_manager.set_synchronous_mode(True)
+            settings.synchronous_mode = True
+            settings.fixed_delta_seconds = 0.05
+
+            client.set_replayer_time_factor(args.time_factor)
+            client.replay_file(args.input[0], args.start, args.duration, 0)
+
+            spectator = world.get_spectator()
+            ego = None
+            ttc = 1e9
+
+            while True:
+                world.tick()
+
+                if ego is None:
+                    vehicles = world.get_actors().filter('vehicle.*')
+                    ego = next((v for v in vehicles if v.attributes.get('role_name') == 'hero'), None)
+                else:
+                    ego_transform = ego.get_transform()
+                    spectator_location = ego_transform.location - ego_transform.get_forward_vector()*6.0 + carla.Location(z=4.0)
+                    spectator_transform = carla.Transform(spectator_location, carla.Rotation(pitch=-15.0,yaw=ego_transform.rotation.yaw))
+                    spectator.set_transform(spectator_transform)
 
         # client.set_replayer_time_factor(1)
     except KeyboardInterrupt:
         pass
     finally:
-        #settings.no_rendering_mode = False
+        settings.no_rendering_mode = False
         settings.synchronous_mode = False
-        world.apply_settings(settings)
+        client.get_world().apply_settings(settings)
@@ -51,7 +51,7 @@ def make_uturn(world, map_, vehicle):
     left_direction = carla.Vector3D(forward.y, -forward.x, 0.0)
 
     front_center = get_front_center(vehicle)
-    current_fc_wp = map_.get_waypoint(front_center)
+    current_fc_wp = map_.get_waypoint(front_center, cache=False)
     radius = max(current_fc_wp.lane_width, 3.8)
 
     rear_center_wheels = get_middle_rear_wheels_position(vehicle)
@@ -132,35 +132,47 @@ def run_one_agent(args, world, map_, client, vehicle_spawn_points, pid, lane, vo
     time_acc = 0.0
     uturn_done = False
     moving = False
+    profiler = TickProfiler(dt)
+    logger = ScenarioLogger(args.output + f"_{args.agent}_{lane}_{int(vo)}.events.jsonl", every=args.log_every)
     try:
         route = get_route(lane)
         pcla = PCLA(args.agent, ego, route, client)
         while True:
-            data['groundtruth_kinematic'].append(write_info(data, time_acc, ego, npc))
+            with profiler.phase('serialization'):
+                data['groundtruth_kinematic'].append(write_info(data, time_acc, ego, npc))
             time_acc += dt
 
-            ego_transform = ego.get_transform()
-            spectator.set_transform(viewpoint_transform(ego_transform))
-        
+            with profiler.phase('rpc'):
+                ego_transform = ego.get_transform()
+                spectator.set_transform(viewpoint_transform(ego_transform))
+
             # Ego
-            ego_action = pcla.get_action()
-            ego.apply_control(ego_action)
-            print(f"Ego speed: {get_speed(ego)*3.6:.2f}, NPC speed: {get_speed(npc)*3.6:.2f} km/h")
+            with profiler.phase('agent'):
+                ego_action = pcla.get_action()
+            with profiler.phase('rpc'):
+                ego.apply_control(ego_action)
+            logger.tick(len(data['groundtruth_kinematic']), time=time_acc,
+                        ego_speed=get_speed(ego)*3.6, npc_speed=get_speed(npc)*3.6)
 
             # NPC
-            if get_speed(ego) >= 13.8/3.6 and not moving and ego_transform.location.distance(npc.get_transform().location) < 80.0:
-                moving = True
-                print("NPC starts moving")
-            if moving:
-                uturn_done, next_waypoints, next_waypoint, meta_waypoints = control_npc(
-                    world, map_, ego, npc, dt, pid, vo/3.6, uturn_done, next_waypoints, next_waypoint, dx0)
-                if meta_waypoints is not None:
-                    data['metadata']['waypoints'] = [write_vector3d(p) for p in meta_waypoints]
-
-            world.tick()
+            with profiler.phase('npc'):
+                if get_speed(ego) >= 13.8/3.6 and not moving and ego_transform.location.distance(npc.get_transform().location) < 80.0:
+                    moving = True
+                    logger.event('npc_starts_moving', time=time_acc, ego_speed=get_speed(ego)*3.6)
+                if moving:
+                    uturn_done, next_waypoints, next_waypoint, meta_waypoints = control_npc(
+                        world, map_, ego, npc, dt, pid, vo/3.6, uturn_done, next_waypoints, next_waypoint, dx0)
+                    if meta_waypoints is not None:
+                        data['metadata']['waypoints'] = [write_vector3d(p) for p in meta_waypoints]
+                        logger.event('uturn_triggered', time=time_acc,
+                                     longitudinal_distance=longitudinal_distance(ego, npc))
+
+            with profiler.phase('tick'):
+                world.tick()
+            profiler.end_tick()
 
             if trigger_end(ego, ego_transform, npc, time_acc):
-                print("Ending scenario.")
+                logger.event('scenario_end', time=time_acc)
                 break
 
     except KeyboardInterrupt:
@@ -169,8 +181,14 @@ def run_one_agent(args, world, map_, client, vehicle_spawn_points, pid, lane, vo
         print("Saving and exiting...")
         client.stop_recorder()
         # save to json file
-        with open(args.output + f"_{args.agent}_{lane}_{int(vo)}.json", 'w') as f:
-            json.dump(data, f, indent=None)
+        with profiler.phase('serialization'):
+            with open(args.output + f"_{args.agent}_{lane}_{int(vo)}.json", 'w') as f:
+                json.dump(data, f, indent=None)
+        profiler.end_tick(simulated=False)
+        # per-phase timing, next to the trace
+        profiler.write(args.output + f"_{args.agent}_{lane}_{int(vo)}.timing.json")
+        profiler.print_summary()
+        logger.close()
 
         # Full stop
         npc.apply_control(carla.VehicleControl(brake=1.0))
@@ -187,7 +205,8 @@ def main(args):
     client.set_timeout(10.0)
     client.load_world("Town10HD")
     world = client.get_world()
-    map_ = world.get_map()
+    # waypoint queries are served from a per-town cache saved on disk
+    map_ = WaypointCache(world.get_map())
     traffic_manager = client.get_trafficmanager(8000)
     settings = world.get_settings()
     asynch = False
@@ -204,7 +223,9 @@ def main(args):
     
     bp_library = world.get_blueprint_library()
     vehicle_spawn_points = map_.get_spawn_points()
-    
+    # NPC spawn points of the innermost and adjacent lanes
+    map_.precompute([vehicle_spawn_points[20].location, vehicle_spawn_points[67].location])
+
     for lane in ['innermost', 'adjacent']:
         for vo in [10, 15]:
             dx0 = d_dx0(lane, vo)
@@ -212,12 +233,16 @@ def main(args):
             print(f"Running agent: {args.agent} with lane={lane}, vo={vo}, dx0={dx0}")
             client.start_recorder(args.output + f"_{args.agent}_{lane}_{int(vo)}.log", True)
             run_one_agent(args, world, map_, client, vehicle_spawn_points, pid, lane, vo, dx0, bp_library)
+            map_.save()
 
 def make_cli_args():
     import argparse
     parser = argparse.ArgumentParser(description="CARLA U-turn Scenario")
     parser.add_argument('output', type=str, help='Output file for saving the (replayable) log and trace data. Must be an absolute path.')
     parser.add_argument('-a', '--agent', type=str, help='Agent name, either "tf_tf", "lav_lav", "if_if", "tf_ltf", "tf_gf", "tf_lf"', default='tf_tf')
+    parser.add_argument('--log-every', type=int, default=20,
+                        help='Log the ego/NPC state every N ticks in the events log, 0 to disable (default: 20). '
+                             'Events (NPC starts moving, U-turn/swerve triggered, scenario end) are always logged.')
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -0,0 +1,365 @@
+"""
+Performance benchmarks of the hot paths of safety-benchmarks and trace-analysis.
+
+Each benchmark is timed over several repeats (wall time, time.perf_counter) and measured once more
+under tracemalloc for its peak Python memory, so the timings are not slowed by tracing.
+Results are appended, one JSON line per run, to a history file keyed by the git commit,
+and two runs can be compared to spot regressions.
+
+The two folders are self-contained scripts that both define a `utils` module,
+so each is imported with its own folder at the front of sys.path.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAFETY_DIR = os.path.join(ROOT, 'safety-benchmarks')
+TRACE_DIR = os.path.join(ROOT, 'trace-analysis')
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.jsonl')
+
+# number of entries of the synthetic traces, at 100 Hz (the recorded traces hold tens of thousands)
+TRACE_SIZES = (1000, 10000, 50000)
+
+def _import_from(folder, *names):
+    """
+    Import top-level modules of one folder, dropping the modules of the same name
+    that another folder may have loaded before (e.g., `utils`).
+    `profiling` is kept: both folders share the module of safety-benchmarks/profiling.py.
+    """
+    for name in ('utils', 'common', 'vehicle'):
+        sys.modules.pop(name, None)
+    sys.path.insert(0, folder)
+    try:
+        return [__import__(name, fromlist=['_']) for name in names]
+    finally:
+        sys.path.remove(folder)
+
+def git_commit():
+    """
+    Return (commit hash, True if the working tree has uncommitted changes), or (None, False) outside git.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+class Benchmark:
+    def __init__(self, name, setup, repeat=5, group=''):
+        """
+        :param name: unique name, e.g., `trace.min_ttc[10000]`
+        :param setup: function returning the callable to measure, so preparation is not measured
+        :param repeat: number of timed calls
+        :param group: `safety` or `trace`
+        """
+        self.name = name
+        self.setup = setup
+        self.repeat = repeat
+        self.group = group
+
+    def run(self, repeat=None, memory=True):
+        """
+        Return a dictionary with the wall times in seconds and the peak memory in bytes.
+        """
+        func = self.setup()
+        times = []
+        # simulation() and the sweeps print their progress
+        with redirect_stdout(io.StringIO()):
+            for _ in range(repeat or self.repeat):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+                plt.close('all')
+            peak = None
+            if memory:
+                tracemalloc.start()
+                func()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                plt.close('all')
+        return {
+            'repeat': len(times),
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.fmean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+            'peak_memory': peak
+        }
+
+# --- safety-benchmarks ---
+
+def random_rectangles(count, seed=0):
+    """
+    Return `count` pairs of rectangle vertices (count, 2, 4, 2), about half of them overlapping.
+    """
+    rng = np.random.default_rng(seed)
+    local = np.array([[2.5, 1.0], [-2.5, 1.0], [-2.5, -1.0], [2.5, -1.0]])
+    centers = rng.uniform(-4, 4, size=(count, 2, 2))
+    angles = rng.uniform(0, 2 * np.pi, size=(count, 2))
+    cos, sin = np.cos(angles)[..., None], np.sin(angles)[..., None]
+    x = cos * local[:, 0] - sin * local[:, 1]
+    y = sin * local[:, 0] + cos * local[:, 1]
+    return np.stack((x, y), axis=-1) + centers[:, :, None, :]
+
+def safety_benchmarks():
+    uturn, swerve, safety_utils, common = _import_from(SAFETY_DIR, 'uturn.uturn', 'swerve.swerve', 'utils', 'common')
+
+    def uturn_cells():
+        return lambda: [uturn.single_sim_exec(dx, 30 / 3.6, 10 / 3.6) for dx in (12, 25, 40)]
+
+    def swerve_cells():
+        return lambda: [swerve.single_sim_exec(dx, 20 / 3.6, 10 / 3.6, 1.0, swerve.NY, swerve.SWERVE_DISTANCE)
+                        for dx in (15, 30, 45)]
+
+    def collision_pairs():
+        pairs = random_rectangles(1000)
+        return lambda: [safety_utils.is_collision(ego, npc) for ego, npc in pairs]
+
+    def vertices():
+        # called for both vehicles at every Simulation.step
+        vehicles = [common.Vehicle((x, 0.0), heading, (10 / 3.6, 0.0), (4.5, 1.8))
+                    for x, heading in zip(range(1000), np.linspace(0, 2 * np.pi, 1000))]
+        return lambda: [veh.get_vertices() for veh in vehicles]
+
+    return [
+        Benchmark('safety.uturn.single_sim_exec', uturn_cells, group='safety'),
+        Benchmark('safety.swerve.single_sim_exec', swerve_cells, group='safety'),
+        Benchmark('safety.uturn.simulation', lambda: lambda: uturn.simulation(10 / 3.6), repeat=1,
+                  group='safety'),
+        Benchmark('safety.uturn.simulation[library]',
+                  lambda: lambda: uturn.simulation(10 / 3.6, library=True), repeat=3, group='safety'),
+        Benchmark('safety.utils.is_collision', collision_pairs, group='safety'),
+        Benchmark('safety.Vehicle.get_vertices', vertices, group='safety'),
+    ]
+
+# --- trace-analysis ---
+
+def synthetic_trace(count, step=0.01, ve=30 / 3.6, vo=10 / 3.6, start_fraction=0.5):
+    """
+    Return a trace dictionary in the JSON trace schema with `count` entries:
+    the ego drives along +x, the NPC comes the other way in the adjacent lane and
+    passes the U-turn point at `start_fraction` of the trace, then the two vehicles cross
+    without colliding, so collision and TTC checks scan the whole window.
+    """
+    times = np.arange(count) * step
+    start = times[int(count * start_fraction)]
+    # the vehicles are side by side 2 s after the U-turn point
+    meet = start + 2.0
+    ego_x = ve * (times - meet)
+    npc_x = -vo * (times - meet)
+
+    def kinematic(x, y, heading, vx):
+        return {'pose': {'position': {'x': float(x), 'y': y, 'z': 0.0},
+                         'rotation': {'x': 0.0, 'y': 0.0, 'z': heading}},
+                'twist': {'linear': {'x': vx, 'y': 0.0, 'z': 0.0}}}
+
+    entries = [{'timestamp': float(t),
+                'groundtruth_ego': kinematic(ex, 0.0, 0.0, ve),
+                'groundtruth_vehicles': [dict(kinematic(nx, 3.5, 180.0, -vo), name="NPC")]}
+               for t, ex, nx in zip(times, ego_x, npc_x)]
+    sizes = [{'name': 'ego', 'size': {'x': 4.9, 'y': 1.9, 'z': 1.5}, 'center': {'x': 1.4, 'y': 0.0, 'z': 0.7}},
+             {'name': 'npc1', 'size': {'x': 4.5, 'y': 1.8, 'z': 1.5}, 'center': {'x': 1.3, 'y': 0.0, 'z': 0.7}}]
+    uturn_point = -vo * (start - meet) - 4.5 / 2 - 1.3
+    return {'groundtruth_kinematic': entries,
+            'groundtruth_size': sizes,
+            'metadata': {'uturn_point': {'x': float(uturn_point), 'y': 3.5, 'z': 0.0}}}
+
+def trace_benchmarks(folder, sizes=TRACE_SIZES):
+    """
+    :param folder: where the synthetic traces are written, when first needed
+    """
+    analysis, trace_utils, vehicle = _import_from(TRACE_DIR, 'analysis', 'utils', 'vehicle')
+    paths = {}
+
+    def trace_file(count):
+        if count not in paths:
+            paths[count] = os.path.join(folder, f'uturn_synthetic_{count}.json')
+            with open(paths[count], 'w') as f:
+                json.dump(synthetic_trace(count), f)
+        return paths[count]
+
+    def loaded(count):
+        return analysis.load_data(trace_file(count))
+
+    def collision_pairs():
+        pairs = random_rectangles(1000)
+        return lambda: [trace_utils.is_collision(ego, npc) for ego, npc in pairs]
+
+    def vertices():
+        vehicles = [vehicle.Vehicle((4.5, 1.8), (x, 0.0), heading, (1.3, 0.0))
+                    for x, heading in zip(range(1000), np.linspace(0, 360, 1000))]
+        return lambda: [veh.get_vertices() for veh in vehicles]
+
+    def loading(count):
+        path = trace_file(count)
+        return lambda: analysis.load_data(path)
+
+    def start_moment(count):
+        data = loaded(count)
+        return lambda: analysis.behavior_start_moment(data, analysis.UTURN_KEY_STR)
+
+    def from_start(func):
+        def setup(count):
+            data = loaded(count)
+            start = analysis.behavior_start_moment(data, analysis.UTURN_KEY_STR)
+            return lambda: func(data, start)
+        return setup
+
+    benchmarks = [
+        Benchmark('trace.utils.is_collision', collision_pairs, group='trace'),
+        Benchmark('trace.Vehicle.get_vertices', vertices, group='trace'),
+    ]
+    for count in sizes:
+        benchmarks += [
+            Benchmark(f'trace.load_data[{count}]', lambda count=count: loading(count), group='trace'),
+            Benchmark(f'trace.behavior_start_moment[{count}]', lambda count=count: start_moment(count),
+                      group='trace'),
+            Benchmark(f'trace.is_collision[{count}]',
+                      lambda count=count: from_start(analysis.is_collision)(count), group='trace'),
+        ]
+    # min_ttc only scans the 10 s after the start, so its cost does not grow with the trace
+    benchmarks.append(Benchmark(f'trace.min_ttc[{sizes[0]}]',
+                                lambda: from_start(analysis.min_ttc)(sizes[0]), repeat=1, group='trace'))
+    return benchmarks
+
+def all_benchmarks(folder):
+    return safety_benchmarks() + trace_benchmarks(folder)
+
+# --- history ---
+
+def is_selected(name, patterns):
+    """
+    Whether a benchmark name contains one of the patterns, in which `*` matches any characters;
+    other characters, e.g., the brackets of `trace.min_ttc[1000]`, are literal.
+    """
+    return any(re.search('.*'.join(map(re.escape, pattern.split('*'))), name) for pattern in patterns)
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def find_run(history, ref):
+    """
+    Return the last run whose commit starts with `ref`, or the last run for `last`,
+    the one before for `last~1`, etc.
+    """
+    if ref.startswith('last'):
+        back = int(ref[5:] or 0) if ref.startswith('last~') else 0
+        return history[-1 - back] if back < len(history) else None
+    try:
+        ref = subprocess.run(['git', 'rev-parse', ref], cwd=ROOT, capture_output=True,
+                             text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    runs = [run for run in history if run['commit'] and run['commit'].startswith(ref)]
+    return runs[-1] if runs else None
+
+def compare(base, head, threshold=0.1):
+    """
+    Print the ratio head / base of the median times and peak memories of the common benchmarks.
+    :return: list of names of the benchmarks slower than (1 + threshold) * base
+    """
+    print(f"base: {base['commit'] or '?'}{' (dirty)' if base['dirty'] else ''} {base['date']}")
+    print(f"head: {head['commit'] or '?'}{' (dirty)' if head['dirty'] else ''} {head['date']}")
+    print(f"{'benchmark':45s} {'base (s)':>10s} {'head (s)':>10s} {'time':>7s} {'memory':>7s}")
+    regressions = []
+    for name, result in head['results'].items():
+        if name not in base['results']:
+            continue
+        old = base['results'][name]
+        ratio = result['median'] / old['median'] if old['median'] > 0 else float('inf')
+        memory = (f"{result['peak_memory'] / old['peak_memory']:6.2f}x"
+                  if result['peak_memory'] and old['peak_memory'] else '      -')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  slower'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print(f"{name:45s} {old['median']:10.4f} {result['median']:10.4f} {ratio:6.2f}x {memory}{flag}")
+    return regressions
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description='Timing and memory benchmarks of the simulator, geometry '
+                                                 'and trace-analysis hot paths, recorded per git commit.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='run benchmarks and append the results to the history file')
+    run.add_argument('-k', '--select', nargs='+', default=['*'],
+                     help='run the benchmarks whose names contain one of these patterns, '
+                          'with `*` matching any characters (default: all)')
+    run.add_argument('--repeat', type=int, help='timed calls per benchmark (default: per benchmark)')
+    run.add_argument('--no-memory', action='store_true', help='skip the tracemalloc measurement')
+    run.add_argument('--no-save', action='store_true', help='print the results only')
+
+    subparsers.add_parser('list', help='list the benchmark names')
+
+    comparison = subparsers.add_parser('compare', help='compare two recorded runs')
+    comparison.add_argument('base', nargs='?', default='last~1',
+                            help='commit (any git revision) or `last~N` (default: last~1)')
+    comparison.add_argument('head', nargs='?', default='last', help='commit or `last~N` (default: last)')
+    comparison.add_argument('--threshold', type=float, default=0.1,
+                            help='relative slowdown reported as a regression (default: 0.1)')
+
+    for subparser in (run, comparison):
+        subparser.add_argument('--history', default=HISTORY,
+                               help='JSON lines history file (default: perf-benchmarks/history.jsonl)')
+    return parser
+
+if __name__ == '__main__':
+    cli_args = cli_parser().parse_args()
+    if cli_args.command == 'list':
+        for bench in all_benchmarks(None):
+            print(bench.name)
+    elif cli_args.command == 'compare':
+        history = read_history(cli_args.history)
+        base, head = find_run(history, cli_args.base), find_run(history, cli_args.head)
+        if base is None or head is None:
+            sys.exit(f"No recorded run for {cli_args.base if base is None else cli_args.head}")
+        if compare(base, head, cli_args.threshold):
+            sys.exit(1)
+    else:
+        commit, dirty = git_commit()
+        record = {
+            'commit': commit,
+            'dirty': dirty,
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': f"{platform.system()} {platform.machine()} {platform.node()}",
+            'results': {}
+        }
+        with tempfile.TemporaryDirectory(prefix='perf-traces-') as folder:
+            for bench in all_benchmarks(folder):
+                if not is_selected(bench.name, cli_args.select):
+                    continue
+                result = bench.run(cli_args.repeat, not cli_args.no_memory)
+                record['results'][bench.name] = result
+                memory = f"{result['peak_memory'] / 2 ** 20:8.1f} MiB" if result['peak_memory'] is not None else ''
+                print(f"{bench.name:45s} median {result['median']:9.4f} s  min {result['min']:9.4f} s {memory}")
+        if not cli_args.no_save:
+            with open(cli_args.history, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            print(f"Appended to {cli_args.history} (commit {commit}{', dirty' if dirty else ''})")
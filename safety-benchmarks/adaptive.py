@@ -0,0 +1,174 @@
+import numpy as np
+
+class AdaptiveSampler:
+    """
+    Adaptive (quadtree) sampling of a benchmark map, i.e., a binary function
+    is_safe(x, y) over a rectangle, e.g., (dx0, ve) for U-turn or (dx0, vy) for swerve.
+
+    The rectangle is first split into a coarse grid of cells, and each cell whose four corners
+    do not have the same verdict is split into four, recursively, down to a target resolution.
+    Samples lie on the lattice of the finest cells and are shared between neighboring cells,
+    so each point is simulated once. Far from the collision boundary the map stays coarse.
+    Note that a region of the other verdict that lies entirely inside a coarse cell is missed,
+    so the initial grid must be fine enough to see every region of the map.
+    """
+    def __init__(self, is_safe, x_range, y_range, resolution, initial_cells=(8, 4)):
+        """
+        :param is_safe: function (x, y) -> True if no collision
+        :param x_range: (min, max) of x
+        :param y_range: (min, max) of y
+        :param resolution: (dx, dy), maximum size of the finest cells
+        :param initial_cells: number of cells of the initial grid along x and y
+        """
+        self.is_safe = is_safe
+        self.x_range = x_range
+        self.y_range = y_range
+        self.initial_cells = initial_cells
+        # number of times the initial cells can be split, the same for both axes
+        self.depth = max(0, max(
+            int(np.ceil(np.log2((high - low) / res / cells)))
+            for (low, high), res, cells in zip((x_range, y_range), resolution, initial_cells)))
+        self.nx = initial_cells[0] * 2 ** self.depth
+        self.ny = initial_cells[1] * 2 ** self.depth
+        # lattice point (i, j) -> verdict
+        self.samples = {}
+        # cells (i0, j0, i1, j1) in lattice coordinates, filled by run()
+        self.leaves = []
+
+    def to_xy(self, i, j):
+        x = self.x_range[0] + (self.x_range[1] - self.x_range[0]) * i / self.nx
+        y = self.y_range[0] + (self.y_range[1] - self.y_range[0]) * j / self.ny
+        return x, y
+
+    def verdict(self, i, j):
+        if (i, j) not in self.samples:
+            self.samples[(i, j)] = bool(self.is_safe(*self.to_xy(i, j)))
+        return self.samples[(i, j)]
+
+    def corners(self, cell):
+        i0, j0, i1, j1 = cell
+        return (self.verdict(i0, j0), self.verdict(i1, j0),
+                self.verdict(i1, j1), self.verdict(i0, j1))
+
+    def is_mixed(self, cell):
+        """
+        A cell must be split if its corners disagree, or if a sample already taken on its
+        border (by a finer neighbor) disagrees with them.
+        """
+        corners = self.corners(cell)
+        if any(corner != corners[0] for corner in corners):
+            return True
+        i0, j0, i1, j1 = cell
+        border = [(i, j) for i in range(i0, i1 + 1) for j in (j0, j1)] + \
+                 [(i, j) for i in (i0, i1) for j in range(j0 + 1, j1)]
+        return any(self.samples.get(point, corners[0]) != corners[0] for point in border)
+
+    def run(self):
+        """
+        Refine the map and return the leaves, as cells (i0, j0, i1, j1) in lattice coordinates.
+        """
+        step = 2 ** self.depth
+        pending = [(i * step, j * step, (i + 1) * step, (j + 1) * step)
+                   for i in range(self.initial_cells[0]) for j in range(self.initial_cells[1])]
+        self.leaves = []
+        # splitting a cell adds samples on the borders of its neighbors,
+        # so leaves are checked again until none of them must be split
+        while pending:
+            for cell in pending:
+                self.split(cell, self.leaves)
+            pending = set(cell for cell in self.leaves if cell[2] - cell[0] > 1 and self.is_mixed(cell))
+            self.leaves = [cell for cell in self.leaves if cell not in pending]
+        return self.leaves
+
+    def split(self, cell, leaves):
+        i0, j0, i1, j1 = cell
+        if not self.is_mixed(cell) or i1 - i0 == 1:
+            leaves.append(cell)
+            return
+        im, jm = (i0 + i1) // 2, (j0 + j1) // 2
+        for sub_cell in ((i0, j0, im, jm), (im, j0, i1, jm), (im, jm, i1, j1), (i0, jm, im, j1)):
+            self.split(sub_cell, leaves)
+
+    def boundary(self):
+        """
+        Return the collision boundary as a list of polylines, each an array (n, 2) of (x, y).
+        It is traced by marching squares on the finest cells whose corners disagree:
+        each such cell contributes a segment between the midpoints of its edges whose
+        end points disagree.
+        """
+        # end points are kept in half-lattice coordinates, so that they match exactly
+        segments = []
+        for cell in self.leaves:
+            i0, j0, i1, j1 = cell
+            if i1 - i0 != 1:
+                continue
+            corners = self.corners(cell)
+            points = [(2 * i0 + 1, 2 * j0), (2 * i1, 2 * j0 + 1), (2 * i0 + 1, 2 * j1), (2 * i0, 2 * j0 + 1)]
+            crossings = [points[k] for k in range(4) if corners[k] != corners[(k + 1) % 4]]
+            # 2 crossings, or 4 for a saddle cell
+            segments.extend(zip(crossings[0::2], crossings[1::2]))
+
+        neighbors = {}
+        for a, b in segments:
+            neighbors.setdefault(a, []).append(b)
+            neighbors.setdefault(b, []).append(a)
+        # start from open ends first, then what remains are closed loops
+        starts = [point for point, others in neighbors.items() if len(others) == 1] + list(neighbors)
+        visited = set()
+        polylines = []
+        for start in starts:
+            if start in visited:
+                continue
+            line = [start]
+            visited.add(start)
+            while True:
+                following = [point for point in neighbors[line[-1]] if point not in visited]
+                if not following:
+                    break
+                line.append(following[0])
+                visited.add(following[0])
+            if len(line) > 2 and line[0] in neighbors[line[-1]]:
+                line.append(line[0])
+            if len(line) > 1:
+                polylines.append(np.array([self.to_xy(i / 2, j / 2) for i, j in line]))
+        return polylines
+
+    def points(self):
+        """
+        Return all samples as arrays x, y, verdict.
+        """
+        lattice = np.array(list(self.samples.keys()), dtype=float).reshape(-1, 2)
+        x, y = self.to_xy(lattice[:, 0], lattice[:, 1])
+        return x, y, np.array(list(self.samples.values()), dtype=bool)
+
+    def save(self, path):
+        """
+        Save samples, leaves (as x0, y0, x1, y1) and boundary polylines to a npz file.
+        """
+        x, y, verdicts = self.points()
+        leaves = np.array(self.leaves, dtype=float).reshape(-1, 4)
+        x0, y0 = self.to_xy(leaves[:, 0], leaves[:, 1])
+        x1, y1 = self.to_xy(leaves[:, 2], leaves[:, 3])
+        polylines = self.boundary()
+        np.savez_compressed(
+            path, x=x, y=y, safe=verdicts,
+            leaves=np.stack((x0, y0, x1, y1), axis=1),
+            boundary=np.concatenate(polylines) if polylines else np.zeros((0, 2)),
+            boundary_lengths=np.array([len(line) for line in polylines], dtype=int))
+
+    def plot(self, ax, colors=('r', 'g', 'orange')):
+        """
+        Draw the refined map: leaves colored by verdict (collision, no collision, boundary
+        cells) and the boundary polylines.
+        """
+        from matplotlib.patches import Rectangle
+        for cell in self.leaves:
+            corners = self.corners(cell)
+            color = colors[2] if len(set(corners)) > 1 else colors[1] if corners[0] else colors[0]
+            (x0, y0), (x1, y1) = self.to_xy(cell[0], cell[1]), self.to_xy(cell[2], cell[3])
+            ax.add_patch(Rectangle((x0, y0), x1 - x0, y1 - y0, facecolor=color,
+                                   edgecolor='white', linewidth=0.2))
+        for line in self.boundary():
+            ax.plot(line[:, 0], line[:, 1], color='black', linewidth=1)
+        ax.set_xlim(*self.x_range)
+        ax.set_ylim(*self.y_range)
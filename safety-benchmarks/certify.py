@@ -0,0 +1,130 @@
+import numpy as np
+import utils
+
+SAFE = 'safe'
+COLLISION = 'collision'
+UNDECIDED = 'undecided'
+
+class Certifier:
+    """
+    Set-based certification of whole boxes of initial conditions dx0 in [a, b], ve in [c, d]
+    for one scenario configuration, given by its TrajectoryLibrary.
+
+    A box is certified safe if, at every step, the union of all possible ego footprints
+    does not meet the union of all possible NPC footprints, and certified collision if,
+    at some step, the footprint common to all ego positions meets the footprint common
+    to all NPC positions. Otherwise it is undecided.
+
+    The bounds are sound for the stepped simulation, not only for sampled points:
+    - the NPC footprint at step k is the same for all dx0, translated by dx0, so over [a, b]
+      it sweeps the polygon along a segment, which is convex;
+    - the ego keeps heading 0 and its deceleration profile does not depend on ve, so its speed
+      at every step is non-decreasing in ve, and so is its position, up to the last step
+      before stopping, which can move it back by at most 0.5 * decel * sim_step^2.
+      The ego positions over [c, d] are thus bounded by the positions at c and d, with this margin.
+    """
+    def __init__(self, library):
+        """
+        :param library: trajectory.TrajectoryLibrary of the scenario configuration
+        """
+        self.library = library
+        # margin for the non-monotonic last step of the ego, and for round-off errors
+        driver = library.driver
+        self.margin = 0.5 * max(driver.max_deceleration, driver.AEB_max_deceleration) * library.sim_step ** 2 + 1e-9
+        npc = library.npc_vertices
+        self.npc_x = (npc[:, :, 0].min(axis=1), npc[:, :, 0].max(axis=1))
+        self.npc_y = (npc[:, :, 1].min(axis=1), npc[:, :, 1].max(axis=1))
+        # normals of two adjacent edges of the NPC rectangle, (steps, 2, 2)
+        edges = npc[:, 1:3] - npc[:, 0:2]
+        self.npc_axes = np.stack((-edges[..., 1], edges[..., 0]), axis=-1)
+        projections = np.einsum('sak,svk->sav', self.npc_axes, npc)
+        self.npc_proj = (projections.min(axis=-1), projections.max(axis=-1))
+
+    def ego_bounds(self, ve_range):
+        """
+        Return, per step, the x-range of the union of the ego footprints (outer), the x-range of
+        their intersection (core, empty if min > max) and the y-range of the footprints.
+        """
+        low = self.library.ego_vertices(ve_range[0])
+        high = self.library.ego_vertices(ve_range[1])
+        outer = (low[:, :, 0].min(axis=1) - self.margin, high[:, :, 0].max(axis=1) + self.margin)
+        core = (high[:, :, 0].min(axis=1) + self.margin, low[:, :, 0].max(axis=1) - self.margin)
+        return outer, core, (low[:, :, 1].min(axis=1), low[:, :, 1].max(axis=1))
+
+    def certify(self, dx_range, ve_range):
+        """
+        Return SAFE, COLLISION or UNDECIDED for the box dx_range x ve_range (ve in m/s).
+        """
+        a, b = dx_range
+        (outer_min, outer_max), (core_min, core_max), (y_min, y_max) = self.ego_bounds(ve_range)
+
+        # separating axis test between the ego box and the swept NPC polygon.
+        # The swept polygon is the convex hull of the NPC footprints translated by a and b,
+        # its edge normals are those of the NPC and the normal of the sweep direction (y).
+        separated = (self.npc_x[1] + b < outer_min) | (outer_max < self.npc_x[0] + a) | \
+                    (self.npc_y[1] < y_min) | (y_max < self.npc_y[0])
+        box = np.stack((np.stack((outer_min, y_min), axis=-1), np.stack((outer_max, y_min), axis=-1),
+                        np.stack((outer_max, y_max), axis=-1), np.stack((outer_min, y_max), axis=-1)), axis=1)
+        box_proj = np.einsum('sak,svk->sav', self.npc_axes, box)
+        sweep = np.stack((a * self.npc_axes[..., 0], b * self.npc_axes[..., 0]), axis=-1)
+        separated |= ((self.npc_proj[1] + sweep.max(axis=-1) < box_proj.min(axis=-1)) |
+                      (box_proj.max(axis=-1) < self.npc_proj[0] + sweep.min(axis=-1))).any(axis=-1)
+        if separated.all():
+            return SAFE
+
+        # the core of the NPC footprints is the intersection of the footprints translated by a and b
+        candidates = np.nonzero((core_min <= core_max) &
+                                (self.npc_x[0] + b <= core_max) & (core_min <= self.npc_x[1] + a) &
+                                (self.npc_y[0] <= y_max) & (y_min <= self.npc_y[1]))[0]
+        shift = np.array((b - a, 0.0))
+        for k in candidates:
+            npc = self.library.npc_vertices[k] + np.array((a, 0.0))
+            ego = np.array(((core_min[k], y_min[k]), (core_max[k], y_min[k]),
+                            (core_max[k], y_max[k]), (core_min[k], y_max[k])))
+            core = utils.clip_convex(utils.clip_convex(npc, npc + shift), ego)
+            if len(core):
+                return COLLISION
+        return UNDECIDED
+
+    def run(self, dx_range, ve_range, resolution, initial_cells=(8, 4)):
+        """
+        Certify the region dx_range x ve_range, splitting undecided boxes into four
+        until they are smaller than the resolution.
+        :param resolution: (dx0, ve), minimum size of the boxes
+        :return: list of ((a, b), (c, d), status)
+        """
+        dx_edges = np.linspace(*dx_range, initial_cells[0] + 1)
+        ve_edges = np.linspace(*ve_range, initial_cells[1] + 1)
+        pending = [((dx_edges[i], dx_edges[i + 1]), (ve_edges[j], ve_edges[j + 1]))
+                   for i in range(initial_cells[0]) for j in range(initial_cells[1])]
+        leaves = []
+        while pending:
+            dx_box, ve_box = pending.pop()
+            status = self.certify(dx_box, ve_box)
+            if status != UNDECIDED or (dx_box[1] - dx_box[0] <= resolution[0] and
+                                       ve_box[1] - ve_box[0] <= resolution[1]):
+                leaves.append((dx_box, ve_box, status))
+                continue
+            dx_mid, ve_mid = sum(dx_box) / 2, sum(ve_box) / 2
+            for dx_half in ((dx_box[0], dx_mid), (dx_mid, dx_box[1])):
+                for ve_half in ((ve_box[0], ve_mid), (ve_mid, ve_box[1])):
+                    pending.append((dx_half, ve_half))
+        return leaves
+
+def plot_boxes(ax, leaves, ve_scale=1.0, colors=('r', 'g', 'orange')):
+    """
+    Draw certified boxes: collision, safe and undecided.
+    :param ve_scale: factor applied to ve, e.g., 3.6 to plot km/h
+    """
+    from matplotlib.patches import Rectangle
+    status_colors = {COLLISION: colors[0], SAFE: colors[1], UNDECIDED: colors[2]}
+    for (a, b), (c, d), status in leaves:
+        ax.add_patch(Rectangle((a, c * ve_scale), b - a, (d - c) * ve_scale,
+                               facecolor=status_colors[status], edgecolor='white', linewidth=0.2))
+    ax.set_xlim(min(box[0][0] for box in leaves), max(box[0][1] for box in leaves))
+    ax.set_ylim(min(box[1][0] for box in leaves) * ve_scale, max(box[1][1] for box in leaves) * ve_scale)
+
+def save_boxes(path, leaves):
+    np.savez_compressed(path,
+                        boxes=np.array([(a, b, c, d) for (a, b), (c, d), _ in leaves]).reshape(-1, 4),
+                        status=np.array([status for _, _, status in leaves]))
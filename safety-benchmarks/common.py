@@ -1,5 +1,8 @@
+import copy
+import json
 import numpy as np
 import utils
+import profiling
 
 JERK_TIME = 0.6                 # time from press brake to when reach maximum deceleration
 MAX_DECELERATION = 0.774 * 9.81
@@ -8,6 +11,55 @@ AEB_MAX_DECELERATION = 0.85 * 9.81
 BRAKING_PEDAL_DELAY = 0.75      # braking delay
 RISK_EVAL_TIME = 0.4
 
+class DriverModel:
+    """
+    Reaction and braking parameters of the ego driver (and of its AEB), per simulation.
+    The defaults are the module-level constants used by the benchmarks.
+    """
+    PARAMETERS = ('jerk_time', 'max_deceleration', 'braking_pedal_delay', 'risk_eval_time',
+                  'AEB_jerk_time', 'AEB_max_deceleration')
+
+    def __init__(self, jerk_time=JERK_TIME, max_deceleration=MAX_DECELERATION,
+                 braking_pedal_delay=BRAKING_PEDAL_DELAY, risk_eval_time=RISK_EVAL_TIME,
+                 AEB_jerk_time=AEB_JERK_TIME, AEB_max_deceleration=AEB_MAX_DECELERATION):
+        """
+        :param jerk_time: time from pressing the brake to reaching the maximum deceleration, in s
+        :param max_deceleration: maximum deceleration of the human brake, in m/s^2
+        :param braking_pedal_delay: time from the brake decision to pressing the brake, in s
+        :param risk_eval_time: time from the risk detection to the brake decision, in s
+        :param AEB_jerk_time: time for the AEB to reach its maximum deceleration, in s
+        :param AEB_max_deceleration: maximum deceleration of the AEB, in m/s^2
+        """
+        self.jerk_time = jerk_time
+        self.max_deceleration = max_deceleration
+        self.braking_pedal_delay = braking_pedal_delay
+        self.risk_eval_time = risk_eval_time
+        self.AEB_jerk_time = AEB_jerk_time
+        self.AEB_max_deceleration = AEB_max_deceleration
+
+    def __repr__(self):
+        return 'DriverModel(' + ', '.join(f'{name}={getattr(self, name):g}' for name in self.PARAMETERS) + ')'
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.PARAMETERS}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a DriverModel from a dictionary of parameters; missing ones take their default.
+        """
+        return cls(**{name: data[name] for name in cls.PARAMETERS if name in data})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a DriverModel from a JSON file, either a dictionary of parameters or the output of
+        trace-analysis/calibration.py (parameters under `driver`).
+        """
+        with open(path) as f:
+            data = json.load(f)
+        return cls.from_dict(data.get('driver', data))
+
 class Vehicle:
     """
     Abstract class for vehicles.
@@ -29,6 +81,8 @@ class Vehicle:
 
     def get_vertices(self):
         """Return the 4 corner points of the vehicle in world coordinates."""
+        if profiling.active is not None:
+            profiling.active.count('vertices')
         length, width = self.size[0], self.size[1]
         dx = length / 2
         dy = width / 2
@@ -63,6 +117,8 @@ class Vehicle:
 
     @classmethod
     def is_collision(self, veh1, veh2):
+        if profiling.active is not None:
+            profiling.active.count('narrow_phase')
         return utils.is_collision(veh1.get_vertices(), veh2.get_vertices())
 
 class Ego(Vehicle):
@@ -82,34 +138,151 @@ class NPC(Vehicle):
         super().__init__(position, heading, velocity, size)
         self.speed = np.linalg.norm(self.velocity)
 
+class AEBPolicy:
+    """
+    Trigger policy of the autonomous emergency brake (AEB).
+    AEB is activated when the NPC footprint overlaps the lateral extent of the ego (i.e., is in its path),
+    is not behind the ego, and the time to collision or the gap to the ego front falls below a threshold.
+    """
+    def __init__(self, ttc_threshold=None, distance_threshold=None):
+        """
+        :param ttc_threshold: in seconds, None to ignore the time to collision
+        :param distance_threshold: in m, None to ignore the distance
+        """
+        self.ttc_threshold = ttc_threshold
+        self.distance_threshold = distance_threshold
+
+    def __repr__(self):
+        thresholds = []
+        if self.ttc_threshold is not None:
+            thresholds.append(f"TTC <= {self.ttc_threshold:g} s")
+        if self.distance_threshold is not None:
+            thresholds.append(f"gap <= {self.distance_threshold:g} m")
+        return f"AEB ({', '.join(thresholds)})"
+
+    def triggered(self, ego_vertices, ego_speed, npc_vertices, npc_vx):
+        """
+        Vectorized trigger test, for one or many (broadcast) pairs of states.
+        :param ego_vertices: array (..., 4, 2), the ego heading along +x
+        :param ego_speed: array (...)
+        :param npc_vertices: array (..., 4, 2)
+        :param npc_vx: array (...), NPC velocity along x
+        :return: boolean array (...)
+        """
+        ego_x, ego_y = ego_vertices[..., 0], ego_vertices[..., 1]
+        npc_x, npc_y = npc_vertices[..., 0], npc_vertices[..., 1]
+        in_path = (npc_y.min(axis=-1) <= ego_y.max(axis=-1)) & (ego_y.min(axis=-1) <= npc_y.max(axis=-1)) & \
+                  (npc_x.max(axis=-1) >= ego_x.min(axis=-1))
+        gap = np.maximum(npc_x.min(axis=-1) - ego_x.max(axis=-1), 0)
+        closing = np.asarray(ego_speed - npc_vx, dtype=float)
+        triggered = np.zeros(np.shape(in_path), dtype=bool)
+        if self.distance_threshold is not None:
+            triggered |= gap <= self.distance_threshold
+        if self.ttc_threshold is not None:
+            triggered |= gap <= self.ttc_threshold * np.maximum(closing, 0)
+        return in_path & triggered
+
+    def should_activate(self, sim):
+        return bool(self.triggered(sim.ego.get_vertices(), sim.ego.speed, sim.npc.get_vertices(),
+                                   sim.npc.speed * np.cos(sim.npc.heading)))
+
+def AEB_variants(ttc_thresholds=(), distance_thresholds=()):
+    """
+    Return the ego variants to benchmark: None (human brake only), then one AEBPolicy per threshold.
+    """
+    return [None] + [AEBPolicy(ttc_threshold=ttc) for ttc in ttc_thresholds] + \
+           [AEBPolicy(distance_threshold=distance) for distance in distance_thresholds]
+
 class Simulation:
     """
     Simulation abstract class.
     """
-    def __init__(self, ego: Ego, npc: NPC, sim_step=0.02):
+    def __init__(self, ego: Ego, npc: NPC, sim_step=0.02, AEB_policy=None, driver=None):
+        """
+        :param AEB_policy: AEBPolicy, or None if the ego has no AEB (only the human brake)
+        :param driver: DriverModel, default: the benchmark constants
+        """
         self.ego = ego
         self.npc = npc
         self.sim_step = sim_step
+        self.AEB_policy = AEB_policy
+        self.driver = driver if driver is not None else DriverModel()
         self.collision = False
+        # if False, vehicles pass through each other (used to record trajectories only)
+        self.detect_collisions = True
 
         self.time = 0
         self.brake_activated = False
-        # the moment when deciding to brake (brake is applied 0.75 seconds after this moment)
+        # the moment when deciding to brake (brake is applied braking_pedal_delay after this moment)
         self.brake_decision_time = -1
         self.AEB_activated = False
+        # the moment when AEB is activated (-1 if not activated)
+        self.AEB_activation_time = -1
         # delta deceleration of human brake between two consecutive steps
-        self.delta_brake_acc = MAX_DECELERATION / JERK_TIME * sim_step
+        self.delta_brake_acc = self.driver.max_deceleration / self.driver.jerk_time * sim_step
         # delta deceleration of AEB brake between two consecutive steps
         self.delta_AEB_acc = 0
 
+        # initial (position, heading, speed) of both vehicles, used by the closed-form evaluators
+        self.ego_initial = (self.ego.position.copy(), self.ego.heading, self.ego.speed)
+        self.npc_initial = (self.npc.position.copy(), self.npc.heading, self.npc.speed)
+
+        # broad phase: radius of a circle around each vehicle position containing its footprint.
+        # Positions move at most speed * sim_step per step, so do the x-intervals of these circles.
+        self.broad_phase = True
+        self.ego_radius = np.max(np.linalg.norm(self.ego.get_vertices() - self.ego.position, axis=1))
+        self.npc_radius = np.max(np.linalg.norm(self.npc.get_vertices() - self.npc.position, axis=1))
+        # number of upcoming steps in which the footprints cannot overlap
+        self.steps_to_overlap = 0
+
     def step(self):
-        if Vehicle.is_collision(self.ego, self.npc):
+        if profiling.active is not None:
+            profiling.active.count('steps')
+        if self.detect_collisions and self.may_collide() and Vehicle.is_collision(self.ego, self.npc):
             self.collision = True
             return
         self.ego_step()
         self.npc_step()
         self.time += self.sim_step
 
+    def should_activate_AEB(self):
+        if self.AEB_policy is None:
+            return False
+        return self.AEB_policy.should_activate(self)
+
+    def x_gap(self):
+        """
+        Distance along the road axis (x) between conservative bounds of the two footprints,
+        negative if the bounds overlap.
+        """
+        ego_x, npc_x = self.ego.position[0], self.npc.position[0]
+        return max(npc_x - self.npc_radius - (ego_x + self.ego_radius),
+                   ego_x - self.ego_radius - (npc_x + self.npc_radius))
+
+    def may_collide(self):
+        """
+        Broad phase of the collision check: return False if the footprints cannot overlap
+        at the current step, so that the exact test can be skipped.
+        When they are apart, also predict how many more steps they stay apart,
+        from the closing speed bound ego speed + NPC speed (the ego never accelerates),
+        and skip the broad phase itself during these steps.
+        """
+        if not self.broad_phase:
+            return True
+        if self.steps_to_overlap > 0:
+            self.steps_to_overlap -= 1
+            if profiling.active is not None:
+                profiling.active.count('broad_skipped')
+            return False
+        if profiling.active is not None:
+            profiling.active.count('broad_phase')
+        gap = self.x_gap()
+        if gap <= 0:
+            return True
+        closing = (self.ego.speed + self.npc.speed) * self.sim_step
+        self.steps_to_overlap = int(np.ceil(gap / closing)) - 1 if closing > 0 else np.inf
+        return False
+
     def ego_step(self):
         """
         The evolution of the ego vehicle takes place.
@@ -124,19 +297,21 @@ class Simulation:
         # if reach 0.75 seconds of delay
         if not self.brake_activated and \
                 self.brake_decision_time >= 0 and \
-                self.time - self.brake_decision_time >= BRAKING_PEDAL_DELAY:
+                self.time - self.brake_decision_time >= self.driver.braking_pedal_delay:
             self.brake_activated = True
 
         # update deceleration
+        driver = self.driver
         # if brake was applied, but AEB is not yet activated
         if self.brake_activated and not self.AEB_activated:
-            if self.ego.decel < MAX_DECELERATION:
-                self.ego.decel = min(self.ego.decel + self.delta_brake_acc, MAX_DECELERATION)
+            if self.ego.decel < driver.max_deceleration:
+                self.ego.decel = min(self.ego.decel + self.delta_brake_acc, driver.max_deceleration)
         elif self.AEB_activated:
             if self.delta_AEB_acc == 0:
-                self.delta_AEB_acc = (AEB_MAX_DECELERATION - self.ego.decel) / AEB_JERK_TIME * self.sim_step
-            if self.ego.decel < AEB_MAX_DECELERATION:
-                self.ego.decel = min(self.ego.decel + self.delta_AEB_acc, AEB_MAX_DECELERATION)
+                self.delta_AEB_acc = (driver.AEB_max_deceleration - self.ego.decel) / driver.AEB_jerk_time \
+                                     * self.sim_step
+            if self.ego.decel < driver.AEB_max_deceleration:
+                self.ego.decel = min(self.ego.decel + self.delta_AEB_acc, driver.AEB_max_deceleration)
 
     def npc_step(self):
         """
@@ -146,6 +321,97 @@ class Simulation:
         if self.npc.speed <= 0:
             return
 
+    def ego_jerk_segments(self, brake_decision_time=None, AEB_activation_time=None):
+        """
+        Deceleration profile of the ego as a list of (start time, jerk), in time order.
+        The deceleration is 0 until braking_pedal_delay after the brake decision, then rises
+        to max_deceleration in jerk_time. From the AEB activation, it rises from its current
+        value to AEB_max_deceleration in AEB_jerk_time (parameters of self.driver).
+        :param brake_decision_time: defaults to self.brake_decision_time, negative if no braking
+        :param AEB_activation_time: defaults to self.AEB_activation_time, negative if no AEB
+        """
+        if brake_decision_time is None:
+            brake_decision_time = self.brake_decision_time
+        if AEB_activation_time is None:
+            AEB_activation_time = self.AEB_activation_time
+        driver = self.driver
+        brake_time = brake_decision_time + driver.braking_pedal_delay if brake_decision_time >= 0 else np.inf
+        AEB_time = AEB_activation_time if AEB_activation_time >= 0 else np.inf
+        brake_jerk = driver.max_deceleration / driver.jerk_time
+
+        segments = [(0.0, 0.0)]
+        if brake_time < AEB_time:
+            segments.append((brake_time, brake_jerk))
+            segments.append((min(brake_time + driver.jerk_time, AEB_time), 0.0))
+        if AEB_time < np.inf:
+            decel = float(np.clip((AEB_time - brake_time) * brake_jerk, 0, driver.max_deceleration))
+            segments.append((AEB_time, (driver.AEB_max_deceleration - decel) / driver.AEB_jerk_time))
+            segments.append((AEB_time + driver.AEB_jerk_time, 0.0))
+        return segments
+
+    def ego_state_at(self, t, brake_decision_time=None, AEB_activation_time=None):
+        """
+        Exact ego state at time t, without stepping the simulation (see ego_jerk_segments).
+        Unlike ego_step, the result does not depend on sim_step.
+        :return: (position, heading, speed, deceleration)
+        """
+        position, heading, speed = self.ego_initial
+        distance, speed, decel = integrate_jerk_profile(
+            speed, self.ego_jerk_segments(brake_decision_time, AEB_activation_time), t)
+        position = position + distance * np.array((np.cos(heading), np.sin(heading)))
+        return position, heading, speed, decel
+
+    def npc_state_at(self, t):
+        """
+        Exact NPC state at time t, without stepping the simulation.
+        This depends on scenarios, so here is only abstract implementation.
+        :return: (position, heading, speed)
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no closed-form NPC motion")
+
+    def vehicles_at(self, t, brake_decision_time=None, AEB_activation_time=None):
+        """
+        Return copies of the ego and the NPC placed at their exact states at time t.
+        """
+        ego = copy.copy(self.ego)
+        ego.position, ego.heading, ego.speed, ego.decel = \
+            self.ego_state_at(t, brake_decision_time, AEB_activation_time)
+        npc = copy.copy(self.npc)
+        npc.position, npc.heading, npc.speed = self.npc_state_at(t)
+        return ego, npc
+
+    def collision_at(self, t, brake_decision_time=None, AEB_activation_time=None):
+        return Vehicle.is_collision(*self.vehicles_at(t, brake_decision_time, AEB_activation_time))
+
+def integrate_jerk_profile(speed, segments, t):
+    """
+    Closed-form motion of a vehicle braking with a piecewise-constant jerk.
+    The vehicle stops (and stays still) when its speed reaches 0.
+    :param speed: initial speed
+    :param segments: list of (start time, jerk of the deceleration), in time order, starting at 0
+    :param t: time
+    :return: (travelled distance, speed, deceleration) at time t
+    """
+    distance, decel = 0.0, 0.0
+    for i, (start, jerk) in enumerate(segments):
+        if start >= t:
+            break
+        end = segments[i + 1][0] if i + 1 < len(segments) else np.inf
+        h = min(end, t) - start
+        end_speed = speed - decel * h - jerk * h ** 2 / 2
+        if end_speed <= 0:
+            # time to stop, root of speed - decel * h - jerk * h^2 / 2
+            if jerk > 0:
+                h = (np.sqrt(decel ** 2 + 2 * jerk * speed) - decel) / jerk
+            elif decel > 0:
+                h = speed / decel
+            distance += speed * h - decel * h ** 2 / 2 - jerk * h ** 3 / 6
+            return distance, 0.0, decel + jerk * h
+        distance += speed * h - decel * h ** 2 / 2 - jerk * h ** 3 / 6
+        speed = end_speed
+        decel += jerk * h
+    return distance, speed, decel
+
 # There are two environment configurations: CARLA and AWSIM-Labs
 # Depending on which environment is used, the parameters, e.g., lane width, median strip width, are set accordingly.
 # By default, we use AWSIM-Labs configuration.
@@ -172,4 +438,9 @@ awsim_env_config = {
     'ego_width': 2.2,
     'npc_length': 4.0,
     'npc_width': 1.9
-}
\ No newline at end of file
+}
+env_configs = {
+    'carla': carla_env_config,
+    'carla_town07': carla_town07_env_config,
+    'awsim': awsim_env_config
+}
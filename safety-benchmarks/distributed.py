@@ -0,0 +1,197 @@
+"""
+Distribution of a chunked sweep (see sweep.py) over several processes and hosts.
+
+The coordinator owns the sweep folder and serves its unfinished chunks as shards over TCP,
+using multiprocessing.connection (authenticated, no external service needed).
+Messages are pickles, which run code when loaded: anyone holding the key can run code on the coordinator
+and on the workers, so only use it on a trusted network, with a secret key.
+A shard descriptor holds the scenario, the axes (parameter values and env names) and
+the range of outer combinations to compute. Workers pull shards, run the simulations and push back
+the compact uint8/float32 result arrays. A shard is leased to one worker at a time: if its results
+are not back before the lease timeout (e.g., the worker was killed), it is leased again to another worker.
+"""
+import argparse
+import multiprocessing
+import secrets
+import socket
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+import sweep
+
+# seconds a worker waits when all unfinished shards are leased to other workers
+RETRY_DELAY = 1.0
+
+class Coordinator:
+    def __init__(self, chunked_sweep, scenario, lease_timeout=600):
+        """
+        :param chunked_sweep: sweep.ChunkedSweep in which results are written
+        :param scenario: `uturn` or `swerve`, tells workers which evaluation function to use
+        :param lease_timeout: seconds after which a shard leased to a worker is served again
+        """
+        self.sweep = chunked_sweep
+        self.scenario = scenario
+        self.lease_timeout = lease_timeout
+        # chunk -> (worker name, deadline)
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        if not self.sweep.pending_chunks():
+            self.finished.set()
+
+    def next_shard(self, worker):
+        """
+        Return a shard descriptor for the worker, a wait message, or a done message.
+        """
+        with self.lock:
+            pending = self.sweep.pending_chunks()
+            if not pending:
+                return {'type': 'done'}
+            now = time.time()
+            for chunk in pending:
+                if chunk in self.leases and self.leases[chunk][1] > now:
+                    continue
+                if chunk in self.leases:
+                    print(f"Lease of chunk {chunk + 1} by {self.leases[chunk][0]} expired")
+                self.leases[chunk] = (worker, now + self.lease_timeout)
+                flat = self.sweep.chunk_range(chunk)
+                return {'type': 'shard', 'chunk': chunk, 'scenario': self.scenario,
+                        'axes': self.sweep.axes, 'flat_range': (flat.start, flat.stop)}
+            return {'type': 'wait', 'seconds': RETRY_DELAY}
+
+    def submit(self, worker, chunk, verdicts, metrics):
+        with self.lock:
+            # results of an expired lease may come after those of the new lease
+            if chunk in self.sweep.done:
+                return
+            self.sweep.write_chunk(chunk, verdicts, metrics)
+            self.leases.pop(chunk, None)
+            print(f"Done chunk {chunk + 1}/{self.sweep.chunk_count} ({worker}), "
+                  f"{len(self.sweep.pending_chunks())} left")
+            if not self.sweep.pending_chunks():
+                self.finished.set()
+
+    def handle(self, conn):
+        worker = '?'
+        try:
+            while True:
+                message = conn.recv()
+                worker = message.get('worker', worker)
+                if message['type'] == 'request':
+                    conn.send(self.next_shard(worker))
+                elif message['type'] == 'result':
+                    self.submit(worker, message['chunk'], message['verdicts'], message['metrics'])
+                    conn.send({'type': 'ack'})
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def serve(self, address, authkey):
+        """
+        Serve shards until all chunks are finished.
+        """
+        listener = Listener(address, authkey=authkey)
+        print(f"Serving {len(self.sweep.pending_chunks())} shards on {address[0]}:{listener.address[1]}")
+
+        def accept():
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, multiprocessing.AuthenticationError):
+                    if self.finished.is_set():
+                        return
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+        threading.Thread(target=accept, daemon=True).start()
+        self.finished.wait()
+        listener.close()
+
+def work(address, authkey, name=None):
+    """
+    Pull shards from the coordinator and compute them until the sweep is finished.
+    """
+    name = name or f"{socket.gethostname()}:{multiprocessing.current_process().pid}"
+    try:
+        conn = Client(address, authkey=authkey)
+    except ConnectionRefusedError:
+        print(f"[{name}] no coordinator at {address[0]}:{address[1]}")
+        return
+    with conn:
+        while True:
+            try:
+                conn.send({'type': 'request', 'worker': name})
+                shard = conn.recv()
+            except (EOFError, OSError):
+                # the coordinator stopped: the sweep is finished
+                return
+            if shard['type'] == 'done':
+                return
+            if shard['type'] == 'wait':
+                time.sleep(shard['seconds'])
+                continue
+            verdicts, metrics = sweep.compute_chunk(shard['axes'], range(*shard['flat_range']),
+                                                    sweep.EVALUATORS[shard['scenario']])
+            try:
+                conn.send({'type': 'result', 'worker': name, 'chunk': shard['chunk'],
+                           'verdicts': verdicts, 'metrics': metrics})
+                conn.recv()
+            except (EOFError, OSError):
+                return
+            print(f"[{name}] done chunk {shard['chunk'] + 1}")
+
+def _work_process(host, port, authkey, index):
+    work((host, port), authkey, f"{socket.gethostname()}-{index}")
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description='Distribute a chunked benchmark sweep (see sweep.py) '
+                                                 'over worker processes on any number of hosts.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='run the coordinator, which owns the output folder',
+                                  epilog='Example: python distributed.py serve --port 6000 -- '
+                                         'swerve --vo 7:20:0.5 -o sweeps/swerve')
+    serve.add_argument('--host', default='127.0.0.1',
+                       help='address to listen on, e.g., 0.0.0.0 for all interfaces (default: 127.0.0.1)')
+    serve.add_argument('--authkey', help='shared secret key authenticating the workers (default: random, printed)')
+    serve.add_argument('--lease', type=float, default=600,
+                       help='seconds after which an unfinished shard is given to another worker (default: 600)')
+    serve.add_argument('sweep_args', nargs=argparse.REMAINDER,
+                       help='sweep arguments, as for sweep.py (scenario, axes, -o, --chunk-size)')
+
+    worker = subparsers.add_parser('work', help='run workers that pull shards from a coordinator')
+    worker.add_argument('--host', default='localhost', help='coordinator host (default: localhost)')
+    worker.add_argument('--authkey', required=True, help='secret key printed by the coordinator')
+    worker.add_argument('-n', '--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes on this host (default: number of CPUs)')
+
+    for subparser in (serve, worker):
+        subparser.add_argument('--port', type=int, default=6000, help='coordinator port (default: 6000)')
+    return parser
+
+if __name__ == '__main__':
+    cli_args = cli_parser().parse_args()
+    if cli_args.command == 'serve' and cli_args.authkey is None:
+        cli_args.authkey = secrets.token_hex(16)
+        print(f"Authentication key: {cli_args.authkey}")
+    authkey = cli_args.authkey.encode()
+    if cli_args.command == 'serve':
+        sweep_args = cli_args.sweep_args[1:] if cli_args.sweep_args[:1] == ['--'] else cli_args.sweep_args
+        sweep_cli_args = sweep.cli_parser().parse_args(sweep_args)
+        axes, _ = sweep.sweep_axes(sweep_cli_args)
+        chunked_sweep = sweep.ChunkedSweep(sweep_cli_args.output, axes, sweep_cli_args.chunk_size)
+        print(f"{int(np.prod(chunked_sweep.shape))} cells, {chunked_sweep.chunk_count} chunks, "
+              f"{len(chunked_sweep.done)} already done")
+        coordinator = Coordinator(chunked_sweep, sweep_cli_args.command, cli_args.lease)
+        coordinator.serve((cli_args.host, cli_args.port), authkey)
+    else:
+        processes = [multiprocessing.Process(target=_work_process,
+                                             args=(cli_args.host, cli_args.port, authkey, i))
+                     for i in range(cli_args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -0,0 +1,189 @@
+"""
+Opt-in instrumentation: event counters and phase timers.
+This is the only implementation: trace-analysis/profiling.py loads this file, so both folders
+(and a process importing both, e.g., perf-benchmarks/bench.py) share one module and one active profile.
+
+Nothing is recorded unless a profile is active, either in code:
+    with profiling.profile() as prof:
+        single_sim_exec(...)
+    print(prof.report())
+or for a whole run, by setting the PROFILE environment variable to the output path
+of a Chrome trace (or to `-` for the report only):
+    PROFILE=/tmp/uturn.json python -m uturn.uturn -vo 10
+    PROFILE=/tmp/analysis.json python analysis.py ../Autoware-baseline-results/u-turn/data/adjacent-lane/run1/
+The report is printed at exit; set PROFILE_MEMORY=1 to also measure the peak memory.
+The trace opens in chrome://tracing or https://ui.perfetto.dev: every phase is a slice
+whose arguments hold the counter increments during the phase, so the cost can be attributed
+to the cells of a sweep (phases `single_sim_exec` and `sweep_cell`), or to the files and to
+the phases of analysis.process_a_file (`load`, `start_moment`, `collision`, `ttc`, `dx0`).
+In worker processes, the process id is appended to the output path.
+
+Counters used by safety-benchmarks:
+    steps           Simulation.step calls
+    broad_phase     broad phase tests (Simulation.may_collide computing the gap)
+    broad_skipped   steps skipped by the broad phase without any test
+    narrow_phase    exact collision tests (Vehicle.is_collision)
+    vertices        vehicle footprint computations (Vehicle.get_vertices)
+    batch_pairs     footprint pairs tested by the trajectory library (utils.batch_is_collision)
+Counters used by trace-analysis:
+    entries         trace entries scanned by is_collision and min_ttc
+    broad_phase     vehicles kept by the sort-and-sweep broad phase of is_collision and min_ttc
+    narrow_phase    exact collision tests (Vehicle.is_collision)
+    vertices        vehicle footprint computations (Vehicle.get_vertices)
+    ttc_substeps    constant-velocity extrapolation steps of min_ttc
+"""
+import json
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+# the active Profile, None when profiling is off
+active = None
+
+class Profile:
+    def __init__(self, memory=False):
+        """
+        :param memory: also trace Python allocations with tracemalloc for the peak memory (slower)
+        """
+        self.memory = memory
+        self.counters = {}
+        # phase name -> [calls, total seconds]
+        self.timers = {}
+        # Chrome trace events
+        self.events = []
+        self.start_time = None
+        self.elapsed = 0.0
+        self.allocated_blocks = 0
+        self.peak_memory = None
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def phase(self, name, **args):
+        return _Phase(self, name, args)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._blocks = sys.getallocatedblocks()
+        if self.memory:
+            tracemalloc.start()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.start_time
+        self.allocated_blocks = sys.getallocatedblocks() - self._blocks
+        if self.memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def report(self):
+        lines = [f"Profile: {self.elapsed:.3f} s, {self.allocated_blocks:+d} allocated blocks"
+                 + (f", peak memory {self.peak_memory / 2 ** 20:.1f} MiB" if self.peak_memory is not None else "")]
+        if self.timers:
+            lines.append(f"  {'phase':30s} {'calls':>10s} {'total (s)':>12s} {'mean (ms)':>12s}")
+            for name, (calls, total) in sorted(self.timers.items(), key=lambda item: -item[1][1]):
+                lines.append(f"  {name:30s} {calls:10d} {total:12.4f} {1000 * total / calls:12.4f}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"  {name:30s} {value:10d}")
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """
+        Return the events in the Chrome trace event format, with the final counter values.
+        """
+        end = {'name': 'counters', 'ph': 'C', 'ts': self.elapsed * 1e6, 'pid': os.getpid(), 'tid': 0,
+               'args': dict(self.counters)}
+        return {'traceEvents': self.events + [end], 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+class _Phase:
+    """
+    Time a block of code and record it as a slice of the trace.
+    """
+    def __init__(self, prof, name, args):
+        self.prof = prof
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.counters = dict(self.prof.counters)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        duration = end - self.start
+        timer = self.prof.timers.setdefault(self.name, [0, 0.0])
+        timer[0] += 1
+        timer[1] += duration
+        args = {name: value - self.counters.get(name, 0) for name, value in self.prof.counters.items()
+                if value != self.counters.get(name, 0)}
+        args.update({key: value if isinstance(value, (int, str, bool)) else float(value)
+                     for key, value in self.args.items()})
+        self.prof.events.append({'name': self.name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                                 'ts': (self.start - self.prof.start_time) * 1e6, 'dur': duration * 1e6,
+                                 'args': args})
+        return False
+
+class profile:
+    """
+    Context manager activating a new Profile; profiles do not nest.
+    """
+    def __init__(self, memory=False):
+        self.prof = Profile(memory)
+
+    def __enter__(self):
+        global active
+        if active is not None:
+            raise RuntimeError("A profile is already active")
+        self.prof.start()
+        active = self.prof
+        return self.prof
+
+    def __exit__(self, *exc):
+        global active
+        active = None
+        self.prof.stop()
+        return False
+
+def count(name, n=1):
+    if active is not None:
+        active.count(name, n)
+
+def phase(name, **args):
+    """
+    Context manager timing a phase of the active profile; does nothing when profiling is off.
+    """
+    if active is None:
+        return nullcontext()
+    return active.phase(name, **args)
+
+def _finish(context, path):
+    context.__exit__(None, None, None)
+    print(context.prof.report(), file=sys.stderr)
+    if path != '-':
+        if multiprocessing.current_process().name != 'MainProcess':
+            path = f"{path}.{os.getpid()}"
+        context.prof.save(path)
+        print(f"Profile trace written to {path}", file=sys.stderr)
+
+def _start_from_environment():
+    context = profile(memory=os.environ.get('PROFILE_MEMORY') == '1')
+    context.__enter__()
+    # finalizers also run at the normal exit of multiprocessing workers, unlike atexit
+    util.Finalize(None, _finish, args=(context, os.environ['PROFILE']), exitpriority=0)
+
+def _restart_after_fork(_):
+    global active
+    active = None
+    _start_from_environment()
+
+if os.environ.get('PROFILE'):
+    from multiprocessing import util
+    _start_from_environment()
+    util.register_after_fork(_start_from_environment, _restart_after_fork)
@@ -0,0 +1,284 @@
+"""
+Monte Carlo sensitivity of the benchmark maps to the driver model and scenario constants.
+
+Parameter sets are drawn by quasi-random sampling (scrambled Sobol sequence or Latin hypercube)
+over uniform ranges, e.g., braking pedal delay in [0.5, 1.0] s, and each set is evaluated on the
+whole benchmark grid with a trajectory library (verdicts identical to single_sim_exec).
+Sets are evaluated in batches by a process pool.
+
+Results:
+- the probabilistic avoidability map, P(collision) per cell, whose 5%-95% band shows how
+  robust the benchmark boundary is;
+- first-order sensitivity indices S_i = Var(E[Y | X_i]) / Var(Y) of each parameter X_i, for Y the
+  collision indicator of each cell and for Y the fraction of colliding cells of the map.
+  They are estimated from the same samples by binning X_i (sqrt(n) bins), so no Saltelli design is needed;
+  the estimate is biased upwards by about (bins - 1) / n, and is noisy for small n.
+"""
+import argparse
+import multiprocessing
+
+import numpy as np
+from matplotlib import pyplot as plt
+from common import DriverModel, env_configs
+from utils import value_range
+
+DRIVER_RANGES = {
+    'jerk_time': (0.4, 0.8),
+    'max_deceleration': (0.6 * 9.81, 0.9 * 9.81),
+    'braking_pedal_delay': (0.5, 1.0),
+    'risk_eval_time': (0.2, 0.6),
+}
+UTURN_RANGES = {
+    'wheelbase': (2.3, 3.0),
+    'turning_wheel_angle': (np.pi / 7, np.pi / 5),
+}
+SWERVE_RANGES = {
+    'ny': (1.5, 2.1),
+    'swerve_distance': (1.0, 3.0),
+    'wheelbase': (2.3, 3.0),
+}
+
+# (degree s, coefficients a, initial direction numbers m) of the Sobol sequence for
+# dimensions 2, 3, ..., from the primitive polynomials of Joe and Kuo (new-joe-kuo-6.21201)
+SOBOL_DIRECTIONS = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+]
+
+def sobol(n, d, rng, bits=30):
+    """
+    Return n points of the d-dimensional Sobol sequence in [0, 1)^d, scrambled by a random
+    digital shift (which keeps the stratification of the sequence). Use n a power of 2.
+    """
+    if d > len(SOBOL_DIRECTIONS) + 1:
+        raise ValueError(f"Sobol sampling supports up to {len(SOBOL_DIRECTIONS) + 1} parameters")
+    directions = np.zeros((d, bits), dtype=np.int64)
+    directions[0] = 1 << (bits - 1 - np.arange(bits))
+    for j in range(1, d):
+        s, a, m = SOBOL_DIRECTIONS[j - 1]
+        for k in range(bits):
+            if k < s:
+                directions[j, k] = m[k] << (bits - 1 - k)
+            else:
+                value = directions[j, k - s] ^ (directions[j, k - s] >> s)
+                for l in range(1, s):
+                    if (a >> (s - 1 - l)) & 1:
+                        value ^= directions[j, k - l]
+                directions[j, k] = value
+
+    points = np.zeros((n, d), dtype=np.int64)
+    for i in range(1, n):
+        # Gray code order: flip the direction number of the lowest zero bit of i - 1
+        c = (i & -i).bit_length() - 1
+        points[i] = points[i - 1] ^ directions[:, c]
+    shift = rng.integers(0, 1 << bits, size=d)
+    return (points ^ shift) / float(1 << bits)
+
+def latin_hypercube(n, d, rng):
+    """
+    Return n points in [0, 1)^d with exactly one point in each of the n slices of every axis.
+    """
+    strata = np.array([rng.permutation(n) for _ in range(d)]).T
+    return (strata + rng.random((n, d))) / n
+
+SAMPLERS = {
+    'sobol': sobol,
+    'lhs': latin_hypercube
+}
+
+def sample_parameters(ranges, n, method='sobol', seed=0):
+    """
+    :param ranges: dict name -> (low, high)
+    :return: array (n, len(ranges)), columns in the order of ranges
+    """
+    unit = SAMPLERS[method](n, len(ranges), np.random.default_rng(seed))
+    low, high = np.array(list(ranges.values()), dtype=float).T
+    return low + unit * (high - low)
+
+def _driver(params):
+    return DriverModel(**{name: params[name] for name in DriverModel.PARAMETERS if name in params})
+
+def uturn_collisions(params, config):
+    """
+    Collision map (len(ve_values), len(dx_values)) of one parameter set.
+    """
+    from uturn.uturn import trajectory_library, TURNING_WHEEL_ANGLE, WHEEL_BASE
+    lib = trajectory_library(config['vo'] / 3.6, params.get('turning_wheel_angle', TURNING_WHEEL_ANGLE),
+                             params.get('wheelbase', WHEEL_BASE), config['lane'] == 'rightmost',
+                             env_configs[config['env']], _driver(params))
+    return np.array([~lib.verdicts(config['dx_values'], ve / 3.6) for ve in config['y_values']])
+
+def swerve_collisions(params, config):
+    """
+    Collision map (len(vy_values), len(dx_values)) of one parameter set.
+    """
+    from swerve.swerve import trajectory_library, NY, SWERVE_DISTANCE, WHEEL_BASE
+    driver = _driver(params)
+    return np.array([~trajectory_library(config['vo'] / 3.6, vy, params.get('ny', NY),
+                                         params.get('swerve_distance', SWERVE_DISTANCE),
+                                         params.get('wheelbase', WHEEL_BASE), env_configs[config['env']],
+                                         driver).verdicts(config['dx_values'], config['ve'] / 3.6)
+                     for vy in config['y_values']])
+
+EVALUATORS = {
+    'uturn': uturn_collisions,
+    'swerve': swerve_collisions
+}
+
+def _evaluate(task):
+    scenario, params, config = task
+    return EVALUATORS[scenario](params, config)
+
+def collision_maps(scenario, names, samples, config, processes=None, batch_size=4):
+    """
+    Evaluate every parameter set on the grid of config.
+    :param names: parameter names, in the order of the sample columns
+    :param samples: array (n, len(names))
+    :param config: dict with vo, env, dx_values, y_values, and lane (U-turn) or ve (swerve), speeds in km/h
+    :param batch_size: parameter sets sent to a worker at once
+    :return: boolean array (n, len(y_values), len(dx_values)), True for collision
+    """
+    tasks = [(scenario, dict(zip(names, map(float, row))), config) for row in samples]
+    maps = []
+    with multiprocessing.Pool(processes) as pool:
+        for i, collisions in enumerate(pool.imap(_evaluate, tasks, chunksize=batch_size)):
+            maps.append(collisions)
+            if (i + 1) % max(1, len(tasks) // 10) == 0:
+                print(f"Done {i + 1}/{len(tasks)} parameter sets")
+    return np.array(maps)
+
+def first_order_indices(samples, outputs, bins=None):
+    """
+    First-order sensitivity indices by binning each input: Var(E[Y | X_i]) / Var(Y).
+    :param samples: array (n, d) of inputs
+    :param outputs: array (n, ...) of outputs
+    :return: array (d, ...), NaN where the output does not vary
+    """
+    n = len(samples)
+    bins = bins or max(2, int(round(np.sqrt(n))))
+    outputs = np.asarray(outputs, dtype=float)
+    mean = outputs.mean(axis=0)
+    variance = outputs.var(axis=0)
+    indices = np.empty((samples.shape[1],) + outputs.shape[1:])
+    for i in range(samples.shape[1]):
+        groups = np.array_split(np.argsort(samples[:, i], kind='stable'), bins)
+        explained = sum(len(group) * (outputs[group].mean(axis=0) - mean) ** 2 for group in groups) / n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            indices[i] = np.where(variance > 0, explained / variance, np.nan)
+    return indices
+
+def plot_probability(config, probability, nominal, title):
+    """
+    Draw P(collision) per cell, the 5%, 50% and 95% contours and the nominal boundary.
+    """
+    dx, y = np.meshgrid(config['dx_values'], config['y_values'])
+    plt.figure(dpi=200, figsize=(10, 4.0))
+    mesh = plt.pcolormesh(dx, y, probability, cmap='RdYlGn_r', vmin=0, vmax=1, shading='nearest')
+    plt.colorbar(mesh, label='P(collision)')
+    if probability.min() < probability.max():
+        contours = plt.contour(dx, y, probability, levels=[0.05, 0.5, 0.95], colors='black',
+                               linewidths=[0.6, 1.2, 0.6], linestyles=['dashed', 'solid', 'dashed'])
+        plt.clabel(contours, fmt='%.2f', fontsize=6)
+    plt.contour(dx, y, nominal.astype(float), levels=[0.5], colors='blue', linewidths=1)
+    plt.xlabel('Longitudinal distance (dx0)')
+    plt.ylabel(config['y_label'])
+    plt.title(title + ' (blue: nominal boundary)')
+    plt.show()
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description='Monte Carlo sensitivity of the safety reference benchmarks '
+                                                 'to the driver model and scenario constants.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    uturn = subparsers.add_parser('uturn', help='U-turn map over (dx0, ve)')
+    uturn.add_argument('-vo', type=float, default=10, help='NPC Speed in km/h (default: 10)')
+    uturn.add_argument('-l', '--lane', default='rightmost', choices=['rightmost', 'adjacent'])
+    uturn.add_argument('--ve', type=float, nargs=3, default=[14, 50, 2], metavar=('MIN', 'MAX', 'STEP'),
+                       help='Ego speeds in km/h (default: 14 50 2)')
+    uturn.add_argument('--dx', type=float, nargs=3, default=[9, 50, 1], metavar=('MIN', 'MAX', 'STEP'),
+                       help='Longitudinal distances in m (default: 9 50 1)')
+
+    swerve = subparsers.add_parser('swerve', help='swerve map over (dx0, vy)')
+    swerve.add_argument('-ve', type=float, default=20, help='AV Speed in km/h (default: 20)')
+    swerve.add_argument('-vo', type=float, default=10, help='NPC Speed in km/h (default: 10)')
+    swerve.add_argument('--vy', type=float, nargs=3, default=[0.6, 1.6, 0.1], metavar=('MIN', 'MAX', 'STEP'),
+                        help='NPC lateral velocities in m/s (default: 0.6 1.6 0.1)')
+    swerve.add_argument('--dx', type=float, nargs=3, default=[10, 55, 1], metavar=('MIN', 'MAX', 'STEP'),
+                        help='Longitudinal distances in m (default: 10 55 1)')
+
+    for subparser in (uturn, swerve):
+        subparser.add_argument('--env', default='awsim', choices=list(env_configs),
+                               help='environment configuration (default: awsim)')
+        subparser.add_argument('-n', '--samples', type=int, default=256,
+                               help='number of parameter sets (default: 256)')
+        subparser.add_argument('--method', default='sobol', choices=list(SAMPLERS),
+                               help='sampling method (default: sobol)')
+        subparser.add_argument('--param', nargs=3, action='append', default=[], metavar=('NAME', 'LOW', 'HIGH'),
+                               help='vary a parameter over [LOW, HIGH] instead of its default range; '
+                                    'AEB_jerk_time and AEB_max_deceleration are fixed unless given')
+        subparser.add_argument('--fix', nargs='+', default=[], metavar='NAME',
+                               help='parameters kept at their nominal value')
+        subparser.add_argument('--seed', type=int, default=0)
+        subparser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count(),
+                               help='worker processes (default: number of CPUs)')
+        subparser.add_argument('--batch-size', type=int, default=4,
+                               help='parameter sets per batch sent to a worker (default: 4)')
+        subparser.add_argument('-o', '--output', help='npz file to save the samples, maps and indices to')
+    return parser
+
+if __name__ == '__main__':
+    cli_args = cli_parser().parse_args()
+    scenario = cli_args.command
+    ranges = dict(DRIVER_RANGES, **(UTURN_RANGES if scenario == 'uturn' else SWERVE_RANGES))
+    for name, low, high in cli_args.param:
+        if name not in ranges and name not in DriverModel.PARAMETERS:
+            raise SystemExit(f"Unknown parameter {name}")
+        ranges[name] = (float(low), float(high))
+    for name in cli_args.fix:
+        ranges.pop(name, None)
+    names = list(ranges)
+
+    config = {'vo': cli_args.vo, 'env': cli_args.env, 'dx_values': value_range(*cli_args.dx).tolist()}
+    if scenario == 'uturn':
+        config.update(lane=cli_args.lane, y_values=value_range(*cli_args.ve).tolist(), y_label='Ego speed (ve)')
+        title = f'Ego: {cli_args.lane} lane, vo = {cli_args.vo:g}'
+    else:
+        config.update(ve=cli_args.ve, y_values=value_range(*cli_args.vy).tolist(), y_label='Lateral velocity (vy)')
+        title = f've = {cli_args.ve:g}, vo = {cli_args.vo:g}'
+
+    samples = sample_parameters(ranges, cli_args.samples, cli_args.method, cli_args.seed)
+    print(f"{len(samples)} parameter sets ({cli_args.method}) over {', '.join(names)}")
+    maps = collision_maps(scenario, names, samples, config, cli_args.processes, cli_args.batch_size)
+    nominal = EVALUATORS[scenario]({}, config)
+    probability = maps.mean(axis=0)
+    area = maps.mean(axis=(1, 2))
+    area_indices = first_order_indices(samples, area)
+    cell_indices = first_order_indices(samples, maps)
+
+    band = (probability > 0.05) & (probability < 0.95)
+    print(f"Collision cells: nominal {nominal.mean():.1%}, mean {area.mean():.1%} (std {area.std():.1%}); "
+          f"{band.sum()} of {band.size} cells with 5% < P(collision) < 95%")
+    print("First-order indices of the collision area, and mean over the uncertain cells:")
+    for name, index, cells in zip(names, area_indices, cell_indices):
+        mean_cells = np.nanmean(cells[band]) if band.any() else np.nan
+        print(f"  {name:22s} {index:6.3f} {mean_cells:6.3f}")
+
+    if cli_args.output:
+        np.savez_compressed(cli_args.output, names=np.array(names), samples=samples,
+                            ranges=np.array([ranges[name] for name in names]),
+                            dx=config['dx_values'], y=config['y_values'],
+                            collisions=np.packbits(maps, axis=None), shape=np.array(maps.shape),
+                            nominal=nominal, probability=probability,
+                            area_indices=area_indices, cell_indices=cell_indices)
+        print(f"Written {cli_args.output}")
+    plot_probability(config, probability, nominal, title)
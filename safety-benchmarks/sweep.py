@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import profiling
+from common import env_configs
+from utils import value_range
+
+# verdict values in the verdict array
+COLLISION = 0
+SAFE = 1
+NOT_COMPUTED = 255
+
+METRICS = ['time', 'ego_speed', 'relative_speed']
+
+class ChunkedSweep:
+    """
+    Out-of-core sweep over a large parameter grid.
+
+    The grid is the product of outer axes (one trajectory library each, e.g., vo, vy, wheelbase, env)
+    and two inner axes evaluated together by the library (ve and dx0). Results are written into
+    preallocated memory-mapped files in `directory`:
+        sweep.json      axes, metric names, chunk size and the finished chunks
+        verdicts.u8     uint8 array (outer..., ve, dx0): SAFE, COLLISION or NOT_COMPUTED
+        metrics.f32     float32 array (outer..., ve, dx0, metric), NaN where there is no collision
+    Outer combinations are processed in chunks of `chunk_size`. A chunk is recorded as finished
+    only after its results are flushed, so an interrupted sweep resumes from the last finished chunk,
+    and memory does not depend on the grid size.
+    """
+    def __init__(self, directory, axes, chunk_size=16):
+        """
+        :param directory: output folder, created if needed
+        :param axes: list of (name, values), outer axes first, then the two inner axes
+        :param chunk_size: number of outer combinations per chunk
+        """
+        self.directory = directory
+        self.axes = [(name, list(values)) for name, values in axes]
+        self.chunk_size = chunk_size
+        self.shape = tuple(len(values) for _, values in self.axes)
+        self.outer_shape = self.shape[:-2]
+        self.chunk_count = -(-int(np.prod(self.outer_shape)) // chunk_size)
+        self.done = set()
+
+        os.makedirs(directory, exist_ok=True)
+        info_path = self._path('sweep.json')
+        resume = os.path.exists(info_path)
+        if resume:
+            with open(info_path, 'r') as f:
+                info = json.load(f)
+            if info['axes'] != [[name, values] for name, values in self.axes] or \
+                    info['chunk_size'] != chunk_size or info['metrics'] != METRICS:
+                raise ValueError(f"{directory} contains a sweep over other axes; use another folder")
+            self.done = set(info['done'])
+        mode = 'r+' if resume else 'w+'
+        self.verdicts = np.memmap(self._path('verdicts.u8'), dtype=np.uint8, mode=mode, shape=self.shape)
+        self.metrics = np.memmap(self._path('metrics.f32'), dtype=np.float32, mode=mode,
+                                 shape=self.shape + (len(METRICS),))
+        if not resume:
+            self.verdicts[:] = NOT_COMPUTED
+            self.metrics[:] = np.nan
+            self._save_info()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _save_info(self):
+        self.verdicts.flush()
+        self.metrics.flush()
+        info = {
+            'axes': self.axes,
+            'metrics': METRICS,
+            'chunk_size': self.chunk_size,
+            'done': sorted(self.done)
+        }
+        tmp_path = self._path('sweep.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp_path, self._path('sweep.json'))
+
+    def chunk_range(self, chunk):
+        """
+        Return the range of flat indices of the outer combinations of a chunk.
+        """
+        outer_count = int(np.prod(self.outer_shape))
+        return range(chunk * self.chunk_size, min((chunk + 1) * self.chunk_size, outer_count))
+
+    def pending_chunks(self):
+        return [chunk for chunk in range(self.chunk_count) if chunk not in self.done]
+
+    def write_chunk(self, chunk, verdicts, metrics):
+        """
+        Store the results of a chunk, as returned by compute_chunk, and record it as finished.
+        """
+        flat = self.chunk_range(chunk)
+        self.verdicts.reshape((-1,) + self.shape[-2:])[flat.start:flat.stop] = verdicts
+        self.metrics.reshape((-1,) + self.shape[-2:] + (len(METRICS),))[flat.start:flat.stop] = metrics
+        self.done.add(chunk)
+        self._save_info()
+
+    def run(self, evaluate):
+        """
+        Compute all unfinished chunks.
+        :param evaluate: function (dict of outer parameters, inner values 1, inner values 2)
+                         -> dict of arrays (len(inner 1), len(inner 2)) with `step` (-1 if no collision)
+                         and the METRICS, as TrajectoryLibrary.impacts
+        """
+        for chunk in self.pending_chunks():
+            self.write_chunk(chunk, *compute_chunk(self.axes, self.chunk_range(chunk), evaluate))
+            print(f"Done chunk {chunk + 1}/{self.chunk_count}")
+
+def compute_chunk(axes, flat_range, evaluate):
+    """
+    Evaluate the outer combinations with flat indices in flat_range.
+    :return: verdicts (n, inner 1, inner 2) as uint8 and metrics (n, inner 1, inner 2, metric) as float32
+    """
+    outer_shape = tuple(len(values) for _, values in axes[:-2])
+    (_, inner1), (_, inner2) = axes[-2:]
+    verdicts = np.empty((len(flat_range), len(inner1), len(inner2)), dtype=np.uint8)
+    metrics = np.empty(verdicts.shape + (len(METRICS),), dtype=np.float32)
+    for row, flat in enumerate(flat_range):
+        index = np.unravel_index(flat, outer_shape)
+        params = {name: values[int(i)] for (name, values), i in zip(axes, index)}
+        with profiling.phase('sweep_cell', **params):
+            impacts = evaluate(params, inner1, inner2)
+        verdicts[row] = np.where(impacts['step'] < 0, SAFE, COLLISION)
+        metrics[row] = np.stack([impacts[name] for name in METRICS], axis=-1)
+    return verdicts, metrics
+
+def load(directory):
+    """
+    Open a sweep read-only: return (axes, verdicts, metrics), the arrays being memory-mapped.
+    """
+    with open(os.path.join(directory, 'sweep.json'), 'r') as f:
+        info = json.load(f)
+    shape = tuple(len(values) for _, values in info['axes'])
+    verdicts = np.memmap(os.path.join(directory, 'verdicts.u8'), dtype=np.uint8, mode='r', shape=shape)
+    metrics = np.memmap(os.path.join(directory, 'metrics.f32'), dtype=np.float32, mode='r',
+                        shape=shape + (len(info['metrics']),))
+    return info['axes'], verdicts, metrics
+
+def _impacts_grid(lib, ve_values, dx_values):
+    impacts = [lib.impacts(dx_values, ve / 3.6) for ve in ve_values]
+    return {name: np.array([impact[name] for impact in impacts]) for name in ['step'] + METRICS}
+
+def uturn_cell(params, ve_values, dx_values):
+    from uturn.uturn import trajectory_library
+    lib = trajectory_library(params['vo'] / 3.6, params['turning_wheel_angle'], params['wheelbase'],
+                             params['lane'] == 'rightmost', env_configs[params['env']])
+    return _impacts_grid(lib, ve_values, dx_values)
+
+def swerve_cell(params, ve_values, dx_values):
+    from swerve.swerve import trajectory_library
+    lib = trajectory_library(params['vo'] / 3.6, params['vy'], params['ny'], params['swerve_distance'],
+                             params['wheelbase'], env_configs[params['env']])
+    return _impacts_grid(lib, ve_values, dx_values)
+
+def parse_values(tokens):
+    """
+    Parse axis values given as numbers, or as `start:stop:step` ranges (stop included).
+    """
+    values = []
+    for token in tokens:
+        if ':' in token:
+            start, stop, step = (float(part) for part in token.split(':'))
+            values.extend(value_range(start, stop, step).tolist())
+        else:
+            values.append(float(token))
+    return values
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description='Chunked, resumable sweeps of the safety reference benchmarks '
+                                                 'over large parameter grids, stored in memory-mapped files.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    uturn = subparsers.add_parser('uturn', help='sweep U-turn scenarios')
+    uturn.add_argument('--vo', nargs='+', default=['10'], help='NPC speeds in km/h')
+    uturn.add_argument('--turning-wheel-angle', nargs='+', default=[str(np.pi / 6)],
+                       help='NPC turning wheel angles in radian')
+    uturn.add_argument('--lane', nargs='+', default=['rightmost'], choices=['rightmost', 'adjacent'])
+
+    swerve = subparsers.add_parser('swerve', help='sweep swerve scenarios')
+    swerve.add_argument('--vo', nargs='+', default=['10'], help='NPC speeds in km/h')
+    swerve.add_argument('--vy', nargs='+', default=['0.6:1.6:0.1'], help='NPC lateral velocities in m/s')
+    swerve.add_argument('--ny', nargs='+', default=['1.8'], help='lateral offsets of the swerve in m')
+    swerve.add_argument('--swerve-distance', nargs='+', default=['2.0'], help='swerve distances in m')
+
+    for subparser, dx_default in ((uturn, '9:50:1'), (swerve, '10:55:1')):
+        subparser.add_argument('--wheelbase', nargs='+', default=['2.5'], help='NPC wheelbases in m')
+        subparser.add_argument('--env', nargs='+', default=['awsim'], choices=list(env_configs),
+                               help='environment configurations (default: awsim)')
+        subparser.add_argument('--ve', nargs='+', default=['14:50:1'], help='Ego speeds in km/h')
+        subparser.add_argument('--dx', nargs='+', default=[dx_default], help='Longitudinal distances in m')
+        subparser.add_argument('-o', '--output', required=True,
+                               help='output folder; an interrupted sweep is resumed from it')
+        subparser.add_argument('--chunk-size', type=int, default=16,
+                               help='outer parameter combinations per chunk (default: 16)')
+    parser.epilog = 'Values can be listed, or given as start:stop:step ranges, e.g., --vo 5:20:0.5'
+    return parser
+
+def sweep_axes(cli_args):
+    """
+    Return the axes of the sweep and its evaluation function from the parsed command line.
+    """
+    if cli_args.command == 'uturn':
+        axes = [('vo', parse_values(cli_args.vo)),
+                ('turning_wheel_angle', parse_values(cli_args.turning_wheel_angle)),
+                ('wheelbase', parse_values(cli_args.wheelbase)),
+                ('lane', cli_args.lane),
+                ('env', cli_args.env)]
+    else:
+        axes = [('vo', parse_values(cli_args.vo)),
+                ('vy', parse_values(cli_args.vy)),
+                ('ny', parse_values(cli_args.ny)),
+                ('swerve_distance', parse_values(cli_args.swerve_distance)),
+                ('wheelbase', parse_values(cli_args.wheelbase)),
+                ('env', cli_args.env)]
+    axes += [('ve', parse_values(cli_args.ve)), ('dx', parse_values(cli_args.dx))]
+    return axes, EVALUATORS[cli_args.command]
+
+EVALUATORS = {
+    'uturn': uturn_cell,
+    'swerve': swerve_cell
+}
+
+if __name__ == '__main__':
+    cli_args = cli_parser().parse_args()
+    axes, evaluate = sweep_axes(cli_args)
+    sweep = ChunkedSweep(cli_args.output, axes, cli_args.chunk_size)
+    print(f"{int(np.prod(sweep.shape))} cells, {sweep.chunk_count} chunks, {len(sweep.done)} already done")
+    sweep.run(evaluate)
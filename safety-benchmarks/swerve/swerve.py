@@ -1,6 +1,9 @@
 import argparse
 
 from common import *
+from trajectory import TrajectoryLibrary
+from adaptive import AdaptiveSampler
+from matplotlib.patches import Patch
 from matplotlib import pyplot as plt
 
 # lateral offset of the swerve, see the paper
@@ -10,6 +13,8 @@ SWERVE_DISTANCE = 2.0
 WHEEL_BASE = 2.5
 
 env_config = awsim_env_config
+# simulated time of each scenario, in seconds
+SIM_DURATION = 10
 
 class SwerveEgo(Ego):
     def __init__(self, position, velocity, size=(2,5)):
@@ -91,8 +96,13 @@ class SwerveSimulation(Simulation):
     """
     Simulation for swerve scenarios
     """
-    def __init__(self, ego: SwerveEgo, npc: SwerveNPC, sim_step=0.02):
-        super().__init__(ego, npc, sim_step)
+    def __init__(self, ego: SwerveEgo, npc: SwerveNPC, sim_step=0.02, AEB_policy=None, env=None, driver=None):
+        """
+        :param env: environment configuration (lane width, ...), default: env_config
+        :param driver: DriverModel, default: the benchmark constants
+        """
+        super().__init__(ego, npc, sim_step, AEB_policy, driver)
+        self.env = env if env is not None else env_config
         self.npc_delta_s = self.npc.speed * self.sim_step
 
     def npc_step(self):
@@ -126,44 +136,61 @@ class SwerveSimulation(Simulation):
 
     def step(self):
         if self.brake_decision_time < 0 and self.should_detect_risk():
-            self.brake_decision_time = self.time + RISK_EVAL_TIME
+            self.brake_decision_time = self.time + self.driver.risk_eval_time
 
         elif not self.AEB_activated and self.should_activate_AEB():
             self.AEB_activated = True
+            self.AEB_activation_time = self.time
 
         super().step()
 
     # Ego should detect a potential risk
     def should_detect_risk(self):
-        return self.npc.topright()[1] >= env_config['lane_width'] / 2
-
-    def should_activate_AEB(self):
-        return False
+        return self.npc.topright()[1] >= self.env['lane_width'] / 2
 
-def single_sim_exec(dx0, ve, vo,vy, ny,swerve_distance):
-    sim_step = 0.025
-    average_length = (env_config['ego_length'] + env_config['npc_length']) / 2.0
+def make_simulation(dx0, ve, vo, vy, ny, swerve_distance, sim_step=0.025, AEB_policy=None,
+                    wheelbase=WHEEL_BASE, env=None, driver=None):
+    env = env if env is not None else env_config
+    average_length = (env['ego_length'] + env['npc_length']) / 2.0
 
     npc = SwerveNPC((dx0 + average_length, 0.0),
                     vo, vy,
-                    (env_config['npc_length'], env_config['npc_width']),
-                    ny, swerve_distance)
+                    (env['npc_length'], env['npc_width']),
+                    ny, swerve_distance, wheelbase)
 
-    ego = SwerveEgo((0.0, env_config['lane_width']),
+    ego = SwerveEgo((0.0, env['lane_width']),
                     (ve,0.0),
-                    (env_config['ego_length'], env_config['ego_width']))
-
-    sim = SwerveSimulation(ego, npc, sim_step)
-    while sim.time < 10:
-        sim.step()
-        if sim.collision:
-            return False
-    return True
+                    (env['ego_length'], env['ego_width']))
+
+    return SwerveSimulation(ego, npc, sim_step, AEB_policy, env, driver)
+
+def single_sim_exec(dx0, ve, vo,vy, ny,swerve_distance, AEB_policy=None, wheelbase=WHEEL_BASE, driver=None):
+    with profiling.phase('single_sim_exec', dx0=dx0, ve=ve, vo=vo, vy=vy):
+        sim = make_simulation(dx0, ve, vo, vy, ny, swerve_distance, AEB_policy=AEB_policy,
+                              wheelbase=wheelbase, driver=driver)
+        while sim.time < SIM_DURATION:
+            sim.step()
+            if sim.collision:
+                return False
+        return True
+
+def trajectory_library(vo, vy, ny=NY, swerve_distance=SWERVE_DISTANCE, wheelbase=WHEEL_BASE, env=None,
+                       driver=None):
+    """
+    Precomputed NPC and ego trajectories for all (dx0, ve) cells with NPC speed vo
+    and lateral velocity vy (m/s), see trajectory.TrajectoryLibrary
+    """
+    return TrajectoryLibrary(
+        lambda dx0, ve: make_simulation(dx0, ve, vo, vy, ny, swerve_distance,
+                                        wheelbase=wheelbase, env=env, driver=driver),
+        SIM_DURATION)
 
-def simulation(ve,vo):
+def simulation(ve,vo, library=False, driver=None):
     """
     :param vo: NPC speed in m/s
     :param ve: Ego speed in m/s
+    :param library: if True, decide all cells from precomputed trajectories (same results, much faster)
+    :param driver: DriverModel, default: the benchmark constants
     """
     ny = NY
     swerve_distance = SWERVE_DISTANCE
@@ -175,9 +202,15 @@ def simulation(ve,vo):
     nc_x, nc_y = [], []
 
     vy = 0.6
+    dx_values = list(range(10, 56))
     while vy <= 1.61:
-        for dx in range(10, 56):
-            not_collision = single_sim_exec(dx, ve, vo,vy, ny, swerve_distance)
+        if library:
+            verdicts = trajectory_library(vo, vy, ny, swerve_distance, driver=driver).verdicts(dx_values, ve)
+        for i, dx in enumerate(dx_values):
+            if library:
+                not_collision = verdicts[i]
+            else:
+                not_collision = single_sim_exec(dx, ve, vo,vy, ny, swerve_distance, driver=driver)
             if not_collision:
                 nc_x.append(dx), nc_y.append(vy)
             else:
@@ -205,6 +238,101 @@ def simulation(ve,vo):
     plt.legend(bbox_to_anchor=(0.8, 0.8))
     plt.show()
 
+def adaptive_simulation(ve, vo, library=False, resolution=(0.25, 0.01), output=None, driver=None):
+    """
+    Same benchmark as simulation(), but sampled adaptively: the map is refined only
+    around the collision boundary (see adaptive.AdaptiveSampler).
+    :param vo: NPC speed in m/s
+    :param ve: Ego speed in m/s
+    :param resolution: size of the finest cells, (dx0 in m, vy in m/s)
+    :param output: if given, npz file in which the refined map and the boundary are saved
+    :param driver: DriverModel, default: the benchmark constants
+    """
+    ny = NY
+    swerve_distance = SWERVE_DISTANCE
+    # one library per lateral velocity
+    libraries = {}
+
+    def is_safe(dx, vy):
+        if library:
+            if vy not in libraries:
+                libraries[vy] = trajectory_library(vo, vy, ny, swerve_distance, driver=driver)
+            return libraries[vy].verdicts([dx], ve)[0]
+        return single_sim_exec(dx, ve, vo, vy, ny, swerve_distance, driver=driver)
+
+    sampler = AdaptiveSampler(is_safe, (10, 55), (0.6, 1.6), resolution)
+    sampler.run()
+    print(f"{len(sampler.samples)} simulations, {len(sampler.leaves)} cells")
+    if output:
+        sampler.save(output)
+
+    colors = ['r', 'g', 'orange']
+    plt.figure(dpi=200, figsize=(8,4))
+    sampler.plot(plt.gca(), colors)
+    plt.xlabel('Longitudinal distance (dx0)')
+    plt.ylabel('Lateral velocity (vy)')
+    plt.title(f've = {(int)(ve * 3.6)}, vo = {(int)(vo * 3.6)}')
+    plt.legend(handles=[Patch(color=colors[0], label="collision"),
+                        Patch(color=colors[1], label="no collision"),
+                        Patch(color=colors[2], label="boundary")],
+               bbox_to_anchor=(0.8, 0.8))
+    plt.show()
+
+def severity_layers(ve, vo, AEB_policy=None, dx_values=tuple(range(10, 56)),
+                    vy_values=tuple(0.6 + 0.1 * i for i in range(11)), driver=None):
+    """
+    Avoidability map with severity layers on the benchmark grid, rows vy (m/s), columns dx0 (m):
+    `safe`, and for colliding cells the first-contact time (s), the ego speed and the
+    relative speed at impact (m/s), NaN elsewhere (see TrajectoryLibrary.impacts).
+    :param vo: NPC speed in m/s
+    :param ve: Ego speed in m/s
+    :param driver: DriverModel, default: the benchmark constants
+    """
+    impacts = [trajectory_library(vo, vy, driver=driver).impacts(list(dx_values), ve, AEB_policy) for vy in vy_values]
+    layers = {name: np.array([impact[name] for impact in impacts])
+              for name in ('time', 'ego_speed', 'relative_speed')}
+    layers['safe'] = np.array([impact['step'] < 0 for impact in impacts])
+    layers['dx'] = np.array(dx_values, dtype=float)
+    layers['vy'] = np.array(vy_values, dtype=float)
+    return layers
+
+def variants_simulation(ve, vo, AEB_policies=(None,), driver=None):
+    """
+    Benchmarks of several ego variants at once, e.g., human brake only and AEB with several
+    trigger policies, one figure row per variant. The NPC trajectories and the human-brake
+    ego trajectory are computed once and shared by all variants.
+    :param vo: NPC speed in m/s
+    :param ve: Ego speed in m/s
+    :param AEB_policies: list of AEBPolicy, None for the human brake only
+    :param driver: DriverModel, default: the benchmark constants
+    """
+    dx_values = list(range(10, 56))
+    vy_values = [0.6 + 0.1 * i for i in range(11)]
+    verdicts = []
+    for vy in vy_values:
+        lib = trajectory_library(vo, vy, driver=driver)
+        verdicts.append(lib.variant_verdicts(dx_values, ve, AEB_policies))
+        print(f"Done vy = {vy:.2f}")
+    verdicts = np.array(verdicts)
+    dx, vy = np.meshgrid(dx_values, vy_values)
+
+    # draw config
+    shape = ","
+    colors = ['r', 'g', 'orange']
+
+    fig, axes = plt.subplots(len(AEB_policies), 1, dpi=200, figsize=(8, 3.0 * len(AEB_policies)),
+                             sharex=True, squeeze=False)
+    for ax, policy, safe in zip(axes[:, 0], AEB_policies, np.moveaxis(verdicts, 1, 0)):
+        ax.scatter(dx[~safe], vy[~safe], label="collision", color=colors[0], marker=shape, s=20)
+        ax.scatter(dx[safe], vy[safe], label="no collision", color=colors[1], marker=shape, s=20)
+        ax.set_ylabel('Lateral velocity (vy)')
+        ax.set_title(f've = {(int)(ve * 3.6)}, vo = {(int)(vo * 3.6)}, '
+                     f'{policy if policy is not None else "human brake only"}')
+    axes[-1, 0].set_xlabel('Longitudinal distance (dx0)')
+    axes[0, 0].legend(bbox_to_anchor=(0.8, 0.8))
+    plt.tight_layout()
+    plt.show()
+
 def cli_parser():
     parser = argparse.ArgumentParser(description='Simulation to Construct '
                                                  'Safety reference benchmark for Swerve scenarios.')
@@ -212,10 +340,40 @@ def cli_parser():
                       help='AV Speed in km/h (default: 20)')
     parser.add_argument('-vo', type=int, default=10,
                       help='NPC Speed in km/h (default: 10)')
+    parser.add_argument('--library', action='store_true',
+                      help='integrate the NPC and ego trajectories once and reuse them '
+                           'for all grid cells (same results, much faster)')
+    parser.add_argument('--adaptive', action='store_true',
+                      help='refine the map only around the collision boundary, '
+                           'instead of the uniform grid')
+    parser.add_argument('--resolution', type=float, nargs=2, default=[0.25, 0.01],
+                      metavar=('DX0', 'VY'),
+                      help='finest cell size with --adaptive, dx0 in m and vy in m/s (default: 0.25 0.01)')
+    parser.add_argument('-o', '--output',
+                      help='with --adaptive, npz file to save the refined map and the boundary to')
+    parser.add_argument('--severity', metavar='FILE',
+                      help='also save the map with the contact time, ego speed and relative speed '
+                           'at impact of each cell to this npz file')
+    parser.add_argument('--aeb-ttc', type=float, nargs='+', default=[], metavar='SECONDS',
+                      help='also benchmark an ego with AEB triggered at each of these TTC thresholds')
+    parser.add_argument('--aeb-distance', type=float, nargs='+', default=[], metavar='METERS',
+                      help='also benchmark an ego with AEB triggered at each of these distance thresholds')
+    parser.add_argument('--driver', metavar='FILE',
+                      help='JSON file of the driver model parameters, e.g., written by '
+                           '../trace-analysis/calibration.py (default: the constants of common.py)')
     return parser
 
 if __name__ == '__main__':
     cli_args = cli_parser().parse_args()
     ve = cli_args.ve / 3.6
     vo = cli_args.vo / 3.6
-    simulation(ve,vo)
\ No newline at end of file
+    driver = DriverModel.load(cli_args.driver) if cli_args.driver else None
+    if cli_args.severity:
+        np.savez_compressed(cli_args.severity, **severity_layers(ve, vo, driver=driver))
+        print(f"Written {cli_args.severity}")
+    if cli_args.aeb_ttc or cli_args.aeb_distance:
+        variants_simulation(ve, vo, AEB_variants(cli_args.aeb_ttc, cli_args.aeb_distance), driver)
+    elif cli_args.adaptive:
+        adaptive_simulation(ve, vo, cli_args.library, cli_args.resolution, cli_args.output, driver)
+    else:
+        simulation(ve,vo, cli_args.library, driver)
\ No newline at end of file
@@ -0,0 +1,215 @@
+import numpy as np
+import utils
+import profiling
+
+class TrajectoryLibrary:
+    """
+    Precomputed trajectories of one scenario configuration (NPC speed, lateral velocity, lane, ...),
+    reused across all (dx0, ve) cells of a benchmark.
+
+    In both benchmark models, the NPC does not react to the ego, and the ego's braking is
+    triggered by the lateral position of the NPC only, not by dx0. Hence:
+    - the NPC trajectory is the same for every dx0, up to a longitudinal translation by dx0;
+    - the ego trajectory depends only on ve.
+    Both are integrated once (the NPC once per library, the ego once per ve), and a cell is
+    decided by checking the precomputed footprints, with the NPC shifted by dx0, against
+    each other at every simulation step. The footprints at step k are those checked by
+    Simulation.step() at the same step, so verdicts match single_sim_exec.
+    """
+    def __init__(self, make_simulation, duration):
+        """
+        :param make_simulation: function (dx0, ve) -> Simulation of the scenario configuration
+        :param duration: simulated time of each cell, in seconds
+        """
+        self.make_simulation = make_simulation
+        self.duration = duration
+
+        # the ego stands still and vehicles pass through each other: only the NPC is recorded
+        sim = make_simulation(0.0, 0.0)
+        sim.detect_collisions = False
+        npc_vertices, npc_velocity, times = [], [], []
+        # step in which the risk is detected, in which the AEB policy is not evaluated
+        self.risk_step = -1
+        while sim.time < duration:
+            npc_vertices.append(sim.npc.get_vertices())
+            npc_velocity.append(sim.npc.speed * np.array((np.cos(sim.npc.heading), np.sin(sim.npc.heading))))
+            times.append(sim.time)
+            deciding = sim.brake_decision_time < 0
+            sim.step()
+            if deciding and sim.brake_decision_time >= 0:
+                self.risk_step = len(npc_vertices) - 1
+        self.sim_step = sim.sim_step
+        self.driver = sim.driver
+        self.npc_vertices = np.array(npc_vertices)
+        # NPC velocity vectors and time of each step
+        self.npc_velocity = np.array(npc_velocity)
+        self.npc_vx = self.npc_velocity[:, 0]
+        self.times = np.array(times)
+        self.steps = len(npc_vertices)
+        self.brake_decision_time = sim.brake_decision_time
+        self.ego_tracks = {}
+        # (ve, step) -> ego footprints from that step, with AEB activated at that step
+        self.AEB_tracks = {}
+
+    def ego_track(self, ve):
+        """
+        Return the ego footprints (steps, 4, 2), speeds (steps,) and full states for ego speed ve,
+        with the human brake only.
+        """
+        if ve not in self.ego_tracks:
+            sim = self.make_simulation(0.0, ve)
+            sim.brake_decision_time = self.brake_decision_time
+            ego_vertices, speeds, states = [], [], []
+            for _ in range(self.steps):
+                ego_vertices.append(sim.ego.get_vertices())
+                speeds.append(sim.ego.speed)
+                states.append((sim.ego.position.copy(), sim.ego.speed, sim.ego.decel,
+                               sim.brake_activated, sim.time))
+                sim.ego_step()
+                sim.time += sim.sim_step
+            self.ego_tracks[ve] = (np.array(ego_vertices), np.array(speeds), states)
+        return self.ego_tracks[ve]
+
+    def ego_vertices(self, ve):
+        """
+        Return the ego footprints (steps, 4, 2) for ego speed ve.
+        """
+        return self.ego_track(ve)[0]
+
+    def AEB_track(self, ve, step):
+        """
+        Return the ego footprints (steps - step, 4, 2) and speeds (steps - step,) from `step` on,
+        when AEB is activated at `step`.
+        The ego is replayed from its state in the human-brake track, so the NPC is not simulated again.
+        """
+        if (ve, step) not in self.AEB_tracks:
+            position, speed, decel, brake_activated, time = self.ego_track(ve)[2][step]
+            sim = self.make_simulation(0.0, ve)
+            sim.brake_decision_time = self.brake_decision_time
+            sim.ego.position, sim.ego.speed, sim.ego.decel = position.copy(), speed, decel
+            sim.brake_activated = brake_activated
+            sim.time = time
+            sim.AEB_activated = True
+            sim.AEB_activation_time = time
+            ego_vertices, speeds = [], []
+            for _ in range(step, self.steps):
+                ego_vertices.append(sim.ego.get_vertices())
+                speeds.append(sim.ego.speed)
+                sim.ego_step()
+                sim.time += sim.sim_step
+            self.AEB_tracks[(ve, step)] = (np.array(ego_vertices), np.array(speeds))
+        return self.AEB_tracks[(ve, step)]
+
+    def npc_tracks(self, dx0_values):
+        """
+        Return the NPC footprints (len(dx0_values), steps, 4, 2), shifted by each dx0.
+        """
+        shifts = np.zeros((len(dx0_values), 1, 1, 2))
+        shifts[:, 0, 0, 0] = dx0_values
+        return self.npc_vertices[np.newaxis] + shifts
+
+    def first_collision_steps(self, dx0_values, ve, AEB_policy=None):
+        """
+        Return, for each dx0, the index of the first step with a collision, or -1 if none.
+        With an AEB policy, the policy is evaluated on the human-brake track up to its first
+        trigger (as Simulation.step does, before the collision check of the same step),
+        and the ego is then replayed with AEB from that step.
+        """
+        return self._first_collisions(dx0_values, ve, AEB_policy)[0]
+
+    def _first_collisions(self, dx0_values, ve, AEB_policy=None):
+        """
+        Return the first collision steps and the AEB activation steps (-1 if none), for each dx0.
+        """
+        npc = self.npc_tracks(dx0_values)
+        ego_vertices, speeds, _ = self.ego_track(ve)
+        collisions = utils.batch_is_collision(ego_vertices[np.newaxis], npc)
+        profiling.count('batch_pairs', collisions.size)
+        first = np.where(collisions.any(axis=1), collisions.argmax(axis=1), -1)
+        AEB_steps = np.full(len(first), -1)
+        if AEB_policy is None:
+            return first, AEB_steps
+
+        triggers = AEB_policy.triggered(ego_vertices[np.newaxis], speeds[np.newaxis],
+                                        npc, self.npc_vx[np.newaxis])
+        if self.risk_step >= 0:
+            triggers[:, self.risk_step] = False
+        for i, dx0 in enumerate(dx0_values):
+            if not triggers[i].any():
+                continue
+            step = triggers[i].argmax()
+            if 0 <= first[i] <= step:
+                continue
+            AEB_steps[i] = step
+            AEB_collisions = utils.batch_is_collision(self.AEB_track(ve, step)[0], npc[i, step:])
+            profiling.count('batch_pairs', AEB_collisions.size)
+            first[i] = step + AEB_collisions.argmax() if AEB_collisions.any() else -1
+        return first, AEB_steps
+
+    def _ego_state(self, ve, step, AEB_step):
+        """
+        Return the ego footprint and speed at `step`, with AEB activated at AEB_step (-1 if none).
+        """
+        if 0 <= AEB_step <= step:
+            vertices, speeds = self.AEB_track(ve, AEB_step)
+            return vertices[step - AEB_step], speeds[step - AEB_step]
+        vertices, speeds, _ = self.ego_track(ve)
+        return vertices[step], speeds[step]
+
+    def impacts(self, dx0_values, ve, AEB_policy=None, iterations=20):
+        """
+        Severity of the collision of each dx0: time of first contact, ego speed and relative speed
+        (norm of the velocity difference) at that time, NaN if there is no collision.
+        The contact time is refined within the step of the first collision by bisection, with the
+        footprints and speeds linearly interpolated between the previous step and this step.
+        :return: dict of arrays (len(dx0_values),): `step`, `time`, `ego_speed`, `relative_speed`
+        """
+        first, AEB_steps = self._first_collisions(dx0_values, ve, AEB_policy)
+        count = len(first)
+        previous = np.maximum(first - 1, 0)
+        ego0, ego1 = np.zeros((count, 4, 2)), np.zeros((count, 4, 2))
+        speed0, speed1 = np.zeros(count), np.zeros(count)
+        for i in np.nonzero(first >= 0)[0]:
+            ego0[i], speed0[i] = self._ego_state(ve, previous[i], AEB_steps[i])
+            ego1[i], speed1[i] = self._ego_state(ve, first[i], AEB_steps[i])
+        shifts = np.zeros((count, 1, 2))
+        shifts[:, 0, 0] = dx0_values
+        npc0 = self.npc_vertices[previous] + shifts
+        npc1 = self.npc_vertices[np.maximum(first, 0)] + shifts
+
+        # the contact is in (low, high], or at step 0 if the vehicles already overlap
+        low, high = np.zeros(count), np.ones(count)
+        for _ in range(iterations if count else 0):
+            middle = (low + high) / 2
+            weights = middle[:, np.newaxis, np.newaxis]
+            colliding = utils.batch_is_collision(ego0 + (ego1 - ego0) * weights,
+                                                 npc0 + (npc1 - npc0) * weights)
+            high = np.where(colliding, middle, high)
+            low = np.where(colliding, low, middle)
+        fraction = np.where(first > 0, high, 0.0)
+
+        time = self.times[previous] + (self.times[np.maximum(first, 0)] - self.times[previous]) * fraction
+        ego_speed = speed0 + (speed1 - speed0) * fraction
+        npc_velocity = self.npc_velocity[previous] + \
+                       (self.npc_velocity[np.maximum(first, 0)] - self.npc_velocity[previous]) * fraction[:, np.newaxis]
+        relative_speed = np.linalg.norm(np.stack((ego_speed, np.zeros(count)), axis=1) - npc_velocity, axis=1)
+        collided = first >= 0
+        return {
+            'step': first,
+            'time': np.where(collided, time, np.nan),
+            'ego_speed': np.where(collided, ego_speed, np.nan),
+            'relative_speed': np.where(collided, relative_speed, np.nan)
+        }
+
+    def verdicts(self, dx0_values, ve, AEB_policy=None):
+        """
+        Return, for each dx0, True if there is no collision (as single_sim_exec does).
+        """
+        return self.first_collision_steps(dx0_values, ve, AEB_policy) < 0
+
+    def variant_verdicts(self, dx0_values, ve, AEB_policies):
+        """
+        Return verdicts (len(AEB_policies), len(dx0_values)) of several ego variants, e.g.,
+        [None, AEBPolicy(ttc_threshold=1.0), ...], sharing the NPC and human-brake tracks.
+        """
+        return np.array([self.verdicts(dx0_values, ve, policy) for policy in AEB_policies])
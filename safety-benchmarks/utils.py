@@ -26,6 +26,48 @@ def is_collision(ego_vertices, npc_vertices):
 
     return False
 
+def batch_is_collision(vertices1, vertices2):
+    """
+    Vectorized is_collision for many pairs of rectangles at once,
+    based on the separating axis theorem: two convex polygons are disjoint iff their
+    projections on one of their edge normals do not overlap.
+    Touching rectangles collide, as in is_collision.
+    :param vertices1: array (..., 4, 2) of rectangle corners, in order
+    :param vertices2: array (..., 4, 2), broadcastable with vertices1
+    :return: boolean array (...)
+    """
+    vertices1, vertices2 = np.broadcast_arrays(vertices1, vertices2)
+    # two adjacent edges give the two normal directions of a rectangle
+    edges = np.concatenate((vertices1[..., 1:3, :] - vertices1[..., 0:2, :],
+                            vertices2[..., 1:3, :] - vertices2[..., 0:2, :]), axis=-2)
+    axes = np.stack((-edges[..., 1], edges[..., 0]), axis=-1)
+    proj1 = np.einsum('...ak,...vk->...av', axes, vertices1)
+    proj2 = np.einsum('...ak,...vk->...av', axes, vertices2)
+    separated = (proj1.max(axis=-1) < proj2.min(axis=-1)) | (proj2.max(axis=-1) < proj1.min(axis=-1))
+    return ~separated.any(axis=-1)
+
+def clip_convex(subject, clip):
+    """
+    Sutherland-Hodgman clipping: intersection of a convex polygon with a convex polygon `clip`.
+    Points on the border are kept, so touching polygons give a degenerate, non-empty result.
+    :param subject: array (n, 2) of corners, in order
+    :param clip: array (m, 2) of corners, in order
+    :return: array (k, 2) of corners, empty if the polygons do not intersect
+    """
+    orientation = np.sign(sign_line_eq(clip[2], clip[0], clip[1])) or 1
+    output = [np.asarray(P, dtype=float) for P in subject]
+    for A, B in zip(clip, np.roll(clip, -1, axis=0)):
+        points, output = output, []
+        for P, Q in zip(points, points[1:] + points[:1]):
+            sp, sq = orientation * sign_line_eq(P, A, B), orientation * sign_line_eq(Q, A, B)
+            if sp >= 0:
+                output.append(P)
+            if sp * sq < 0:
+                output.append(P + (Q - P) * sp / (sp - sq))
+        if not output:
+            break
+    return np.array(output).reshape(-1, 2)
+
 def sign_line_eq(P, A, B):
     """
     Suppose AB has the line equation ax+by+c=0.
@@ -84,4 +126,10 @@ def signed_angle_2d(a, b):
         angle -= 2*np.pi
     elif angle < -np.pi:
         angle += 2*np.pi
-    return angle
\ No newline at end of file
+    return angle
+
+def value_range(start, stop, step):
+    """
+    Values from start to stop (included) by step, rounded to 6 decimals.
+    """
+    return np.round(np.arange(start, stop + step / 2, step), 6)
@@ -1,6 +1,10 @@
 import argparse
 
 from common import *
+from trajectory import TrajectoryLibrary
+from adaptive import AdaptiveSampler
+import certify
+from matplotlib.patches import Patch
 from matplotlib import pyplot as plt
 
 # average of max angles of outer and inner wheels during U-Turn
@@ -9,6 +13,8 @@ TURNING_WHEEL_ANGLE = np.pi / 6
 WHEEL_BASE = 2.5
 
 env_config = awsim_env_config
+# simulated time of each scenario, in seconds
+SIM_DURATION = 15
 
 class UTurnEgo(Ego):
     def __init__(self, position, velocity, size=(2.0,5.0)):
@@ -58,8 +64,13 @@ class UTurnSimulation(Simulation):
     """
     Simulation for U-turn scenarios
     """
-    def __init__(self, ego: UTurnEgo, npc: UTurnNPC, sim_step=0.02):
-        super().__init__(ego, npc, sim_step)
+    def __init__(self, ego: UTurnEgo, npc: UTurnNPC, sim_step=0.02, AEB_policy=None, env=None, driver=None):
+        """
+        :param env: environment configuration (lane width, ...), default: env_config
+        :param driver: DriverModel, default: the benchmark constants
+        """
+        super().__init__(ego, npc, sim_step, AEB_policy, driver)
+        self.env = env if env is not None else env_config
 
     def npc_step(self):
         super().npc_step()
@@ -73,49 +84,82 @@ class UTurnSimulation(Simulation):
             self.npc.position = utils.rotate_point(self.npc.position, self.npc.turning_center, -delta_angle)
             self.npc.heading = max(self.npc.heading - delta_angle, 0)
 
+    def npc_state_at(self, t):
+        """
+        Exact NPC state at time t: the NPC drives at constant speed on an arc of radius
+        turning_radius around turning_center until its heading reaches 0, then straight ahead.
+        """
+        position, heading, speed = self.npc_initial
+        travelled = speed * t
+        angle = min(travelled / self.npc.turning_radius, heading)
+        position = utils.rotate_point(position, self.npc.turning_center, -angle)
+        heading -= angle
+        if heading <= 0:
+            heading = 0
+            position = position + np.array((travelled - angle * self.npc.turning_radius, 0))
+        return position, heading, speed
+
     def step(self):
         if self.brake_decision_time < 0 and self.should_detect_risk():
-            self.brake_decision_time = self.time + RISK_EVAL_TIME
+            self.brake_decision_time = self.time + self.driver.risk_eval_time
 
         elif not self.AEB_activated and self.should_activate_AEB():
             self.AEB_activated = True
+            self.AEB_activation_time = self.time
 
         super().step()
 
     # Ego should detect a potential risk
     def should_detect_risk(self):
-        return self.npc.topright()[1] >= env_config['lane_width'] / 2 + env_config['median_strip']
-
-    def should_activate_AEB(self):
-        return False
+        return self.npc.topright()[1] >= self.env['lane_width'] / 2 + self.env['median_strip']
 
-def single_sim_exec(dx0, ve, vo, turning_wheel_angle=TURNING_WHEEL_ANGLE,
-                    wheelbase=WHEEL_BASE, rightmost_lane=True):
-    sim_step = 0.02
-    average_length = (env_config['ego_length'] + env_config['npc_length']) / 2
+def make_simulation(dx0, ve, vo, turning_wheel_angle=TURNING_WHEEL_ANGLE,
+                    wheelbase=WHEEL_BASE, rightmost_lane=True, sim_step=0.02, AEB_policy=None, env=None,
+                    driver=None):
+    env = env if env is not None else env_config
+    average_length = (env['ego_length'] + env['npc_length']) / 2
 
     npc = UTurnNPC((dx0 + average_length, 0),
                    (vo,0),
-                   (env_config['npc_length'], env_config['npc_width']),
+                   (env['npc_length'], env['npc_width']),
                     wheelbase, turning_wheel_angle)
 
-    ego_dy0 = env_config['median_strip'] + env_config['lane_width']
+    ego_dy0 = env['median_strip'] + env['lane_width']
     if not rightmost_lane:
-        ego_dy0 += env_config['lane_width']
+        ego_dy0 += env['lane_width']
     ego = UTurnEgo((0, ego_dy0),
                    (ve,0),
-                   (env_config['ego_length'], env_config['ego_width']))
+                   (env['ego_length'], env['ego_width']))
 
-    sim = UTurnSimulation(ego, npc, sim_step)
-    while sim.time < 15:
-        sim.step()
-        if sim.collision:
-            return False
-    return True
+    return UTurnSimulation(ego, npc, sim_step, AEB_policy, env, driver)
 
-def simulation(vo, rightmost_lane=True):
+def single_sim_exec(dx0, ve, vo, turning_wheel_angle=TURNING_WHEEL_ANGLE,
+                    wheelbase=WHEEL_BASE, rightmost_lane=True, AEB_policy=None, driver=None):
+    with profiling.phase('single_sim_exec', dx0=dx0, ve=ve, vo=vo):
+        sim = make_simulation(dx0, ve, vo, turning_wheel_angle, wheelbase, rightmost_lane,
+                              AEB_policy=AEB_policy, driver=driver)
+        while sim.time < SIM_DURATION:
+            sim.step()
+            if sim.collision:
+                return False
+        return True
+
+def trajectory_library(vo, turning_wheel_angle=TURNING_WHEEL_ANGLE,
+                       wheelbase=WHEEL_BASE, rightmost_lane=True, env=None, driver=None):
+    """
+    Precomputed NPC and ego trajectories for all (dx0, ve) cells with NPC speed vo (m/s),
+    see trajectory.TrajectoryLibrary
+    """
+    return TrajectoryLibrary(
+        lambda dx0, ve: make_simulation(dx0, ve, vo, turning_wheel_angle, wheelbase, rightmost_lane,
+                                        env=env, driver=driver),
+        SIM_DURATION)
+
+def simulation(vo, rightmost_lane=True, library=False, driver=None):
     """
     :param vo: NPC speed in m/s
+    :param library: if True, decide all cells from precomputed trajectories (same results, much faster)
+    :param driver: DriverModel, default: the benchmark constants
     """
 
     # red points: collisions
@@ -124,9 +168,16 @@ def simulation(vo, rightmost_lane=True):
     # green points: no collisions
     nc_x, nc_y = [], []
 
+    dx_values = list(range(9, 51))
+    lib = trajectory_library(vo, rightmost_lane=rightmost_lane, driver=driver) if library else None
     for ve in [14,20,25,30,35,40,45,50]:
-        for dx in range(9, 51):
-            not_collision = single_sim_exec(dx, ve/3.6, vo, rightmost_lane=rightmost_lane)
+        if lib is not None:
+            verdicts = lib.verdicts(dx_values, ve/3.6)
+        for i, dx in enumerate(dx_values):
+            if lib is not None:
+                not_collision = verdicts[i]
+            else:
+                not_collision = single_sim_exec(dx, ve/3.6, vo, rightmost_lane=rightmost_lane, driver=driver)
             if not_collision:
                 nc_x.append(dx), nc_y.append(ve)
             else:
@@ -154,6 +205,126 @@ def simulation(vo, rightmost_lane=True):
     plt.legend(bbox_to_anchor=(0.82, 0.8))
     plt.show()
 
+def adaptive_simulation(vo, rightmost_lane=True, library=False, resolution=(0.25, 0.5), output=None,
+                        driver=None):
+    """
+    Same benchmark as simulation(), but sampled adaptively: the map is refined only
+    around the collision boundary (see adaptive.AdaptiveSampler).
+    :param vo: NPC speed in m/s
+    :param resolution: size of the finest cells, (dx0 in m, ve in km/h)
+    :param output: if given, npz file in which the refined map and the boundary are saved
+    :param driver: DriverModel, default: the benchmark constants
+    """
+    lib = trajectory_library(vo, rightmost_lane=rightmost_lane, driver=driver) if library else None
+
+    def is_safe(dx, ve):
+        if lib is not None:
+            return lib.verdicts([dx], ve/3.6)[0]
+        return single_sim_exec(dx, ve/3.6, vo, rightmost_lane=rightmost_lane, driver=driver)
+
+    sampler = AdaptiveSampler(is_safe, (9, 50), (14, 50), resolution)
+    sampler.run()
+    print(f"{len(sampler.samples)} simulations, {len(sampler.leaves)} cells")
+    if output:
+        sampler.save(output)
+
+    colors = ['r', 'g', 'orange']
+    plt.figure(dpi=200, figsize=(10,4.0))
+    sampler.plot(plt.gca(), colors)
+    plt.xlabel('Longitudinal distance (dx0)')
+    plt.ylabel('Ego speed (ve)')
+    plt.title(f'Ego: {"rightmost lane" if rightmost_lane else "adjacent lane"}, '
+              f'vo = {(int)(vo * 3.6)}')
+    plt.legend(handles=[Patch(color=colors[0], label="Collision"),
+                        Patch(color=colors[1], label="No collision"),
+                        Patch(color=colors[2], label="Boundary")],
+               bbox_to_anchor=(0.82, 0.8))
+    plt.show()
+
+def severity_layers(vo, rightmost_lane=True, AEB_policy=None,
+                    dx_values=tuple(range(9, 51)), ve_values=(14,20,25,30,35,40,45,50), driver=None):
+    """
+    Avoidability map with severity layers on the benchmark grid, rows ve (km/h), columns dx0 (m):
+    `safe`, and for colliding cells the first-contact time (s), the ego speed and the
+    relative speed at impact (m/s), NaN elsewhere (see TrajectoryLibrary.impacts).
+    :param vo: NPC speed in m/s
+    :param driver: DriverModel, default: the benchmark constants
+    """
+    lib = trajectory_library(vo, rightmost_lane=rightmost_lane, driver=driver)
+    impacts = [lib.impacts(list(dx_values), ve/3.6, AEB_policy) for ve in ve_values]
+    layers = {name: np.array([impact[name] for impact in impacts])
+              for name in ('time', 'ego_speed', 'relative_speed')}
+    layers['safe'] = np.array([impact['step'] < 0 for impact in impacts])
+    layers['dx'] = np.array(dx_values, dtype=float)
+    layers['ve'] = np.array(ve_values, dtype=float)
+    return layers
+
+def variants_simulation(vo, rightmost_lane=True, AEB_policies=(None,), driver=None):
+    """
+    Benchmarks of several ego variants at once, e.g., human brake only and AEB with several
+    trigger policies, one figure row per variant. The NPC trajectory and the human-brake
+    ego trajectories are computed once and shared by all variants.
+    :param vo: NPC speed in m/s
+    :param AEB_policies: list of AEBPolicy, None for the human brake only
+    :param driver: DriverModel, default: the benchmark constants
+    """
+    lib = trajectory_library(vo, rightmost_lane=rightmost_lane, driver=driver)
+    dx_values = list(range(9, 51))
+    ve_values = [14,20,25,30,35,40,45,50]
+    verdicts = []
+    for ve in ve_values:
+        verdicts.append(lib.variant_verdicts(dx_values, ve/3.6, AEB_policies))
+        print(f"Done ve = {ve}")
+    verdicts = np.array(verdicts)
+    dx, ve = np.meshgrid(dx_values, ve_values)
+
+    # draw config
+    shape = ","
+    colors = ['r', 'g', 'orange']
+
+    fig, axes = plt.subplots(len(AEB_policies), 1, dpi=200, figsize=(10, 3.0 * len(AEB_policies)),
+                             sharex=True, squeeze=False)
+    for ax, policy, safe in zip(axes[:, 0], AEB_policies, np.moveaxis(verdicts, 1, 0)):
+        ax.scatter(dx[~safe], ve[~safe], label="Collision", color=colors[0], marker=shape, s=20)
+        ax.scatter(dx[safe], ve[safe], label="No collision", color=colors[1], marker=shape, s=20)
+        ax.set_ylabel('Ego speed (ve)')
+        ax.set_title(f'Ego: {"rightmost lane" if rightmost_lane else "adjacent lane"}, '
+                     f'vo = {(int)(vo * 3.6)}, {policy if policy is not None else "human brake only"}')
+    axes[-1, 0].set_xlabel('Longitudinal distance (dx0)')
+    axes[0, 0].legend(bbox_to_anchor=(0.82, 0.8))
+    plt.tight_layout()
+    plt.show()
+
+def certified_simulation(vo, rightmost_lane=True, resolution=(0.25, 0.5), output=None, driver=None):
+    """
+    Same benchmark as simulation(), but whole boxes of (dx0, ve) are certified safe or
+    collision at once, and undecided boxes are split (see certify.Certifier).
+    Unlike point samples, a certified box holds for every point inside it.
+    :param vo: NPC speed in m/s
+    :param resolution: size of the smallest boxes, (dx0 in m, ve in km/h)
+    :param output: if given, npz file in which the boxes and their status are saved
+    :param driver: DriverModel, default: the benchmark constants
+    """
+    certifier = certify.Certifier(trajectory_library(vo, rightmost_lane=rightmost_lane, driver=driver))
+    leaves = certifier.run((9, 50), (14/3.6, 50/3.6), (resolution[0], resolution[1]/3.6))
+    undecided = sum((b - a) * (d - c) for (a, b), (c, d), status in leaves if status == certify.UNDECIDED)
+    print(f"{len(leaves)} boxes, undecided area: {100 * undecided / ((50 - 9) * (50 - 14)/3.6):.1f}%")
+    if output:
+        certify.save_boxes(output, leaves)
+
+    colors = ['r', 'g', 'orange']
+    plt.figure(dpi=200, figsize=(10,4.0))
+    certify.plot_boxes(plt.gca(), leaves, 3.6, colors)
+    plt.xlabel('Longitudinal distance (dx0)')
+    plt.ylabel('Ego speed (ve)')
+    plt.title(f'Ego: {"rightmost lane" if rightmost_lane else "adjacent lane"}, '
+              f'vo = {(int)(vo * 3.6)}')
+    plt.legend(handles=[Patch(color=colors[0], label="Certified collision"),
+                        Patch(color=colors[1], label="Certified no collision"),
+                        Patch(color=colors[2], label="Undecided")],
+               bbox_to_anchor=(0.82, 0.8))
+    plt.show()
+
 def cli_parser():
     parser = argparse.ArgumentParser(description='Simulation to Construct '
                                                  'Safety reference benchmark for U-turn scenarios.')
@@ -161,6 +332,31 @@ def cli_parser():
                       help='NPC Speed in km/h (default: 10)')
     parser.add_argument('-l', '--lane', default="rightmost",
                       help='either `rightmost` or `adjacent` (default: rightmost)')
+    parser.add_argument('--library', action='store_true',
+                      help='integrate the NPC and ego trajectories once and reuse them '
+                           'for all grid cells (same results, much faster)')
+    parser.add_argument('--adaptive', action='store_true',
+                      help='refine the map only around the collision boundary, '
+                           'instead of the uniform grid')
+    parser.add_argument('--certify', action='store_true',
+                      help='certify whole boxes of initial conditions as safe or collision, '
+                           'instead of simulating points')
+    parser.add_argument('--resolution', type=float, nargs=2, default=[0.25, 0.5],
+                      metavar=('DX0', 'VE'),
+                      help='finest cell size with --adaptive or --certify, '
+                           'dx0 in m and ve in km/h (default: 0.25 0.5)')
+    parser.add_argument('-o', '--output',
+                      help='with --adaptive or --certify, npz file to save the refined map to')
+    parser.add_argument('--severity', metavar='FILE',
+                      help='also save the map with the contact time, ego speed and relative speed '
+                           'at impact of each cell to this npz file')
+    parser.add_argument('--aeb-ttc', type=float, nargs='+', default=[], metavar='SECONDS',
+                      help='also benchmark an ego with AEB triggered at each of these TTC thresholds')
+    parser.add_argument('--aeb-distance', type=float, nargs='+', default=[], metavar='METERS',
+                      help='also benchmark an ego with AEB triggered at each of these distance thresholds')
+    parser.add_argument('--driver', metavar='FILE',
+                      help='JSON file of the driver model parameters, e.g., written by '
+                           '../trace-analysis/calibration.py (default: the constants of common.py)')
     return parser
 
 if __name__ == '__main__':
@@ -172,4 +368,15 @@ if __name__ == '__main__':
         print("[WARNING] Lane must be either `rightmost` or `adjacent`. "
               "Rightmost is used by default")
         rightmost = True
-    simulation(vo, rightmost)
+    driver = DriverModel.load(cli_args.driver) if cli_args.driver else None
+    if cli_args.severity:
+        np.savez_compressed(cli_args.severity, **severity_layers(vo, rightmost, driver=driver))
+        print(f"Written {cli_args.severity}")
+    if cli_args.aeb_ttc or cli_args.aeb_distance:
+        variants_simulation(vo, rightmost, AEB_variants(cli_args.aeb_ttc, cli_args.aeb_distance), driver)
+    elif cli_args.certify:
+        certified_simulation(vo, rightmost, cli_args.resolution, cli_args.output, driver)
+    elif cli_args.adaptive:
+        adaptive_simulation(vo, rightmost, cli_args.library, cli_args.resolution, cli_args.output, driver)
+    else:
+        simulation(vo, rightmost, cli_args.library, driver)
@@ -0,0 +1,177 @@
+import argparse
+import json
+
+import numpy as np
+from matplotlib import pyplot as plt
+from utils import value_range
+
+class AvoidabilityVolume:
+    """
+    Benchmark verdicts over three dimensions: NPC speed vo, a second parameter y
+    (ego speed ve for U-turn, NPC lateral velocity vy for swerve) and dx0.
+    safe[k, j, i] is True if there is no collision for vo_values[k], y_values[j], dx_values[i].
+
+    Between two sampled NPC speeds, the verdicts are linearly interpolated and thresholded
+    at 0.5, so a slice at any vo is a blend of the two nearest sampled maps.
+    """
+    def __init__(self, vo_values, y_values, dx_values, safe, metadata=None):
+        """
+        :param vo_values: sorted NPC speeds, in km/h
+        :param y_values: sorted values of the second parameter
+        :param dx_values: sorted initial longitudinal distances, in m
+        :param safe: boolean array (len(vo_values), len(y_values), len(dx_values))
+        :param metadata: dictionary, e.g., scenario, lane, ve, axis labels
+        """
+        self.vo_values = np.asarray(vo_values, dtype=float)
+        self.y_values = np.asarray(y_values, dtype=float)
+        self.dx_values = np.asarray(dx_values, dtype=float)
+        self.safe = np.asarray(safe, dtype=bool)
+        self.metadata = metadata if metadata is not None else {}
+
+    def slice(self, vo):
+        """
+        Return the (len(y_values), len(dx_values)) boolean map at NPC speed vo (km/h).
+        """
+        k, w = _axis_weight(self.vo_values, vo)
+        blend = (1 - w) * self.safe[k] + w * self.safe[k + 1] if w > 0 else self.safe[k]
+        return blend >= 0.5
+
+    def is_safe(self, vo, y, dx0):
+        """
+        Verdict at any point inside the sampled volume, by trilinear interpolation.
+        """
+        value = 0.0
+        (k, wk), (j, wj), (i, wi) = [_axis_weight(values, x) for values, x in
+                                     ((self.vo_values, vo), (self.y_values, y), (self.dx_values, dx0))]
+        for dk, fk in ((0, 1 - wk), (1, wk)):
+            for dj, fj in ((0, 1 - wj), (1, wj)):
+                for di, fi in ((0, 1 - wi), (1, wi)):
+                    if fk * fj * fi > 0:
+                        value += fk * fj * fi * self.safe[k + dk, j + dj, i + di]
+        return value >= 0.5
+
+    def save(self, path):
+        """
+        Save to a npz file, with verdicts packed to one bit each.
+        """
+        np.savez_compressed(path, vo=self.vo_values, y=self.y_values, dx=self.dx_values,
+                            safe=np.packbits(self.safe, axis=None), shape=np.array(self.safe.shape),
+                            metadata=json.dumps(self.metadata))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        shape = tuple(data['shape'])
+        safe = np.unpackbits(data['safe'], count=int(np.prod(shape))).reshape(shape).astype(bool)
+        return cls(data['vo'], data['y'], data['dx'], safe, json.loads(str(data['metadata'])))
+
+def _axis_weight(values, x):
+    """
+    Return (i, w) such that x = (1 - w) * values[i] + w * values[i + 1],
+    clamped to the sampled range (w = 0 for a single value).
+    """
+    if len(values) == 1:
+        return 0, 0.0
+    i = int(np.clip(np.searchsorted(values, x, side='right') - 1, 0, len(values) - 2))
+    w = float(np.clip((x - values[i]) / (values[i + 1] - values[i]), 0, 1))
+    return i, w
+
+def uturn_volume(vo_values, ve_values, dx_values, rightmost_lane=True):
+    """
+    U-turn verdicts over (vo, ve, dx0), speeds in km/h, using one trajectory library per vo.
+    """
+    from uturn.uturn import trajectory_library
+
+    safe = np.zeros((len(vo_values), len(ve_values), len(dx_values)), dtype=bool)
+    for k, vo in enumerate(vo_values):
+        lib = trajectory_library(vo / 3.6, rightmost_lane=rightmost_lane)
+        for j, ve in enumerate(ve_values):
+            safe[k, j] = lib.verdicts(dx_values, ve / 3.6)
+        print(f"Done vo = {vo:.2f}")
+    metadata = {'scenario': 'uturn', 'lane': 'rightmost' if rightmost_lane else 'adjacent',
+                'y_label': 'Ego speed (ve)'}
+    return AvoidabilityVolume(vo_values, ve_values, dx_values, safe, metadata)
+
+def swerve_volume(ve, vo_values, vy_values, dx_values):
+    """
+    Swerve verdicts over (vo, vy, dx0) at ego speed ve, speeds in km/h and vy in m/s,
+    using one trajectory library per (vo, vy).
+    """
+    from swerve.swerve import trajectory_library
+
+    if min(vo_values) / 3.6 <= max(vy_values):
+        raise ValueError("The NPC speed must be greater than its lateral velocity")
+    safe = np.zeros((len(vo_values), len(vy_values), len(dx_values)), dtype=bool)
+    for k, vo in enumerate(vo_values):
+        for j, vy in enumerate(vy_values):
+            safe[k, j] = trajectory_library(vo / 3.6, vy).verdicts(dx_values, ve / 3.6)
+        print(f"Done vo = {vo:.2f}")
+    metadata = {'scenario': 'swerve', 've': ve, 'y_label': 'Lateral velocity (vy)'}
+    return AvoidabilityVolume(vo_values, vy_values, dx_values, safe, metadata)
+
+def plot_slice(volume, vo):
+    safe = volume.slice(vo)
+    dx, y = np.meshgrid(volume.dx_values, volume.y_values)
+
+    # draw config
+    shape = ","
+    colors = ['r', 'g', 'orange']
+
+    plt.figure(dpi=200, figsize=(10,4.0))
+    plt.scatter(dx[~safe], y[~safe], label="Collision", color=colors[0], marker=shape, s=5)
+    plt.scatter(dx[safe], y[safe], label="No collision", color=colors[1], marker=shape, s=5)
+    plt.xlabel('Longitudinal distance (dx0)')
+    plt.ylabel(volume.metadata.get('y_label', ''))
+    if volume.metadata.get('scenario') == 'swerve':
+        plt.title(f've = {volume.metadata["ve"]:g}, vo = {vo:g}')
+    else:
+        plt.title(f'Ego: {volume.metadata.get("lane", "rightmost")} lane, vo = {vo:g}')
+    plt.legend(bbox_to_anchor=(0.82, 0.8))
+    plt.show()
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description='Safety reference benchmarks over a continuous range '
+                                                 'of NPC speeds, stored as 3-D avoidability volumes.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    uturn = subparsers.add_parser('uturn', help='compute the volume over (vo, ve, dx0) for U-turn')
+    uturn.add_argument('-l', '--lane', default="rightmost", choices=["rightmost", "adjacent"],
+                       help='either `rightmost` or `adjacent` (default: rightmost)')
+    uturn.add_argument('--ve', type=float, nargs=3, default=[14, 50, 1], metavar=('MIN', 'MAX', 'STEP'),
+                       help='Ego speeds in km/h (default: 14 50 1)')
+    uturn.add_argument('--vo', type=float, nargs=3, default=[5, 20, 0.5], metavar=('MIN', 'MAX', 'STEP'),
+                       help='NPC speeds in km/h (default: 5 20 0.5)')
+    uturn.add_argument('--dx', type=float, nargs=3, default=[9, 50, 0.5], metavar=('MIN', 'MAX', 'STEP'),
+                       help='Longitudinal distances in m (default: 9 50 0.5)')
+
+    swerve = subparsers.add_parser('swerve', help='compute the volume over (vo, vy, dx0) for swerve')
+    swerve.add_argument('-ve', type=float, default=20,
+                        help='AV Speed in km/h (default: 20)')
+    swerve.add_argument('--vy', type=float, nargs=3, default=[0.6, 1.6, 0.02], metavar=('MIN', 'MAX', 'STEP'),
+                        help='NPC lateral velocities in m/s (default: 0.6 1.6 0.02)')
+    swerve.add_argument('--vo', type=float, nargs=3, default=[7, 20, 0.5], metavar=('MIN', 'MAX', 'STEP'),
+                        help='NPC speeds in km/h, above the lateral velocities (default: 7 20 0.5)')
+    swerve.add_argument('--dx', type=float, nargs=3, default=[10, 55, 0.5], metavar=('MIN', 'MAX', 'STEP'),
+                        help='Longitudinal distances in m (default: 10 55 0.5)')
+
+    for subparser in (uturn, swerve):
+        subparser.add_argument('-o', '--output', required=True, help='output npz file')
+
+    view = subparsers.add_parser('slice', help='plot a saved volume at any NPC speed')
+    view.add_argument('input', help='npz file written by the `uturn` or `swerve` command')
+    view.add_argument('-vo', type=float, required=True, help='NPC Speed in km/h')
+    return parser
+
+if __name__ == '__main__':
+    cli_args = cli_parser().parse_args()
+    if cli_args.command == 'slice':
+        plot_slice(AvoidabilityVolume.load(cli_args.input), cli_args.vo)
+    else:
+        if cli_args.command == 'uturn':
+            volume = uturn_volume(value_range(*cli_args.vo), value_range(*cli_args.ve),
+                                  value_range(*cli_args.dx), cli_args.lane == "rightmost")
+        else:
+            volume = swerve_volume(cli_args.ve, value_range(*cli_args.vo), value_range(*cli_args.vy),
+                                   value_range(*cli_args.dx))
+        volume.save(cli_args.output)
+        print(f"Written {cli_args.output}")
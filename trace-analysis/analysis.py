@@ -1,18 +1,22 @@
+import csv
 import json
 import math
 import numpy as np
 from vehicle import Vehicle
 import os, sys, re
+import warnings
 import utils
+import profiling
 from pathlib import Path
 
 UTURN_KEY_STR = "uturn_point"
-UTURN_FILE_PATTERN = r"(?!.*\.meta\.json$)uturn_[A-Za-z0-9_]+\.json"
 
 SWERVE_KEY_STR = "swerve_point"
-SWERVE_FILE_PATTERN = r"(?!.*\.meta\.json$)swerve_[A-Za-z0-9_]+\.json"
 WAYPOINTS_KEY_STR = "waypoints"
 
+# version of the results of process_a_file, to increase when they change, so that persisted results are recomputed
+METRICS_VERSION = 1
+
 
 def is_moving(twist_linear, threshold=1e-3):
     # Compute the magnitude of the velocity vector
@@ -157,82 +161,123 @@ def get_speed(ln_vel):
     ])
     return np.linalg.norm(vel)
 
-def is_collision(data, starting_time=None):
+def actor_sizes(data):
     """
-    Check whether a collision exists
+    Return {actor name: ((length, width), (center x, center y))} from `groundtruth_size`.
     """
-    veh_details = extract_vehicle_sizes(data)
-    npc_details = next(item for item in veh_details if item['name'] == 'npc1')
-    ego_details = next(item for item in veh_details if item['name'] == 'ego')
-    npc_size = (npc_details['size']['x'], npc_details['size']['y'])
-    npc_center = (npc_details['center']['x'], npc_details['center']['y'])
-    ego_size = (ego_details['size']['x'], ego_details['size']['y'])
-    ego_center = (ego_details['center']['x'], ego_details['center']['y'])
+    return {item['name']: ((item['size']['x'], item['size']['y']), (item['center']['x'], item['center']['y']))
+            for item in extract_vehicle_sizes(data)}
+
+def entry_vehicles(entry, sizes):
+    """
+    Return the (name, kinematic) of the vehicles of an entry: the i-th of `groundtruth_vehicles` is `npc{i+1}`.
+    Vehicles without a size in `groundtruth_size` are ignored, with a warning.
+    """
+    vehicles = []
+    for i, kin in enumerate(entry.get('groundtruth_vehicles', [])):
+        name = f'npc{i + 1}'
+        if name in sizes:
+            vehicles.append((name, kin))
+        else:
+            warnings.warn(f"No size for {name}, ignored")
+    return vehicles
+
+def bounding_box(kinematic, size, center, margin=0.0):
+    """
+    Axis-aligned box (min x, min y, max x, max y) containing the footprint in any heading, enlarged by margin.
+    """
+    radius = math.hypot(*center) + math.hypot(*size) / 2 + margin
+    x, y = kinematic['pose']['position']['x'], kinematic['pose']['position']['y']
+    return (x - radius, y - radius, x + radius, y + radius)
 
+def ego_candidates(broad_phase, entry, sizes, time_bound=0.0):
+    """
+    Vehicles of an entry that the broad phase cannot separate from the ego, as a list of (name, kinematic).
+    With time_bound > 0, boxes are enlarged by the distance each actor travels in time_bound
+    at its current speed, so that actors that may collide within time_bound are kept.
+    """
+    ego_kin = entry['groundtruth_ego']
+    actors = [('ego', ego_kin)] + entry_vehicles(entry, sizes)
+    boxes = [bounding_box(kin, *sizes[name], get_speed(kin['twist']['linear']) * time_bound)
+             for name, kin in actors]
+    candidates = [actors[j] for j in broad_phase.pairs_with(0, boxes)]
+    if profiling.active is not None:
+        profiling.active.count('broad_phase', len(candidates))
+    return candidates
+
+def is_collision(data, starting_time=None):
+    """
+    Check whether the ego collides with any vehicle.
+    :return: (collision, timestamp of the first collision or -1, name of the vehicle, e.g., `npc2`, or None)
+    """
+    sizes = actor_sizes(data)
+    broad_phase = utils.SortAndSweep()
     for entry in data['groundtruth_kinematic']:
         timestamp = entry['timestamp']
         if starting_time and timestamp < starting_time:
             continue
+        if profiling.active is not None:
+            profiling.active.count('entries')
 
-        npc_kin = entry['groundtruth_vehicles'][0]
-        ego_kin = entry['groundtruth_ego']
-
-        ego = vehicle(ego_kin, ego_size, ego_center)
-        npc = vehicle(npc_kin, npc_size, npc_center)
-        if Vehicle.is_collision(ego, npc):
-            return True, timestamp
-    return False, -1
+        candidates = ego_candidates(broad_phase, entry, sizes)
+        if not candidates:
+            continue
+        ego = vehicle(entry['groundtruth_ego'], *sizes['ego'])
+        for name, npc_kin in candidates:
+            if Vehicle.is_collision(ego, vehicle(npc_kin, *sizes[name])):
+                return True, timestamp, name
+    return False, -1, None
 
 def min_ttc(data, starting_time=None):
     """
-    Return the minimum TTC between two vehicles.
+    Return the minimum TTC between the ego and any vehicle, and the name of that vehicle
+    (None if no TTC is below the bound).
     If TTC > 3, ignore.
     If A collision occurs, return 0
     """
-    veh_details = extract_vehicle_sizes(data)
-    npc_details = next(item for item in veh_details if item['name'] == 'npc1')
-    ego_details = next(item for item in veh_details if item['name'] == 'ego')
-    npc_size = (npc_details['size']['x'], npc_details['size']['y'])
-    npc_center = (npc_details['center']['x'], npc_details['center']['y'])
-    ego_size = (ego_details['size']['x'], ego_details['size']['y'])
-    ego_center = (ego_details['center']['x'], ego_details['center']['y'])
+    sizes = actor_sizes(data)
+    broad_phase = utils.SortAndSweep()
 
     time_step = 0.01
     time_bound = 3
 
     ttc = float('inf')
+    ttc_actor = None
     for entry in data['groundtruth_kinematic']:
         timestamp = entry['timestamp']
         if starting_time and (
                 timestamp < starting_time or timestamp > starting_time + 10):
             continue
+        if profiling.active is not None:
+            profiling.active.count('entries')
 
-        npc_kin = entry['groundtruth_vehicles'][0]
         ego_kin = entry['groundtruth_ego']
-
-        ego = vehicle(ego_kin, ego_size, ego_center)
-        npc = vehicle(npc_kin, npc_size, npc_center)
-
         ego_vel = np.array((
             ego_kin['twist']['linear']['x'],
             ego_kin['twist']['linear']['y'],
         ))
-        npc_vel = np.array((
-            npc_kin['twist']['linear']['x'],
-            npc_kin['twist']['linear']['y'],
-        ))
-        time = 0
-        while time < time_bound:
-            if Vehicle.is_collision(ego, npc):
-                if time < ttc:
-                    ttc = time
-                break
-
-            ego.advance(ego_vel, time_step)
-            npc.advance(npc_vel, time_step)
-            time += time_step
-
-    return ttc
+        for name, npc_kin in ego_candidates(broad_phase, entry, sizes, time_bound):
+            ego = vehicle(ego_kin, *sizes['ego'])
+            npc = vehicle(npc_kin, *sizes[name])
+            npc_vel = np.array((
+                npc_kin['twist']['linear']['x'],
+                npc_kin['twist']['linear']['y'],
+            ))
+            time = 0
+            while time < time_bound:
+                if Vehicle.is_collision(ego, npc):
+                    if time < ttc:
+                        ttc = time
+                        ttc_actor = name
+                    break
+
+                ego.advance(ego_vel, time_step)
+                npc.advance(npc_vel, time_step)
+                time += time_step
+                if profiling.active is not None:
+                    profiling.active.count('ttc_substeps')
+
+    return ttc, ttc_actor
 
 def get_lastest_gt_info(data, timestamp):
     last_ego_kin = None
@@ -250,72 +295,211 @@ def get_lastest_gt_info(data, timestamp):
 def process_a_file(file_path, file_name=None):
     if not file_name:
         file_name = os.path.basename(file_path)
-    data = load_data(file_path)
+    with profiling.phase('load', file=file_name):
+        data = load_data(file_path)
 
-    if SWERVE_KEY_STR in data['metadata']:
-        start_moment = (behavior_start_moment(data, SWERVE_KEY_STR))
-    else:
-        start_moment = behavior_start_moment(data, UTURN_KEY_STR)
+    with profiling.phase('start_moment'):
+        if SWERVE_KEY_STR in data['metadata']:
+            start_moment = (behavior_start_moment(data, SWERVE_KEY_STR))
+        else:
+            start_moment = behavior_start_moment(data, UTURN_KEY_STR)
 
-    collision, ti = is_collision(data, start_moment)
-    col_str = f"Y ({ti})" if collision else "N"
+    with profiling.phase('collision'):
+        collision, ti, collision_actor = is_collision(data, start_moment)
+    col_str = f"Y ({ti}, {collision_actor})" if collision else "N"
 
     minttc = 0
+    ttc_actor = collision_actor
     speed_at_collide = 0
     if collision:
         ego_k,_ = kinematics_at(ti, data)
         speed_at_collide = get_speed(ego_k['twist']['linear'])
     else:
-        minttc = min_ttc(data, start_moment)
+        with profiling.phase('ttc'):
+            minttc, ttc_actor = min_ttc(data, start_moment)
 
-    dx0 = longitudinal_distance_at(start_moment, data)
+    with profiling.phase('dx0'):
+        dx0 = longitudinal_distance_at(start_moment, data)
 
     ego_kin, npc_kin = kinematics_at(start_moment, data)
     ego_speed = get_speed(ego_kin['twist']['linear'])
     npc_speed = get_speed(npc_kin['twist']['linear'])
 
     return file_name, utils.round_float(dx0), \
-            utils.round_float(ego_speed), utils.round_float(npc_speed), col_str, minttc, speed_at_collide
+            utils.round_float(ego_speed), utils.round_float(npc_speed), col_str, minttc, ttc_actor, speed_at_collide
     
-def process_a_dir(dir_path="../"):
+class ResultStore:
+    """
+    Results of process_a_file persisted in a CSV or JSON file (by its extension), one row per trace,
+    keyed by the identity of the trace (path relative to the file, size, modification time and SHA-256)
+    and METRICS_VERSION. The file is rewritten after each added result, so an interrupted run keeps its results.
+    """
+    FIELDS = ('path', 'size', 'mtime', 'sha256', 'version', 'file_name', 'dx0', 'ego_speed', 'npc_speed',
+              'collision', 'min_ttc', 'ttc_actor', 'speed_at_collide')
+    FLOAT_FIELDS = ('mtime', 'dx0', 'ego_speed', 'npc_speed', 'min_ttc', 'speed_at_collide')
+
+    def __init__(self, path):
+        self.path = path
+        self.folder = os.path.dirname(os.path.abspath(path))
+        self.json = path.endswith('.json')
+        self.rows = {}
+        if os.path.isfile(path):
+            with open(path, 'r', newline='') as f:
+                rows = json.load(f) if self.json else list(csv.DictReader(f))
+            for row in rows:
+                self.rows[row['path']] = self._parse(row)
+
+    def _parse(self, row):
+        row = dict(row)
+        for field in self.FLOAT_FIELDS:
+            row[field] = float(row[field])
+        row['size'], row['version'] = int(row['size']), int(row['version'])
+        if row['ttc_actor'] in ('', 'None'):
+            row['ttc_actor'] = None
+        return row
+
+    def _key(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), self.folder)
+
+    def lookup(self, file_path):
+        """
+        The result of process_a_file for a trace, if it was stored by the current METRICS_VERSION
+        for the same trace: same size and modification time, or else same SHA-256. None otherwise.
+        """
+        row = self.rows.get(self._key(file_path))
+        if row is None or row['version'] != METRICS_VERSION:
+            return None
+        stat = os.stat(file_path)
+        if (row['size'], row['mtime']) != (stat.st_size, stat.st_mtime):
+            if row['size'] != stat.st_size or utils.file_digest(file_path)[0] != row['sha256']:
+                return None
+            row['mtime'] = stat.st_mtime
+            self.save()
+        return tuple(row[field] for field in self.FIELDS[5:])
+
+    def add(self, file_path, result):
+        """
+        Store the result of process_a_file for a trace, and save.
+        """
+        stat = os.stat(file_path)
+        row = dict(zip(self.FIELDS, (self._key(file_path), stat.st_size, stat.st_mtime,
+                                     utils.file_digest(file_path)[0], METRICS_VERSION) + tuple(result)))
+        for field in self.FLOAT_FIELDS:
+            row[field] = float(row[field])
+        self.rows[row['path']] = row
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            if self.json:
+                json.dump(list(self.rows.values()), f, indent=1)
+            else:
+                writer = csv.DictWriter(f, self.FIELDS)
+                writer.writeheader()
+                writer.writerows(self.rows.values())
+        os.replace(tmp_path, self.path)
+
+def stored_process_a_file(file_path, file_name=None, store=None, force=False):
+    """
+    process_a_file, reusing the result in `store` (ResultStore) for a trace unchanged since it was stored,
+    unless `force`. New results are added to the store.
+    """
+    if not file_name:
+        file_name = os.path.basename(file_path)
+    if store is not None and not force:
+        stored = store.lookup(file_path)
+        if stored is not None:
+            return (file_name,) + stored[1:]
+    print(f"Processing file: {file_name}...")
+    with profiling.phase('file', file=file_name):
+        result = process_a_file(file_path, file_name)
+    if store is not None:
+        store.add(file_path, result)
+    return result
+
+def process_a_dir(dir_path="../", store=None, force=False):
     result = []
-    folder = Path(dir_path)
-    for file in sorted(folder.iterdir()):
-        if file.is_file() and (
-            re.fullmatch(SWERVE_FILE_PATTERN, file.name) or
-            re.fullmatch(UTURN_FILE_PATTERN, file.name)):
-            print(f"Processing file: {file.name}...")
-            file_path = os.path.join(dir_path, file.name)
-            result.append(process_a_file(file_path, file.name))
+    for file_path in utils.trace_files(dir_path):
+        result.append(stored_process_a_file(file_path, os.path.basename(file_path), store, force))
+    return result
+
+def process_a_query(query, catalog_path, store=None, force=False):
+    """
+    Process the traces of a catalog (see catalog.py) matching a query, e.g., "swerve, agent=lav_lav, vo=15".
+    Only the matching traces are opened: the metrics cached in the catalog (or else in `store`) are used
+    for the traces unchanged since they were indexed, unless `force`, and Git LFS pointers are skipped.
+    """
+    from catalog import Catalog
+
+    result = []
+    with Catalog(catalog_path) as catalog:
+        for row in catalog.select(query):
+            file_path = catalog.absolute(row['path'])
+            file_name = os.path.relpath(file_path)
+            if row['lfs']:
+                print(f"Skipping Git LFS pointer: {file_name}")
+                continue
+            stat = os.stat(file_path)
+            if not force and row['metrics_version'] == METRICS_VERSION and \
+                    (row['size'], row['mtime']) == (stat.st_size, stat.st_mtime):
+                result.append((file_name, row['dx0'], row['ego_speed'], row['npc_speed'], row['collision'],
+                               row['min_ttc'], row['ttc_actor'], row['speed_at_collide']))
+                continue
+            result.append(stored_process_a_file(file_path, file_name, store, force))
     return result
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Trace analysis.")
-    parser.add_argument("path", help="Path to a JSON trace file or a folder containing JSON files.")
+    parser.add_argument("path", nargs='?', help="Path to a JSON trace file or a folder containing JSON files.")
     parser.add_argument('-u', '--unit', default='m',
                       help='either m (m/s) or km (km/h) (default: m)')
+    parser.add_argument('-q', '--query',
+                      help='process the traces of the catalog matching a query instead of a path, '
+                           'e.g., "swerve, agent=lav_lav, vo=15" (see catalog.py)')
+    parser.add_argument('--catalog', default='traces.db',
+                      help='catalog file built by catalog.py, used with --query (default: traces.db)')
+    parser.add_argument('-r', '--results',
+                      help='CSV or JSON file (by its extension) keeping the results of each trace, '
+                           'which are reused for unchanged traces on later runs')
+    parser.add_argument('--force', action='store_true',
+                      help='process the traces again even if their results are stored')
     
     args = parser.parse_args()
+    if (args.path is None) == (args.query is None):
+        parser.error("either a path or --query is required")
+    if args.query is not None:
+        from catalog import parse_query
+        if not os.path.isfile(args.catalog):
+            parser.error(f"no catalog {args.catalog}, build it with catalog.py index")
+        try:
+            parse_query(args.query)
+        except ValueError as e:
+            parser.error(str(e))
     unit = 'm'
     if args.unit == "km":
         unit = "km"
-    if os.path.isfile(args.path):
-        fn, dx0, ego_speed, npc_speed, str, minttc, speed_at_collide = process_a_file(args.path)
+    store = ResultStore(args.results) if args.results else None
+    if args.path is not None and os.path.isfile(args.path):
+        fn, dx0, ego_speed, npc_speed, str, minttc, ttc_actor, speed_at_collide = \
+            stored_process_a_file(args.path, store=store, force=args.force)
         if unit == "km":
             ego_speed, npc_speed = ego_speed*3.6, npc_speed*3.6
             speed_at_collide = speed_at_collide*3.6
 
-        print("NPC speed, Ego speed, dx0, Is collision, Min TTC, Speed at Collide")
-        print(f'{fn}, {npc_speed:.1f}, {ego_speed:.1f}, {dx0}, {str}, {minttc}, {speed_at_collide}')
+        print("NPC speed, Ego speed, dx0, Is collision, Min TTC, Min TTC actor, Speed at Collide")
+        print(f'{fn}, {npc_speed:.1f}, {ego_speed:.1f}, {dx0}, {str}, {minttc}, {ttc_actor}, {speed_at_collide}')
 
-    elif os.path.isdir(args.path):
-        dir_path = args.path
-        re = process_a_dir(dir_path)
-        print("File name, NPC speed, Ego speed, dx0, Is collision, Min TTC, Speed at Collide")
-        for fn, dx0, ego_speed, npc_speed, str, minttc, speed_at_collide in re:
+    elif args.query is not None or os.path.isdir(args.path):
+        if args.query is not None:
+            re = process_a_query(args.query, args.catalog, store, args.force)
+        else:
+            re = process_a_dir(args.path, store, args.force)
+        print("File name, NPC speed, Ego speed, dx0, Is collision, Min TTC, Min TTC actor, Speed at Collide")
+        for fn, dx0, ego_speed, npc_speed, str, minttc, ttc_actor, speed_at_collide in re:
             if unit == "km":
                 ego_speed, npc_speed = ego_speed*3.6, npc_speed*3.6
                 speed_at_collide = speed_at_collide*3.6
-            print(f'{fn}, {npc_speed:.1f}, {ego_speed:.1f}, {dx0}, {str}, {minttc:.2f}, {speed_at_collide}')
\ No newline at end of file
+            print(f'{fn}, {npc_speed:.1f}, {ego_speed:.1f}, {dx0}, {str}, {minttc:.2f}, {ttc_actor}, {speed_at_collide}')
\ No newline at end of file
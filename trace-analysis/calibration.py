@@ -0,0 +1,370 @@
+"""
+Calibration of the ego braking model of the safety reference benchmarks (../safety-benchmarks,
+common.DriverModel) from recorded traces.
+
+In the benchmarks, the ego keeps its speed until risk_eval_time + braking_pedal_delay after the risk
+is detected, i.e., after the front corner of the NPC on the ego side leaves the NPC lane (and the
+median strip, for the U-turn). Its deceleration then rises linearly to max_deceleration in jerk_time,
+until it stops.
+
+For each trace, the risk detection moment is found with the same rule, and the ego speed along its
+heading, travelled distance and deceleration (recorded acceleration, or derived from the speed) are
+resampled on a uniform grid from that moment. Then:
+- the brake onset, jerk time and peak deceleration of each trace are extracted from its deceleration
+  (10%-90% rise to the peak, extrapolated to a linear ramp);
+- the reaction time (from the risk detection to the brake onset), jerk time and maximum deceleration
+  are fitted by minimizing the error between the recorded and modelled speeds and travelled distances,
+  over the whole collection (one driver model per agent) and optionally per trace.
+  The model is in closed form, so candidate parameter sets are evaluated in batches, as arrays
+  (candidates, traces, samples), and the search is a cross-entropy method started from the extracted values.
+
+The reaction time is split into the risk evaluation time, kept fixed, and the braking pedal delay.
+The driver model is written as JSON, and is used by the benchmarks with `--driver`.
+"""
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from analysis import load_data, is_collision, SWERVE_KEY_STR
+from columnar import Trace
+from metrics import behavior_start_index
+from utils import import_safety_benchmarks, trace_files
+
+FIT_PARAMETERS = ('reaction_time', 'jerk_time', 'max_deceleration')
+# search ranges of the fitted parameters, in s, s and m/s^2
+FIT_BOUNDS = np.array([(0.0, 3.0), (0.05, 2.0), (1.0, 12.0)])
+
+def risk_detection_index(trace, start, threshold):
+    """
+    Index of the first entry from `start` at which a front corner of the NPC is `threshold` or more
+    towards the ego from the NPC center at `start` (should_detect_risk of the benchmarks),
+    None if there is no such entry.
+    """
+    (length, width), _ = trace.size_of('npc1')
+    origin = trace.body_point('npc1')[start]
+    heading = trace.actor('npc1').heading_vectors()[start]
+    normal = np.array((-heading[1], heading[0]))
+    if np.dot(trace.body_point('ego')[start] - origin, normal) < 0:
+        normal = -normal
+    offset = np.max([(trace.body_point('npc1', (length / 2, side * width / 2))[start:] - origin) @ normal
+                     for side in (-1, 1)], axis=0)
+    crossed = np.flatnonzero(offset >= threshold)
+    return start + int(crossed[0]) if len(crossed) else None
+
+class BrakeResponse:
+    """
+    Ego motion of one trace on a uniform grid of times from the risk detection, and its braking features.
+    Samples after the end of the trace or a collision are NaN.
+    """
+    def __init__(self, name, scenario, detection_time, times, speed, distance, deceleration):
+        """
+        :param name: trace file name
+        :param scenario: `uturn` or `swerve`
+        :param detection_time: timestamp of the risk detection, in s
+        :param times: (M,) times from the risk detection, in s
+        :param speed: (M,) ego speed along its heading, in m/s
+        :param distance: (M,) ego travelled distance along its heading at the risk detection, in m
+        :param deceleration: (M,) ego deceleration, in m/s^2
+        """
+        self.name = name
+        self.scenario = scenario
+        self.detection_time = detection_time
+        self.times = times
+        self.speed = speed
+        self.distance = distance
+        self.deceleration = deceleration
+        self.onset = self.jerk_time = self.peak_deceleration = np.nan
+
+    def initial_speed(self):
+        return self.speed[0]
+
+    def extract_features(self, min_deceleration=1.0):
+        """
+        Set the brake onset (from the risk detection), jerk time and peak deceleration.
+        The deceleration is taken as a linear ramp through its 10% and 90% levels.
+        They stay NaN if the peak deceleration is below min_deceleration (no braking).
+        """
+        decel = np.where(np.isnan(self.deceleration), -np.inf, self.deceleration)
+        peak = decel.max()
+        if peak < min_deceleration:
+            return
+        i90 = np.argmax(decel >= 0.9 * peak)
+        below = np.flatnonzero(decel[:i90] < 0.1 * peak)
+        i10 = below[-1] + 1 if len(below) else 0
+        step = self.times[1] - self.times[0]
+        self.peak_deceleration = float(peak)
+        self.jerk_time = float(max((self.times[i90] - self.times[i10]) / 0.8, step))
+        self.onset = float(self.times[i10] - 0.1 * self.jerk_time)
+
+    def to_dict(self):
+        """
+        Features for the JSON output, None if there was no braking.
+        """
+        features = {name: None if np.isnan(value) else value for name, value in
+                    (('onset', self.onset), ('jerk_time', self.jerk_time),
+                     ('peak_deceleration', self.peak_deceleration))}
+        return dict({'file': self.name, 'scenario': self.scenario, 'detection_time': self.detection_time,
+                     'initial_speed': float(self.initial_speed())}, **features)
+
+def brake_response(trace, name, env, horizon=6.0, step=0.02, smoothing=0.2, end_time=None):
+    """
+    Extract the BrakeResponse of a trace, None if the risk is never detected.
+    Only the motion before end_time (e.g., the collision, after which the model does not apply) is used.
+    :param env: environment configuration of the benchmarks (lane width and median strip)
+    :param horizon: duration of the response from the risk detection, in s
+    :param step: sample step of the response, in s
+    :param smoothing: width of the moving average applied to the deceleration, in s
+    """
+    scenario = 'swerve' if SWERVE_KEY_STR in trace.metadata else 'uturn'
+    threshold = env['lane_width'] / 2 + (env['median_strip'] if scenario == 'uturn' else 0)
+    detection = risk_detection_index(trace, behavior_start_index(trace), threshold)
+    if detection is None:
+        return None
+
+    end = len(trace) if end_time is None else max(int(np.searchsorted(trace.timestamps, end_time)), detection + 1)
+    t = trace.timestamps[:end]
+    ego = trace.ego.slice(slice(0, end))
+    heading = ego.heading_vectors()
+    speed = np.einsum('ij,ij->i', ego.velocity[:, :2], heading)
+    if ego.acceleration is not None and not np.isnan(ego.acceleration).all():
+        acceleration = np.einsum('ij,ij->i', ego.acceleration[:, :2], heading)
+    else:
+        acceleration = np.gradient(speed, t)
+    center = trace.body_point('ego')[:end]
+    distance = (center - center[detection]) @ heading[detection]
+
+    times = np.arange(0, horizon + step / 2, step)
+    grid = t[detection] + times
+    window = max(int(round(smoothing / step)), 1)
+    deceleration = -np.convolve(np.interp(grid, t, acceleration), np.ones(window) / window, mode='same')
+    missing = grid > t[-1]
+    resampled = [np.where(missing, np.nan, values)
+                 for values in (np.interp(grid, t, speed), np.interp(grid, t, distance), deceleration)]
+    return BrakeResponse(name, scenario, float(t[detection]), times, *resampled)
+
+def model_motion(params, initial_speed, times):
+    """
+    Closed-form speed and travelled distance of the benchmark ego from the risk detection.
+    :param params: (..., 3) reaction time, jerk time and maximum deceleration
+    :param initial_speed: speed at the risk detection, broadcast against params[..., 0]
+    :param times: (M,) times from the risk detection
+    :return: (speed, distance), of shape params.shape[:-1] + (M,)
+    """
+    reaction, jerk_time, decel = (params[..., i, None] for i in range(3))
+    v0 = np.asarray(initial_speed)[..., None]
+    # braking time at which the ego stops
+    stop = np.where(v0 <= decel * jerk_time / 2, np.sqrt(2 * jerk_time * v0 / decel),
+                    v0 / decel + jerk_time / 2)
+    u = np.minimum(np.maximum(times - reaction, 0), stop)
+    ramp = u < jerk_time
+    speed = v0 - np.where(ramp, decel * u ** 2 / (2 * jerk_time), decel * (u - jerk_time / 2))
+    braking = np.where(ramp, v0 * u - decel * u ** 3 / (6 * jerk_time),
+                       v0 * u - decel * jerk_time ** 2 / 6 - decel * u * (u - jerk_time) / 2)
+    return np.maximum(speed, 0), v0 * np.minimum(times, reaction) + braking
+
+class Fitter:
+    """
+    Squared error between the recorded and modelled motions of a collection of BrakeResponse,
+    evaluated for batches of candidate parameter sets.
+    """
+    def __init__(self, responses, distance_weight=0.1, batch_size=32):
+        """
+        :param distance_weight: weight of the squared distance errors (m^2) relative to the squared speed
+                                errors ((m/s)^2); distance errors accumulate over time, so they are weighted less
+        :param batch_size: candidates evaluated together, each as a (traces, samples) array
+        """
+        self.times = responses[0].times
+        self.speed = np.array([response.speed for response in responses])
+        self.distance = np.array([response.distance for response in responses])
+        self.valid = ~np.isnan(self.speed) & ~np.isnan(self.distance)
+        self.speed = np.where(self.valid, self.speed, 0)
+        self.distance = np.where(self.valid, self.distance, 0)
+        self.initial_speed = self.speed[:, 0]
+        self.distance_weight = distance_weight
+        self.batch_size = batch_size
+
+    def errors(self, candidates):
+        """
+        :param candidates: (K, G, 3) parameter sets, G = 1 for the same set for all traces,
+                           or G = number of traces for one set per trace
+        :return: (K, traces) sums of the weighted squared speed and distance errors
+        """
+        result = np.empty((len(candidates), len(self.speed)))
+        for start in range(0, len(candidates), self.batch_size):
+            batch = candidates[start:start + self.batch_size]
+            speed, distance = model_motion(batch, self.initial_speed, self.times)
+            squared = (speed - self.speed) ** 2 + self.distance_weight * (distance - self.distance) ** 2
+            result[start:start + self.batch_size] = np.where(self.valid, squared, 0).sum(axis=-1)
+        return result
+
+    def loss(self, candidates):
+        """
+        Mean squared error of each candidate (K, G): over all traces if G = 1, per trace otherwise.
+        """
+        errors = self.errors(candidates)
+        counts = self.valid.sum(axis=1)
+        if candidates.shape[1] == 1:
+            return errors.sum(axis=1, keepdims=True) / counts.sum()
+        return errors / counts
+
+    def fit(self, initial, population=256, iterations=30, elite=0.1, seed=0):
+        """
+        Cross-entropy minimization of the loss within FIT_BOUNDS: each iteration draws a batch of
+        candidates from a normal distribution, then moves it to the mean and spread of the best ones.
+        :param initial: (G, 3) starting parameters, see loss
+        :return: ((G, 3) best parameters, (G,) their mean squared error)
+        """
+        rng = np.random.default_rng(seed)
+        low, high = FIT_BOUNDS[:, 0], FIT_BOUNDS[:, 1]
+        mean = np.clip(np.asarray(initial, dtype=float), low, high)
+        std = np.broadcast_to((high - low) / 4, mean.shape)
+        best, best_loss = mean.copy(), self.loss(mean[None])[0]
+        n_elite = max(int(population * elite), 2)
+        groups = np.arange(len(mean))
+        for _ in range(iterations):
+            candidates = np.clip(rng.normal(mean, std, (population,) + mean.shape), low, high)
+            candidates[0] = best
+            losses = self.loss(candidates)
+            order = np.argsort(losses, axis=0)[:n_elite]
+            elites = np.take_along_axis(candidates, order[..., None], axis=0)
+            mean, std = elites.mean(axis=0), elites.std(axis=0)
+            best, best_loss = elites[0], losses[order[0], groups]
+        return best, best_loss
+
+def benchmark_common():
+    """
+    The `common` module of the benchmarks (DriverModel, env_configs), imported when first used.
+    """
+    return import_safety_benchmarks('common')
+
+def driver_model(params, risk_eval_time=None):
+    """
+    DriverModel of fitted (reaction time, jerk time, maximum deceleration). The reaction time is
+    split into risk_eval_time (by default, the one of the benchmarks) and the braking pedal delay;
+    if it is shorter than risk_eval_time, the risk evaluation time is reduced to it.
+    """
+    common = benchmark_common()
+    if risk_eval_time is None:
+        risk_eval_time = common.RISK_EVAL_TIME
+    reaction, jerk_time, max_deceleration = (float(value) for value in params)
+    risk_eval_time = min(risk_eval_time, reaction)
+    return common.DriverModel(jerk_time=jerk_time, max_deceleration=max_deceleration,
+                              braking_pedal_delay=reaction - risk_eval_time, risk_eval_time=risk_eval_time)
+
+def benchmark_params(driver=None):
+    """
+    (reaction time, jerk time, maximum deceleration) of a DriverModel, by default of the benchmarks.
+    """
+    driver = driver if driver is not None else benchmark_common().DriverModel()
+    return np.array((driver.risk_eval_time + driver.braking_pedal_delay, driver.jerk_time, driver.max_deceleration))
+
+def initial_params(responses):
+    """
+    Starting parameters of the fit for each trace, from its extracted features,
+    or from the median over the collection (the benchmark model if none braked).
+    """
+    features = np.array([(response.onset, response.jerk_time, response.peak_deceleration)
+                         for response in responses])
+    median = np.nanmedian(features, axis=0) if not np.isnan(features).all() else benchmark_params()
+    return np.where(np.isnan(features), median, features), median
+
+def _load(task):
+    path, env, horizon, step, smoothing = task
+    data = load_data(path)
+    collision, collision_time, _ = is_collision(data)
+    response = brake_response(Trace.from_dict(data), os.path.basename(path), env, horizon, step, smoothing,
+                              collision_time if collision else None)
+    if response is not None:
+        response.extract_features()
+    return path, response
+
+def plot_fit(responses, params, count=20):
+    from matplotlib import pyplot as plt
+
+    plt.figure(dpi=200, figsize=(10, 4.0))
+    for i, response in enumerate(responses[:count]):
+        speed, _ = model_motion(params[min(i, len(params) - 1)], response.initial_speed(), response.times)
+        plt.plot(response.times, response.speed, color='gray', linewidth=0.8,
+                 label='Recorded' if i == 0 else None)
+        plt.plot(response.times, speed, color='r', linestyle='--', linewidth=0.8,
+                 label='Fitted model' if i == 0 else None)
+    plt.xlabel('Time from risk detection (s)')
+    plt.ylabel('Ego speed (m/s)')
+    plt.legend()
+    plt.show()
+
+def cli_parser():
+    common = benchmark_common()
+    parser = argparse.ArgumentParser(description='Fit the braking parameters of the benchmark driver model '
+                                                 'to recorded U-turn/swerve traces.')
+    parser.add_argument('paths', nargs='+', help='JSON trace files or folders containing them')
+    parser.add_argument('--env', default='awsim', choices=list(common.env_configs),
+                        help='environment configuration, for the risk detection (default: awsim)')
+    parser.add_argument('--risk-eval-time', type=float, default=common.RISK_EVAL_TIME,
+                        help=f'risk evaluation time kept in the driver model, in s (default: {common.RISK_EVAL_TIME})')
+    parser.add_argument('--horizon', type=float, default=6.0,
+                        help='fitted duration from the risk detection, in s (default: 6)')
+    parser.add_argument('--step', type=float, default=0.02, help='resampling step in s (default: 0.02)')
+    parser.add_argument('--smoothing', type=float, default=0.2,
+                        help='moving average of the deceleration, in s (default: 0.2)')
+    parser.add_argument('--distance-weight', type=float, default=0.1,
+                        help='weight of the distance errors relative to the speed errors (default: 0.1)')
+    parser.add_argument('--per-trace', action='store_true', help='also fit each trace separately')
+    parser.add_argument('--population', type=int, default=256,
+                        help='candidate parameter sets per iteration (default: 256)')
+    parser.add_argument('--iterations', type=int, default=30, help='iterations of the fit (default: 30)')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='candidate parameter sets evaluated together (default: 32)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='processes loading the traces (default: 1)')
+    parser.add_argument('-o', '--output', help='JSON file to write the driver model and the per-trace results to')
+    parser.add_argument('--plot', action='store_true', help='plot the recorded and fitted speeds')
+    return parser
+
+if __name__ == '__main__':
+    cli_args = cli_parser().parse_args()
+    env = benchmark_common().env_configs[cli_args.env]
+    tasks = [(path, env, cli_args.horizon, cli_args.step, cli_args.smoothing)
+             for path in trace_files(cli_args.paths)]
+    responses = []
+    with Pool(cli_args.jobs) as pool:
+        for path, response in pool.imap(_load, tasks):
+            if response is None:
+                print(f"[WARNING] {path}: no risk detected, skipped")
+            else:
+                responses.append(response)
+    if not responses:
+        raise SystemExit("No trace to calibrate")
+
+    print("File name, Scenario, Ego speed, Brake onset, Jerk time, Peak deceleration")
+    for response in responses:
+        print(f"{response.name}, {response.scenario}, {response.initial_speed():.2f}, "
+              f"{response.onset:.3f}, {response.jerk_time:.3f}, {response.peak_deceleration:.2f}")
+
+    fitter = Fitter(responses, cli_args.distance_weight, cli_args.batch_size)
+    initial, median = initial_params(responses)
+    params, loss = fitter.fit(median[None], cli_args.population, cli_args.iterations, seed=cli_args.seed)
+    driver = driver_model(params[0], cli_args.risk_eval_time)
+    benchmark_loss = fitter.loss(benchmark_params()[None, None])[0, 0]
+    print(f"Reaction time {params[0, 0]:.3f} s, jerk time {params[0, 1]:.3f} s, "
+          f"max deceleration {params[0, 2]:.2f} m/s^2")
+    print(f"RMS error: {np.sqrt(loss[0]):.3f} (benchmark driver model: {np.sqrt(benchmark_loss):.3f})")
+    print(driver)
+
+    results = [response.to_dict() for response in responses]
+    if cli_args.per_trace:
+        trace_params, trace_loss = fitter.fit(initial, cli_args.population, cli_args.iterations,
+                                              seed=cli_args.seed)
+        for result, values, error in zip(results, trace_params, trace_loss):
+            result['fit'] = dict(zip(FIT_PARAMETERS, values.tolist()), rms_error=float(np.sqrt(error)))
+    if cli_args.output:
+        with open(cli_args.output, 'w') as f:
+            json.dump({'driver': driver.to_dict(), 'fit': dict(zip(FIT_PARAMETERS, params[0].tolist()),
+                                                               rms_error=float(np.sqrt(loss[0]))),
+                       'env': cli_args.env, 'traces': results}, f, indent=2)
+        print(f"Written {cli_args.output}")
+    if cli_args.plot:
+        plot_fit(responses, trace_params if cli_args.per_trace else params)
@@ -0,0 +1,314 @@
+"""
+SQLite catalog of the recorded traces, so that the traces of a scenario, agent or speed can be selected
+without opening (or fetching from Git LFS) any trace.
+
+The scenario parameters are only encoded in the paths:
+- CARLA agents: `<run>/uturn_<agent>_<lane>_<vo>.json` and `<run>/swerve_<agent>_<vo>_<vy*10>.json`,
+  replayable with the `.log` file of the same name;
+- Autoware: `<lane>-lane/<run>/uturn_simN.json` and `vo-<vo>/<run>/swerve_simN.json`, where simN was
+  recorded with the N-th script file (in the order of the speeds) of `scripts/<lane>-lane` or `scripts/vo-<vo>`,
+  named `uturn-<ve>-<vo>.script` or `swerve-<ve>-<vo>-<vy*10>.script`; the shielded Autoware results use
+  the scripts of the baseline results. The camera footage is in `uturn_simN_footage.mp4`/`.meta.json`.
+Speeds are in km/h and lateral velocities in m/s, as in the file names.
+
+Each trace gets a row with these parameters, the paths of its script, log and footage files,
+its size, modification time and SHA-256 (the object id for a Git LFS pointer), whether it is a Git LFS pointer
+and, once computed, the summary metrics of analysis.process_a_file.
+Paths are stored relative to the folder of the catalog.
+"""
+import argparse
+import os
+import re
+import sqlite3
+from multiprocessing import Pool
+from pathlib import Path
+
+from analysis import process_a_file, METRICS_VERSION
+from utils import file_digest, trace_files
+
+DEFAULT_PATH = 'traces.db'
+
+# (name, SQL type) of the columns of the `traces` table
+COLUMNS = (
+    ('path', 'TEXT PRIMARY KEY'),
+    ('scenario', 'TEXT'),
+    ('agent', 'TEXT'),
+    ('lane', 'TEXT'),
+    ('ve', 'REAL'),
+    ('vo', 'REAL'),
+    ('vy', 'REAL'),
+    ('run', 'INTEGER'),
+    ('sim', 'INTEGER'),
+    ('script', 'TEXT'),
+    ('log', 'TEXT'),
+    ('meta', 'TEXT'),
+    ('video', 'TEXT'),
+    ('size', 'INTEGER'),
+    ('mtime', 'REAL'),
+    ('sha256', 'TEXT'),
+    ('lfs', 'INTEGER'),
+    # summary metrics of analysis.process_a_file, NULL until computed
+    ('dx0', 'REAL'),
+    ('ego_speed', 'REAL'),
+    ('npc_speed', 'REAL'),
+    ('collision', 'TEXT'),
+    ('collided', 'INTEGER'),
+    ('min_ttc', 'REAL'),
+    ('ttc_actor', 'TEXT'),
+    ('speed_at_collide', 'REAL'),
+    ('metrics_version', 'INTEGER'),
+)
+NAMES = [name for name, _ in COLUMNS]
+
+CARLA_UTURN = re.compile(r'uturn_(?P<agent>[a-z]+_[a-z]+)_(?P<lane>[a-z]+)_(?P<vo>\d+)\.json')
+CARLA_SWERVE = re.compile(r'swerve_(?P<agent>[a-z]+_[a-z]+)_(?P<vo>\d+)_(?P<vy>\d+)\.json')
+AUTOWARE_TRACE = re.compile(r'(?P<scenario>uturn|swerve)_sim(?P<sim>\d+)\.json')
+UTURN_SCRIPT = re.compile(r'uturn-(?P<ve>\d+)-(?P<vo>\d+)\.script')
+SWERVE_SCRIPT = re.compile(r'swerve-(?P<ve>\d+)-(?P<vo>\d+)-(?P<vy>\d+)\.script')
+RUN_FOLDER = re.compile(r'run(\d+)')
+LANE_FOLDER = re.compile(r'([a-z]+)-lane')
+VO_FOLDER = re.compile(r'vo-(\d+)')
+
+def _scenario_folder(path):
+    for folder in path.parents:
+        if folder.name in ('u-turn', 'swerve'):
+            return folder
+    return None
+
+def script_files(trace_path):
+    """
+    The script files of the Autoware experiment of a trace, in the order of the simulations (simN is the N-th),
+    or an empty list if they are not found.
+    """
+    scenario = _scenario_folder(trace_path)
+    if scenario is None:
+        return []
+    group = trace_path.parent.parent.name
+    candidates = [scenario / 'scripts' / group,
+                  scenario.parent.parent / 'Autoware-baseline-results' / scenario.name / 'scripts' / group]
+    for folder in candidates:
+        if folder.is_dir():
+            return sorted((file for file in folder.iterdir() if file.suffix == '.script'),
+                          key=lambda file: [int(n) for n in re.findall(r'\d+', file.name)])
+    return []
+
+def trace_params(trace_path):
+    """
+    Scenario parameters of a trace from its path, as a dict of the catalog columns (missing when unknown).
+    """
+    name = trace_path.name
+    params = {'scenario': 'uturn' if name.startswith('uturn') else 'swerve'}
+    run = RUN_FOLDER.fullmatch(trace_path.parent.name)
+    if run:
+        params['run'] = int(run.group(1))
+
+    carla = CARLA_UTURN.fullmatch(name) or CARLA_SWERVE.fullmatch(name)
+    if carla:
+        params.update(agent=carla.group('agent'), vo=float(carla.group('vo')))
+        if 'lane' in carla.groupdict():
+            params['lane'] = carla.group('lane')
+        else:
+            params['vy'] = int(carla.group('vy')) / 10
+        return params
+
+    autoware = AUTOWARE_TRACE.fullmatch(name)
+    if not autoware:
+        return params
+    shielded = any('shielding' in folder.name for folder in trace_path.parents)
+    params.update(agent='autoware_shielded' if shielded else 'autoware', sim=int(autoware.group('sim')))
+    group = trace_path.parent.parent.name
+    lane, vo = LANE_FOLDER.fullmatch(group), VO_FOLDER.fullmatch(group)
+    if lane:
+        params['lane'] = lane.group(1)
+    elif vo:
+        params['vo'] = float(vo.group(1))
+    scripts = script_files(trace_path)
+    if params['sim'] <= len(scripts):
+        script = scripts[params['sim'] - 1]
+        match = UTURN_SCRIPT.fullmatch(script.name) or SWERVE_SCRIPT.fullmatch(script.name)
+        if match:
+            params.update(script=str(script), ve=float(match.group('ve')), vo=float(match.group('vo')))
+            if 'vy' in match.groupdict():
+                params['vy'] = int(match.group('vy')) / 10
+    return params
+
+def trace_record(trace_path):
+    """
+    Catalog row of a trace, without the metrics, as a dict with absolute paths.
+    """
+    record = trace_params(trace_path)
+    for column, suffix in (('log', '.log'), ('meta', '_footage.meta.json'), ('video', '_footage.mp4')):
+        companion = trace_path.with_name(trace_path.stem + suffix)
+        if companion.is_file():
+            record[column] = str(companion)
+    stat = trace_path.stat()
+    sha256, lfs = file_digest(trace_path)
+    record.update(path=str(trace_path), size=stat.st_size, mtime=stat.st_mtime, sha256=sha256, lfs=int(lfs))
+    return record
+
+def trace_metrics(path):
+    """
+    Summary metrics of analysis.process_a_file, as a dict of the catalog columns.
+    """
+    _, dx0, ego_speed, npc_speed, collision, minttc, ttc_actor, speed_at_collide = process_a_file(path)
+    return {'dx0': dx0, 'ego_speed': ego_speed, 'npc_speed': npc_speed, 'collision': collision,
+            'collided': int(collision != 'N'), 'min_ttc': float(minttc), 'ttc_actor': ttc_actor,
+            'speed_at_collide': float(speed_at_collide), 'metrics_version': METRICS_VERSION}
+
+def _trace_metrics(path):
+    """
+    trace_metrics in a worker: (metrics, None), or (None, error) for a trace that cannot be processed.
+    """
+    try:
+        return trace_metrics(path), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+class Catalog:
+    """
+    The `traces` table of a SQLite file.
+    """
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.folder = os.path.dirname(os.path.abspath(path))
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS traces "
+                                f"({', '.join(f'{name} {kind}' for name, kind in COLUMNS)})")
+        # columns added since the catalog was created
+        existing = {row['name'] for row in self.connection.execute("PRAGMA table_info(traces)")}
+        for name, kind in COLUMNS:
+            if name not in existing:
+                self.connection.execute(f"ALTER TABLE traces ADD COLUMN {name} {kind}")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def relative(self, path):
+        return os.path.relpath(path, self.folder)
+
+    def absolute(self, path):
+        return os.path.normpath(os.path.join(self.folder, path))
+
+    def index(self, roots, metrics=False, jobs=1):
+        """
+        Add the traces under the given folders, or update their rows. The rows of unchanged traces
+        (same size and modification time) are kept with their metrics; the others are hashed again.
+        :param metrics: also compute the metrics missing in the rows, except for Git LFS pointers
+        :return: (number of traces, number of new or changed rows)
+        """
+        files = [Path(file).resolve() for file in trace_files(roots, recursive=True)]
+        changed = 0
+        for file in files:
+            path = self.relative(file)
+            stat = file.stat()
+            row = self.connection.execute("SELECT size, mtime FROM traces WHERE path = ?", (path,)).fetchone()
+            if row is not None and (row['size'], row['mtime']) == (stat.st_size, stat.st_mtime):
+                continue
+            record = trace_record(file)
+            for column in ('path', 'script', 'log', 'meta', 'video'):
+                if column in record:
+                    record[column] = self.relative(record[column])
+            values = [record.get(name) for name in NAMES]
+            self.connection.execute(f"INSERT OR REPLACE INTO traces VALUES ({', '.join('?' * len(NAMES))})", values)
+            changed += 1
+        self.connection.commit()
+        if metrics:
+            self.update_metrics(jobs)
+        return len(files), changed
+
+    def update_metrics(self, jobs=1, batch=32):
+        """
+        Compute the missing or outdated (other METRICS_VERSION) metrics of the traces that are not Git LFS pointers.
+        Traces that cannot be processed are reported and left without metrics; the rows are committed
+        every `batch` traces, so an interrupted pass keeps the metrics computed so far.
+        """
+        paths = [row['path'] for row in self.connection.execute(
+            "SELECT path FROM traces WHERE (metrics_version IS NULL OR metrics_version != ?) AND lfs = 0 "
+            "ORDER BY path", (METRICS_VERSION,))]
+        with Pool(jobs) as pool:
+            tasks = [self.absolute(path) for path in paths]
+            for i, (path, (values, error)) in enumerate(zip(paths, pool.imap(_trace_metrics, tasks))):
+                if values is None:
+                    print(f"[WARNING] {self.absolute(path)}: no metrics ({error})")
+                else:
+                    self.connection.execute(f"UPDATE traces SET {', '.join(f'{name} = ?' for name in values)} "
+                                            f"WHERE path = ?", list(values.values()) + [path])
+                if (i + 1) % batch == 0:
+                    self.connection.commit()
+        self.connection.commit()
+
+    def select(self, query=''):
+        """
+        :param query: see parse_query, e.g., "swerve, agent=lav_lav, vo=15"
+        :return: the matching rows (sqlite3.Row), ordered by path
+        """
+        conditions, values = parse_query(query)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self.connection.execute(f"SELECT * FROM traces{where} ORDER BY path", values).fetchall()
+
+def parse_query(query):
+    """
+    Turn a query into SQL conditions on the catalog columns.
+    :param query: comma-separated terms: `all`, a scenario (`uturn`, `u-turn` or `swerve`), or a comparison
+        `<column><op><value>` with op in =, !=, <, <=, >, >= (e.g., `agent=lav_lav`, `vo>=15`, `collided=1`)
+    :return: (list of conditions, list of values)
+    """
+    conditions, values = [], []
+    for term in query.split(','):
+        term = term.strip()
+        if not term or term == 'all':
+            continue
+        if term in ('uturn', 'u-turn', 'swerve'):
+            term = f"scenario={term.replace('-', '')}"
+        match = re.fullmatch(r'(\w+)\s*(!=|<=|>=|=|<|>)\s*(.+)', term)
+        if not match:
+            raise ValueError(f"Invalid query term: {term}")
+        name, op, value = match.groups()
+        if name not in NAMES:
+            raise ValueError(f"Unknown column {name}, expected one of: {', '.join(NAMES)}")
+        try:
+            value = float(value)
+        except ValueError:
+            value = value.strip()
+        conditions.append(f"{name} {op} ?")
+        values.append(value)
+    return conditions, values
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description='SQLite catalog of the recorded traces.')
+    parser.add_argument('-d', '--database', default=DEFAULT_PATH, help=f'catalog file (default: {DEFAULT_PATH})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index = subparsers.add_parser('index', help='add the traces of folders to the catalog')
+    index.add_argument('roots', nargs='+', help='folders containing the traces, searched recursively')
+    index.add_argument('--metrics', action='store_true',
+                       help='also compute the summary metrics of analysis.py (not for Git LFS pointers)')
+    index.add_argument('-j', '--jobs', type=int, default=1, help='parallel processes (default: 1)')
+
+    query = subparsers.add_parser('query', help='list the traces matching a query')
+    query.add_argument('query', nargs='?', default='all',
+                       help='comma-separated terms, e.g., "swerve, agent=lav_lav, vo=15" (default: all)')
+    query.add_argument('-c', '--columns', default='path,scenario,agent,lane,ve,vo,vy,run,lfs',
+                       help='comma-separated columns to print (default: path,scenario,agent,lane,ve,vo,vy,run,lfs)')
+    return parser
+
+if __name__ == '__main__':
+    cli_args = cli_parser().parse_args()
+    with Catalog(cli_args.database) as catalog:
+        if cli_args.command == 'index':
+            count, changed = catalog.index(cli_args.roots, cli_args.metrics, cli_args.jobs)
+            print(f"Indexed {count} traces ({changed} new or changed) in {cli_args.database}")
+        else:
+            columns = cli_args.columns.split(',')
+            rows = catalog.select(cli_args.query)
+            print(", ".join(columns))
+            for row in rows:
+                print(", ".join(str(row[column]) for column in columns))
+            print(f"{len(rows)} traces")
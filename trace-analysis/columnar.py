@@ -0,0 +1,188 @@
+import numpy as np
+
+class ActorTrack:
+    """
+    Kinematics of one actor over a whole trace, stored as one array per quantity.
+    Row i of every array corresponds to Trace.timestamps[i].
+    Rows in which the actor was not present are filled with NaN.
+    """
+    def __init__(self, name, position, rotation, velocity, acceleration=None):
+        """
+        :param name: actor name as used in `groundtruth_size`, e.g., `ego` or `npc1`
+        :param position: (T, 3) array, world frame, in m
+        :param rotation: (T, 3) array of (roll, pitch, yaw), in degrees
+        :param velocity: (T, 3) array of linear velocity, in m/s
+        :param acceleration: (T, 3) array of linear acceleration in m/s^2, or None if not recorded
+        """
+        self.name = name
+        self.position = np.asarray(position, dtype=float)
+        self.rotation = np.asarray(rotation, dtype=float)
+        self.velocity = np.asarray(velocity, dtype=float)
+        self.acceleration = None if acceleration is None else np.asarray(acceleration, dtype=float)
+
+    def __len__(self):
+        return len(self.position)
+
+    def heading_deg(self):
+        return self.rotation[:, 2]
+
+    def heading_vectors(self):
+        """
+        (T, 2) unit vectors of the headings.
+        """
+        theta = np.radians(self.heading_deg())
+        return np.stack((np.cos(theta), np.sin(theta)), axis=1)
+
+    def speed(self):
+        return np.linalg.norm(self.velocity, axis=1)
+
+    def slice(self, index):
+        return ActorTrack(self.name, self.position[index], self.rotation[index],
+                          self.velocity[index],
+                          None if self.acceleration is None else self.acceleration[index])
+
+def _kinematic_row(kin):
+    pos = kin['pose']['position']
+    rot = kin['pose']['rotation']
+    vel = kin['twist']['linear']
+    return (pos['x'], pos['y'], pos['z'],
+            rot['x'], rot['y'], rot['z'],
+            vel['x'], vel['y'], vel['z'])
+
+def _vector_dict(row):
+    return {'x': float(row[0]), 'y': float(row[1]), 'z': float(row[2])}
+
+class Trace:
+    """
+    Columnar representation of a recorded trace.
+    The JSON traces store one dictionary per timestamp; here each kinematic quantity of
+    each actor is a numpy array over the whole trace, which is what vectorized metrics need.
+    """
+    def __init__(self, timestamps, ego, vehicles, sizes, metadata=None):
+        """
+        :param timestamps: (T,) array, in seconds
+        :param ego: ActorTrack of the ego vehicle
+        :param vehicles: list of ActorTrack, one per other vehicle (`npc1`, `npc2`, ...)
+        :param sizes: list of shape dictionaries, in the `groundtruth_size` format
+        :param metadata: scenario metadata dictionary, e.g., U-turn/swerve waypoints
+        """
+        self.timestamps = np.asarray(timestamps, dtype=float)
+        self.ego = ego
+        self.vehicles = vehicles
+        self.sizes = sizes
+        self.metadata = metadata if metadata is not None else {}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def actor(self, name):
+        if name == 'ego':
+            return self.ego
+        return next(veh for veh in self.vehicles if veh.name == name)
+
+    def size_of(self, name):
+        """
+        Return ((length, width), (center x, center y)) of an actor.
+        """
+        details = next(item for item in self.sizes if item['name'] == name)
+        return ((details['size']['x'], details['size']['y']),
+                (details['center']['x'], details['center']['y']))
+
+    def body_point(self, name, offset=(0.0, 0.0)):
+        """
+        World positions (T, 2) of a point of the body of an actor, given in its vehicle frame
+        relative to its center (the trace positions are reference points, see vehicle.Vehicle).
+        """
+        track = self.actor(name)
+        _, center = self.size_of(name)
+        heading = track.heading_vectors()
+        normal = np.stack((-heading[:, 1], heading[:, 0]), axis=1)
+        a, b = np.add(center, offset)
+        return track.position[:, :2] + a * heading + b * normal
+
+    def footprint(self, name):
+        """
+        Corners (T, 4, 2) of the footprint of an actor, in the order of vehicle.Vehicle.get_vertices.
+        """
+        (length, width), _ = self.size_of(name)
+        corners = [(length / 2, width / 2), (-length / 2, width / 2),
+                   (-length / 2, -width / 2), (length / 2, -width / 2)]
+        return np.stack([self.body_point(name, corner) for corner in corners], axis=1)
+
+    def slice(self, index):
+        """
+        Return a new Trace restricted to the rows selected by `index` (slice or mask).
+        """
+        return Trace(self.timestamps[index], self.ego.slice(index),
+                     [veh.slice(index) for veh in self.vehicles],
+                     self.sizes, self.metadata)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a Trace from a loaded JSON trace (see analysis.load_data).
+        """
+        entries = data['groundtruth_kinematic']
+        count = len(entries)
+        n_vehicles = max((len(entry.get('groundtruth_vehicles', [])) for entry in entries), default=0)
+
+        timestamps = np.fromiter((entry['timestamp'] for entry in entries), dtype=float, count=count)
+        ego_rows = np.array([_kinematic_row(entry['groundtruth_ego']) for entry in entries],
+                            dtype=float).reshape(count, 9)
+        ego_acc = None
+        if count and 'acceleration' in entries[0]['groundtruth_ego']:
+            ego_acc = np.array([
+                tuple(entry['groundtruth_ego'].get('acceleration', {})
+                      .get('linear', {'x': np.nan, 'y': np.nan, 'z': np.nan}).values())
+                for entry in entries], dtype=float)
+        ego = ActorTrack('ego', ego_rows[:, 0:3], ego_rows[:, 3:6], ego_rows[:, 6:9], ego_acc)
+
+        npc_rows = np.full((n_vehicles, count, 9), np.nan)
+        for i, entry in enumerate(entries):
+            for j, kin in enumerate(entry.get('groundtruth_vehicles', [])):
+                npc_rows[j, i] = _kinematic_row(kin)
+        vehicles = [ActorTrack(f'npc{j + 1}', rows[:, 0:3], rows[:, 3:6], rows[:, 6:9])
+                    for j, rows in enumerate(npc_rows)]
+
+        sizes = data['groundtruth_size']
+        if 'vehicle_sizes' in sizes:
+            sizes = sizes['vehicle_sizes']
+        return cls(timestamps, ego, vehicles, sizes, data.get('metadata', {}))
+
+    def to_dict(self):
+        """
+        Convert back to the JSON trace schema, as written by the CARLA scenario scripts.
+        """
+        def kinematic(track, i):
+            entry = {
+                'pose': {
+                    'position': _vector_dict(track.position[i]),
+                    'rotation': _vector_dict(track.rotation[i]),
+                },
+                'twist': {
+                    'linear': _vector_dict(track.velocity[i])
+                }
+            }
+            if track.acceleration is not None:
+                entry['acceleration'] = {'linear': _vector_dict(track.acceleration[i])}
+            return entry
+
+        entries = []
+        for i, timestamp in enumerate(self.timestamps):
+            vehicles = []
+            for veh in self.vehicles:
+                if np.isnan(veh.position[i, 0]):
+                    continue
+                npc_entry = kinematic(veh, i)
+                npc_entry['name'] = "NPC"
+                vehicles.append(npc_entry)
+            entries.append({
+                'timestamp': float(timestamp),
+                'groundtruth_ego': kinematic(self.ego, i),
+                'groundtruth_vehicles': vehicles
+            })
+        return {
+            'groundtruth_kinematic': entries,
+            'groundtruth_size': self.sizes,
+            'metadata': self.metadata
+        }
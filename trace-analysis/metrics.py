@@ -0,0 +1,241 @@
+"""
+Metrics of how the ego braked in recorded U-turn/swerve traces, computed on the kinematic arrays of
+columnar.Trace (no per-entry loops), from the U-turn/swerve start (analysis.behavior_start_moment):
+- reaction latency: from the U-turn/swerve start to the brake onset, when the deceleration reaches
+  a threshold on its rise to the peak deceleration;
+- time to peak deceleration: from the brake onset to the peak deceleration, and the peak deceleration;
+- peak jerk: maximum rate of increase of the deceleration from the brake onset to the peak;
+- minimum distance between the ego and NPC footprints (0 if they collide);
+- post-encroachment time (PET): smallest time between the ego and the NPC occupying the same place,
+  over all pairs of samples (0 if they collide, NaN if their paths do not cross);
+- required deceleration: smallest constant deceleration that avoids the recorded NPC footprints when
+  applied by the ego from the U-turn/swerve start, without reaction time (0 if no braking is needed).
+The brake metrics only use the motion before a collision. The deceleration is the recorded one,
+or derived from the speed when it is not recorded, smoothed by a moving average.
+"""
+import argparse
+import csv
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from analysis import load_data, point_start_moment
+from columnar import Trace
+from utils import trace_files
+
+# (name, unit) of the metrics, in the order of the output columns
+METRICS = (
+    ('reaction_latency', 's'),
+    ('time_to_peak_deceleration', 's'),
+    ('peak_deceleration', 'm/s^2'),
+    ('peak_jerk', 'm/s^3'),
+    ('min_distance', 'm'),
+    ('post_encroachment_time', 's'),
+    ('required_deceleration', 'm/s^2'),
+)
+
+def behavior_start_index(trace):
+    """
+    Index of the entry at which the U-turn/swerve starts, as analysis.behavior_start_moment:
+    the NPC front is closest to the U-turn/swerve point, before passing it.
+    """
+    point = point_start_moment({'metadata': trace.metadata})
+    (length, _), _ = trace.size_of('npc1')
+    vec = point - trace.body_point('npc1', (length / 2, 0))
+    passed = np.flatnonzero(np.einsum('ij,ij->i', vec, trace.actor('npc1').heading_vectors()) < 0)
+    stop = passed[0] if len(passed) else len(trace)
+    if stop == 0:
+        return 0
+    distance = np.linalg.norm(vec[:stop], axis=1)
+    return int(np.argmin(np.where(np.isnan(distance), np.inf, distance)))
+
+def ego_motion(trace, end=None):
+    """
+    Speed and acceleration (T,) of the ego along its heading, up to entry `end` (excluded).
+    The acceleration is the recorded one, or derived from the speed when it was not recorded.
+    """
+    ego = trace.ego if end is None else trace.ego.slice(slice(0, end))
+    heading = ego.heading_vectors()
+    speed = np.einsum('ij,ij->i', ego.velocity[:, :2], heading)
+    if ego.acceleration is not None and not np.isnan(ego.acceleration).all():
+        return speed, np.einsum('ij,ij->i', ego.acceleration[:, :2], heading)
+    if len(speed) < 2:
+        return speed, np.zeros_like(speed)
+    return speed, np.gradient(speed, trace.timestamps[:len(speed)])
+
+def moving_average(values, times, width):
+    """
+    Moving average of samples over `width` seconds, from the median sample step.
+    Near the ends, the average is over the samples of the window that exist.
+    """
+    count = max(int(round(width / np.median(np.diff(times)))), 1) if len(times) > 1 else 1
+    kernel = np.ones(count)
+    return np.convolve(values, kernel, mode='same') / np.convolve(np.ones(len(values)), kernel, mode='same')
+
+def rectangles_overlap(a, b):
+    """
+    Separating axis test of convex quadrilaterals given by their corners in order (..., 4, 2),
+    broadcast against each other. Touching footprints overlap, as in utils.is_collision;
+    missing footprints (NaN, absent actor) do not.
+    """
+    a, b = np.broadcast_arrays(a, b)
+    axes = np.concatenate((a[..., 1:3, :] - a[..., 0:2, :], b[..., 1:3, :] - b[..., 0:2, :]), axis=-2)
+    proj_a = np.einsum('...kd,...vd->...kv', axes, a)
+    proj_b = np.einsum('...kd,...vd->...kv', axes, b)
+    separated = (proj_a.max(axis=-1) < proj_b.min(axis=-1)) | (proj_b.max(axis=-1) < proj_a.min(axis=-1))
+    present = ~(np.isnan(a).any(axis=(-1, -2)) | np.isnan(b).any(axis=(-1, -2)))
+    return ~separated.any(axis=-1) & present
+
+def _vertex_edge_distance(p, q):
+    """
+    Smallest distance from the corners of p to the edges of q, (..., 4, 2) each.
+    """
+    start = q[..., None, :, :]
+    edge = np.roll(q, -1, axis=-2)[..., None, :, :] - start
+    rel = p[..., :, None, :] - start
+    t = np.clip(np.sum(rel * edge, axis=-1) / np.sum(edge * edge, axis=-1), 0, 1)
+    return np.linalg.norm(rel - t[..., None] * edge, axis=-1).min(axis=(-1, -2))
+
+def footprint_distance(a, b):
+    """
+    Distance between convex quadrilaterals (..., 4, 2), 0 where they overlap.
+    """
+    a, b = np.broadcast_arrays(a, b)
+    distance = np.minimum(_vertex_edge_distance(a, b), _vertex_edge_distance(b, a))
+    return np.where(rectangles_overlap(a, b), 0.0, distance)
+
+def _radius(footprints):
+    return np.nanmax(np.linalg.norm(footprints - footprints.mean(axis=1, keepdims=True), axis=-1))
+
+def post_encroachment_time(ego, npc, times, chunk=256):
+    """
+    Smallest |t_i - t_j| over the pairs of samples at which the ego footprint at t_i and the NPC
+    footprint at t_j overlap, NaN if they never do. Pairs are screened by the distance between
+    the footprint centers before the exact test (broad phase).
+    :param ego: (T, 4, 2) ego footprints
+    :param npc: (T, 4, 2) NPC footprints
+    :param times: (T,) timestamps
+    :param chunk: ego samples screened together
+    """
+    ego_centers, npc_centers = ego.mean(axis=1), npc.mean(axis=1)
+    reach = _radius(ego) + _radius(npc)
+    best = np.inf
+    for start in range(0, len(times), chunk):
+        distance = np.linalg.norm(ego_centers[start:start + chunk, None] - npc_centers[None], axis=-1)
+        i, j = np.nonzero(distance <= reach)
+        i += start
+        gap = np.abs(times[i] - times[j])
+        closer = gap < best
+        i, j, gap = i[closer], j[closer], gap[closer]
+        overlap = rectangles_overlap(ego[i], npc[j])
+        if overlap.any():
+            best = gap[overlap].min()
+    return best if best < np.inf else np.nan
+
+def required_deceleration(ego, npc, times, speed, heading, max_deceleration=15.0, resolution=0.05, batch=32):
+    """
+    Smallest constant deceleration (a multiple of resolution) with which the ego, braking from the
+    first sample along `heading`, does not overlap the NPC footprints at the same times;
+    inf if max_deceleration does not suffice.
+    :param ego: (T, 4, 2) ego footprints, only the first one is used
+    :param npc: (T, 4, 2) NPC footprints
+    :param speed: ego speed at the first sample
+    :param heading: (2,) unit vector of the ego heading at the first sample
+    :param batch: decelerations tested together, in increasing order
+    """
+    elapsed = times - times[0]
+    decelerations = np.arange(0, max_deceleration + resolution / 2, resolution)
+    for start in range(0, len(decelerations), batch):
+        decel = decelerations[start:start + batch, None]
+        # without deceleration, the ego never stops
+        stop_time = np.divide(speed, decel, out=np.full(decel.shape, np.inf), where=decel > 0)
+        t = np.minimum(elapsed, stop_time)
+        displacement = speed * t - decel * t ** 2 / 2
+        moved = ego[0] + displacement[..., None, None] * heading
+        safe = ~rectangles_overlap(moved, npc).any(axis=1)
+        if safe.any():
+            return float(decel[np.argmax(safe), 0])
+    return np.inf
+
+def trace_metrics(trace, brake_threshold=0.5, smoothing=0.2, horizon=10.0):
+    """
+    Metrics of a trace (see the module documentation), as a dictionary; NaN when not defined,
+    e.g., the brake metrics when the ego did not brake.
+    :param brake_threshold: deceleration of the brake onset, in m/s^2
+    :param smoothing: width of the moving average of the deceleration, in s
+    :param horizon: duration after the U-turn/swerve start taken into account, in s
+    """
+    t = trace.timestamps
+    start = behavior_start_index(trace)
+    stop = int(np.searchsorted(t, t[start] + horizon, side='right'))
+    ego, npc = trace.footprint('ego')[start:stop], trace.footprint('npc1')[start:stop]
+    overlap = np.flatnonzero(rectangles_overlap(ego, npc))
+    end = start + overlap[0] if len(overlap) else stop
+
+    result = dict.fromkeys((name for name, _ in METRICS), np.nan)
+    speed, acceleration = ego_motion(trace, max(end, start + 1))
+    decel = moving_average(-acceleration, t[:len(speed)], smoothing)[start:]
+    peak = int(np.argmax(decel))
+    if decel[peak] >= brake_threshold:
+        below = np.flatnonzero(decel[:peak] < brake_threshold)
+        onset = below[-1] + 1 if len(below) else 0
+        result['reaction_latency'] = t[start + onset] - t[start]
+        result['time_to_peak_deceleration'] = t[start + peak] - t[start + onset]
+        result['peak_deceleration'] = float(decel[peak])
+        if peak > onset:
+            rise = slice(start + onset, start + peak + 1)
+            result['peak_jerk'] = float(np.max(np.gradient(decel[onset:peak + 1], t[rise])))
+
+    result['min_distance'] = float(np.nanmin(footprint_distance(ego, npc)))
+    result['post_encroachment_time'] = float(post_encroachment_time(ego, npc, t[start:stop]))
+    result['required_deceleration'] = required_deceleration(ego, npc, t[start:stop], speed[start],
+                                                            trace.ego.heading_vectors()[start])
+    return result
+
+def process_a_file(task):
+    path, brake_threshold, smoothing, horizon = task
+    trace = Trace.from_dict(load_data(path))
+    return os.path.basename(path), trace_metrics(trace, brake_threshold, smoothing, horizon)
+
+def process_a_dir(path, brake_threshold=0.5, smoothing=0.2, horizon=10.0, jobs=1):
+    """
+    Metrics of every trace of a folder, as a list of (file name, metrics), with `jobs` processes.
+    """
+    tasks = [(file, brake_threshold, smoothing, horizon) for file in trace_files(path)]
+    with Pool(jobs) as pool:
+        return list(pool.imap(process_a_file, tasks))
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description='Brake reaction and deceleration profile metrics of traces.')
+    parser.add_argument('path', help='path to a JSON trace file or a folder containing JSON files')
+    parser.add_argument('--brake-threshold', type=float, default=0.5,
+                        help='deceleration of the brake onset in m/s^2 (default: 0.5)')
+    parser.add_argument('--smoothing', type=float, default=0.2,
+                        help='moving average of the deceleration, in s (default: 0.2)')
+    parser.add_argument('--horizon', type=float, default=10.0,
+                        help='duration after the U-turn/swerve start taken into account, in s (default: 10)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='parallel processes (default: 1)')
+    parser.add_argument('-o', '--output', help='CSV file to write the metrics to')
+    return parser
+
+if __name__ == '__main__':
+    cli_args = cli_parser().parse_args()
+    results = process_a_dir(cli_args.path, cli_args.brake_threshold, cli_args.smoothing, cli_args.horizon,
+                            cli_args.jobs)
+    names = [name for name, _ in METRICS]
+    print("File name, " + ", ".join(f"{name} ({unit})" for name, unit in METRICS))
+    for file_name, metrics in results:
+        print(f"{file_name}, " + ", ".join(f"{metrics[name]:.3f}" for name in names))
+    if len(results) > 1:
+        values = np.array([[metrics[name] for name in names] for _, metrics in results], dtype=float)
+        medians = [np.median(column[np.isfinite(column)]) if np.isfinite(column).any() else np.nan
+                   for column in values.T]
+        print("Median, " + ", ".join(f"{value:.3f}" for value in medians))
+    if cli_args.output:
+        with open(cli_args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['file'] + names)
+            for file_name, metrics in results:
+                writer.writerow([file_name] + [metrics[name] for name in names])
+        print(f"Written {cli_args.output}")
@@ -0,0 +1,15 @@
+"""
+Opt-in instrumentation: event counters and phase timers.
+The implementation, shared with safety-benchmarks, is in safety-benchmarks/profiling.py (see its
+documentation for the usage and the counters of this folder). This module loads it and replaces itself
+with it, so that both folders use the same module, even when a process imports both.
+"""
+import importlib.util
+import os
+import sys
+
+_spec = importlib.util.spec_from_file_location(__name__, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'safety-benchmarks', 'profiling.py'))
+_module = importlib.util.module_from_spec(_spec)
+sys.modules[__name__] = _module
+_spec.loader.exec_module(_module)
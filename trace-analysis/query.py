@@ -0,0 +1,329 @@
+"""
+Lazy queries of kinematic columns across many traces, e.g., the ego speed in the 2 s before the first contact
+of all adjacent-lane U-turn traces:
+    frame = (scan_catalog('traces.db')
+             .where('uturn, lane=adjacent')
+             .window(-2, 0, anchor='collision')
+             .select('ego.speed')
+             .collect(jobs=4))
+Nothing is read until collect(). The scenario filters are evaluated by the catalog (see catalog.py),
+so traces that are filtered out are never opened. Each selected trace is converted once into a columnar cache:
+a folder per trace (named by its SHA-256) with one .npy file per array of columnar.Trace, and
+`trace.json` holding the actor sizes, the metadata and the anchor times of the windows:
+    start       first timestamp
+    behavior    U-turn/swerve start (metrics.behavior_start_index), if the trace has the waypoints
+    collision   first contact between the ego and any vehicle, if any
+The cached arrays are memory-mapped, so only the selected columns over the window rows are read.
+Traces without the anchor of the window (e.g., without a collision) are left out; Git LFS pointers are skipped.
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+from multiprocessing import Pool
+
+import numpy as np
+
+import utils
+from analysis import load_data, SWERVE_KEY_STR, UTURN_KEY_STR, WAYPOINTS_KEY_STR
+from catalog import Catalog, parse_query
+from columnar import Trace
+from metrics import behavior_start_index, rectangles_overlap
+
+DEFAULT_CACHE = 'trace-cache'
+
+CACHE_VERSION = 1
+
+ANCHORS = ('start', 'behavior', 'collision')
+
+# column quantity: (ActorTrack array, component); `speed` is the norm of the velocity
+QUANTITIES = {
+    'x': ('position', 0), 'y': ('position', 1), 'z': ('position', 2),
+    'roll': ('rotation', 0), 'pitch': ('rotation', 1), 'yaw': ('rotation', 2),
+    'vx': ('velocity', 0), 'vy': ('velocity', 1), 'vz': ('velocity', 2),
+    'ax': ('acceleration', 0), 'ay': ('acceleration', 1), 'az': ('acceleration', 2),
+    'speed': ('velocity', None),
+}
+ARRAYS = ('position', 'rotation', 'velocity', 'acceleration')
+
+def parse_column(column):
+    """
+    Split a column name `<actor>.<quantity>`, e.g., `ego.speed` or `npc2.x`, into (actor, array, component).
+    """
+    actor, _, quantity = column.partition('.')
+    if quantity not in QUANTITIES:
+        raise ValueError(f"Invalid column {column}, expected <actor>.<quantity> with quantity in: "
+                         f"{', '.join(QUANTITIES)}")
+    return (actor,) + QUANTITIES[quantity]
+
+def anchor_times(trace):
+    """
+    Times of the window anchors of a columnar.Trace, None when they do not exist.
+    """
+    anchors = {'start': float(trace.timestamps[0]) if len(trace) else None, 'behavior': None, 'collision': None}
+    names = {item['name'] for item in trace.sizes}
+    has_waypoint = any(key in trace.metadata for key in (SWERVE_KEY_STR, UTURN_KEY_STR, WAYPOINTS_KEY_STR))
+    if len(trace) and has_waypoint and 'npc1' in names and any(veh.name == 'npc1' for veh in trace.vehicles):
+        anchors['behavior'] = float(trace.timestamps[behavior_start_index(trace)])
+    if len(trace) and 'ego' in names:
+        ego = trace.footprint('ego')
+        contact = np.zeros(len(trace), dtype=bool)
+        for vehicle in trace.vehicles:
+            if vehicle.name in names:
+                contact |= rectangles_overlap(ego, trace.footprint(vehicle.name))
+        if contact.any():
+            anchors['collision'] = float(trace.timestamps[np.argmax(contact)])
+    return anchors
+
+def write_cache(trace, folder):
+    """
+    Write a columnar.Trace into a cache folder, atomically: an existing folder is left as it is.
+    """
+    tmp_folder = f"{folder}.tmp{os.getpid()}"
+    os.makedirs(tmp_folder, exist_ok=True)
+    np.save(os.path.join(tmp_folder, 'timestamps.npy'), trace.timestamps)
+    for track in [trace.ego] + trace.vehicles:
+        for array in ARRAYS:
+            values = getattr(track, array)
+            if values is not None:
+                np.save(os.path.join(tmp_folder, f'{track.name}.{array}.npy'), values)
+    info = {
+        'version': CACHE_VERSION,
+        'actors': [track.name for track in [trace.ego] + trace.vehicles],
+        'sizes': trace.sizes,
+        'metadata': trace.metadata,
+        'anchors': anchor_times(trace),
+    }
+    with open(os.path.join(tmp_folder, 'trace.json'), 'w') as f:
+        json.dump(info, f)
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError:
+        # written meanwhile by another process
+        shutil.rmtree(tmp_folder)
+
+def cached_trace(path, sha256, cache=DEFAULT_CACHE):
+    """
+    Cache folder of a JSON trace, converted first if it is not cached yet.
+    :return: (folder, contents of its trace.json)
+    """
+    folder = os.path.join(cache, sha256)
+    info_path = os.path.join(folder, 'trace.json')
+    if os.path.isfile(info_path):
+        with open(info_path, 'r') as f:
+            info = json.load(f)
+        if info['version'] == CACHE_VERSION:
+            return folder, info
+        shutil.rmtree(folder)
+    os.makedirs(cache, exist_ok=True)
+    write_cache(Trace.from_dict(load_data(path)), folder)
+    with open(info_path, 'r') as f:
+        return folder, json.load(f)
+
+def read_window(task):
+    """
+    Read columns of a trace over a time window, from its cache.
+    :param task: (path, sha256, cache folder, columns, anchor, (start, end) relative to the anchor)
+    :return: dict of the columns and `time` (relative to the anchor), or None if the trace has no such anchor
+    """
+    path, sha256, cache, columns, anchor, (start, end) = task
+    folder, info = cached_trace(path, sha256, cache)
+    origin = info['anchors'][anchor]
+    if origin is None:
+        return None
+    timestamps = np.load(os.path.join(folder, 'timestamps.npy'), mmap_mode='r')
+    first = int(np.searchsorted(timestamps, origin + start, side='left'))
+    last = int(np.searchsorted(timestamps, origin + end, side='right'))
+    result = {'time': np.array(timestamps[first:last]) - origin}
+    for column in columns:
+        actor, array, component = parse_column(column)
+        array_path = os.path.join(folder, f'{actor}.{array}.npy')
+        if not os.path.isfile(array_path):
+            result[column] = np.full(last - first, np.nan)
+            continue
+        values = np.load(array_path, mmap_mode='r')[first:last]
+        result[column] = np.linalg.norm(values, axis=1) if component is None else np.array(values[:, component])
+    return result
+
+class Frame:
+    """
+    Result of a query: columns of equal length, one row per sample of each trace.
+    The `trace` column holds the path of the trace (relative to the working directory) and the `time` column
+    the time from the anchor of the window.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(self.columns['trace'])
+
+    def names(self):
+        return list(self.columns)
+
+    def traces(self):
+        """
+        The traces present in the frame, in order.
+        """
+        return list(dict.fromkeys(self.columns['trace']))
+
+    def groups(self):
+        """
+        Yield (trace, Frame of the rows of the trace).
+        """
+        for trace in self.traces():
+            mask = self.columns['trace'] == trace
+            yield trace, Frame({name: values[mask] for name, values in self.columns.items()})
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.names())
+            writer.writerows(zip(*self.columns.values()))
+
+class TraceQuery:
+    """
+    Lazy query over the traces of a catalog. The methods return new queries; collect() runs the query.
+    """
+    def __init__(self, catalog_path=None, sources=(), filters=(), columns=('ego.speed',), anchor='start',
+                 window=(-np.inf, np.inf), cache=DEFAULT_CACHE):
+        """
+        :param catalog_path: catalog file built by catalog.py, or None to index `sources` when collected
+        :param sources: trace files or folders, if there is no catalog
+        :param filters: catalog queries (see catalog.parse_query), all of which the traces match
+        :param columns: columns `<actor>.<quantity>`, see QUANTITIES
+        :param anchor: one of ANCHORS
+        :param window: (start, end) in seconds from the anchor
+        :param cache: folder of the columnar cache
+        """
+        self.catalog_path = catalog_path
+        self.sources = list(sources)
+        self.filters = list(filters)
+        self.columns = list(columns)
+        self.anchor = anchor
+        self.time_window = window
+        self.cache = cache
+
+    def _replace(self, **changes):
+        params = {'catalog_path': self.catalog_path, 'sources': self.sources, 'filters': self.filters,
+                  'columns': self.columns, 'anchor': self.anchor, 'window': self.time_window, 'cache': self.cache}
+        params.update(changes)
+        return TraceQuery(**params)
+
+    def where(self, query):
+        """
+        Keep the traces matching a catalog query, e.g., "swerve, agent=lav_lav, vo=15".
+        """
+        parse_query(query)
+        return self._replace(filters=self.filters + [query])
+
+    def window(self, start, end, anchor='start'):
+        """
+        Keep the samples from `start` to `end` seconds (inclusive) after the anchor, one of ANCHORS.
+        """
+        if anchor not in ANCHORS:
+            raise ValueError(f"Invalid anchor {anchor}, expected one of: {', '.join(ANCHORS)}")
+        return self._replace(anchor=anchor, window=(start, end))
+
+    def select(self, *columns):
+        for column in columns:
+            parse_column(column)
+        return self._replace(columns=list(columns))
+
+    def plan(self):
+        """
+        The traces to read, as a list of (path relative to the working directory, absolute path, sha256),
+        found in the catalog without opening any trace, except those modified since they were indexed,
+        which are hashed again so that their outdated cache is not read.
+        """
+        plan = []
+        with Catalog(self.catalog_path or ':memory:') as catalog:
+            if self.catalog_path is None:
+                catalog.index(self.sources)
+            for row in catalog.select(', '.join(self.filters + ['lfs=0'])):
+                path, sha256 = catalog.absolute(row['path']), row['sha256']
+                stat = os.stat(path)
+                if (row['size'], row['mtime']) != (stat.st_size, stat.st_mtime):
+                    sha256, lfs = utils.file_digest(path)
+                    if lfs:
+                        print(f"Skipping Git LFS pointer: {os.path.relpath(path)}")
+                        continue
+                plan.append((os.path.relpath(path), path, sha256))
+        return plan
+
+    def collect(self, jobs=1):
+        """
+        Run the query with `jobs` processes.
+        :return: Frame with the columns `trace`, `time` and the selected columns
+        """
+        plan = self.plan()
+        tasks = [(path, sha256, self.cache, self.columns, self.anchor, self.time_window)
+                 for _, path, sha256 in plan]
+        names, parts = [], []
+        with Pool(jobs) as pool:
+            for (name, _, _), part in zip(plan, pool.imap(read_window, tasks)):
+                if part is not None:
+                    names.append(name)
+                    parts.append(part)
+        columns = {'trace': np.repeat(np.array(names, dtype=object), [len(part['time']) for part in parts])}
+        for column in ['time'] + self.columns:
+            columns[column] = np.concatenate([part[column] for part in parts]) if parts else np.empty(0)
+        return Frame(columns)
+
+def scan_catalog(catalog_path, cache=DEFAULT_CACHE):
+    """
+    Query over the traces of a catalog built by catalog.py.
+    """
+    return TraceQuery(catalog_path=catalog_path, cache=cache)
+
+def scan(*sources, cache=DEFAULT_CACHE):
+    """
+    Query over trace files or folders (searched recursively), indexed in memory when collected.
+    """
+    return TraceQuery(sources=sources, cache=cache)
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description='Query kinematic columns across traces.')
+    parser.add_argument('paths', nargs='*', help='trace files or folders, instead of a catalog')
+    parser.add_argument('-d', '--database', help='catalog file built by catalog.py')
+    parser.add_argument('-q', '--query', default='all',
+                        help='catalog query, e.g., "uturn, lane=adjacent" (default: all)')
+    parser.add_argument('-c', '--columns', default='ego.speed',
+                        help='comma-separated columns <actor>.<quantity>, with quantity in '
+                             f'{", ".join(QUANTITIES)} (default: ego.speed)')
+    parser.add_argument('--anchor', choices=ANCHORS, default='start', help='origin of the window (default: start)')
+    parser.add_argument('--window', nargs=2, type=float, default=(-np.inf, np.inf), metavar=('START', 'END'),
+                        help='time window in s from the anchor (default: whole trace)')
+    parser.add_argument('--cache', default=DEFAULT_CACHE, help=f'columnar cache folder (default: {DEFAULT_CACHE})')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='parallel processes (default: 1)')
+    parser.add_argument('-o', '--output', help='CSV file to write all the samples to')
+    return parser
+
+if __name__ == '__main__':
+    parser = cli_parser()
+    cli_args = parser.parse_args()
+    if (cli_args.database is None) == (not cli_args.paths):
+        parser.error("either paths or --database is required")
+    query = scan_catalog(cli_args.database, cli_args.cache) if cli_args.database \
+        else scan(*cli_args.paths, cache=cli_args.cache)
+    try:
+        query = query.where(cli_args.query).window(*cli_args.window, anchor=cli_args.anchor) \
+            .select(*cli_args.columns.split(','))
+    except ValueError as e:
+        parser.error(str(e))
+    frame = query.collect(cli_args.jobs)
+
+    columns = query.columns
+    print("Trace, Samples, " + ", ".join(f"{column} min, {column} mean, {column} max" for column in columns))
+    for trace, group in frame.groups():
+        stats = []
+        for column in columns:
+            values = group[column][np.isfinite(group[column])]
+            stats += [values.min(), values.mean(), values.max()] if len(values) else [np.nan] * 3
+        print(f"{trace}, {len(group)}, " + ", ".join(f"{value:.3f}" for value in stats))
+    if cli_args.output:
+        frame.to_csv(cli_args.output)
+        print(f"Written {cli_args.output}")
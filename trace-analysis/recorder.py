@@ -0,0 +1,329 @@
+"""
+Offline decoder for CARLA recorder (.log) files.
+
+The recorder format (CARLA 0.9.x) is a small header followed by a stream of packets:
+    header: uint16 version, string magic ("CARLA_RECORDER"), int64 date, string map name
+    packet: uint8 id, uint32 payload size, payload
+where strings are a uint16 length followed by the characters.
+Every simulation frame starts with a FrameStart packet and ends with a FrameEnd packet.
+Packets that are not needed for traces are skipped using their size, so the decoder
+does not depend on the exact layout of the packets it does not read.
+
+Locations in the recorder are in Unreal units (cm) and rotations are (roll, pitch, yaw)
+in degrees; velocities are already in m/s. The decoded traces use the same units and
+frames as the JSON traces written by the CARLA scenario scripts.
+The recorder does not store the U-turn/swerve point of the scenario, which is rebuilt from the NPC
+motion (see behavior_point), so that decoded traces can be analyzed as the original ones.
+"""
+import json
+import os
+import struct
+import numpy as np
+from pathlib import Path
+from analysis import UTURN_KEY_STR, SWERVE_KEY_STR
+from columnar import ActorTrack, Trace
+
+FRAME_START = 0
+FRAME_END = 1
+EVENT_ADD = 2
+COLLISION = 5
+POSITION = 6
+KINEMATICS = 12
+BOUNDING_BOX = 13
+
+CM_TO_M = 0.01
+
+# NPC yaw rate (deg/s) from which its U-turn/swerve has started; before, the NPCs drift by less than 0.5 deg/s
+TURN_RATE = 1.0
+
+# uint32 actor id followed by two float vectors, used by Position, Kinematics and BoundingBox
+ACTOR_VECTORS_DTYPE = np.dtype([('id', '<u4'), ('a', '<f4', 3), ('b', '<f4', 3)])
+COLLISION_DTYPE = np.dtype([('id', '<u4'), ('actor1', '<u4'), ('actor2', '<u4'),
+                            ('hero1', '?'), ('hero2', '?')])
+
+_packet_header = struct.Struct('<BI')
+_frame_start = struct.Struct('<Qdd')
+_event_add_head = struct.Struct('<IB6fI')
+
+class Frame:
+    """
+    Content of one recorded frame, limited to what traces need.
+    """
+    def __init__(self, frame_id, elapsed):
+        self.frame_id = frame_id
+        self.elapsed = elapsed
+        # actor id -> (location in m, rotation (roll, pitch, yaw) in degrees)
+        self.positions = {}
+        # actor id -> linear velocity in m/s
+        self.velocities = {}
+        # list of (actor id 1, actor id 2)
+        self.collisions = []
+
+class RecorderReader:
+    """
+    Stream-oriented reader: packets are read one at a time, so memory does not
+    depend on the length of the recording.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.version = self._read_value('<H')
+        self.magic = self._read_string()
+        if self.magic != "CARLA_RECORDER":
+            self.file.close()
+            raise ValueError(f"{path} is not a CARLA recorder file")
+        self.date = self._read_value('<q')
+        self.map_name = self._read_string()
+        # actor id -> {'type_id', 'role_name'}, filled while reading frames
+        self.actors = {}
+        # actor id -> (center offset in m, size in m)
+        self.bounding_boxes = {}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_value(self, fmt):
+        size = struct.calcsize(fmt)
+        return struct.unpack(fmt, self.file.read(size))[0]
+
+    def _read_string(self):
+        length = self._read_value('<H')
+        return self.file.read(length).decode('utf-8', errors='replace')
+
+    def packets(self):
+        """
+        Yield (packet id, payload) until the end of the file.
+        A truncated last packet (e.g., the recorder was not stopped cleanly) is ignored.
+        """
+        read = self.file.read
+        while True:
+            header = read(_packet_header.size)
+            if len(header) < _packet_header.size:
+                return
+            packet_id, size = _packet_header.unpack(header)
+            payload = read(size)
+            if len(payload) < size:
+                return
+            yield packet_id, payload
+
+    def frames(self):
+        """
+        Yield one Frame per recorded simulation frame.
+        """
+        frame = None
+        for packet_id, payload in self.packets():
+            if packet_id == FRAME_START:
+                frame_id, _, elapsed = _frame_start.unpack_from(payload)
+                frame = Frame(frame_id, elapsed)
+            elif frame is None:
+                continue
+            elif packet_id == FRAME_END:
+                yield frame
+                frame = None
+            elif packet_id == POSITION:
+                for rec in _actor_vectors(payload):
+                    frame.positions[int(rec['id'])] = (rec['a'].astype(float) * CM_TO_M, rec['b'])
+            elif packet_id == KINEMATICS:
+                for rec in _actor_vectors(payload):
+                    frame.velocities[int(rec['id'])] = rec['a']
+            elif packet_id == COLLISION:
+                for rec in _records(payload, COLLISION_DTYPE):
+                    frame.collisions.append((int(rec['actor1']), int(rec['actor2'])))
+            elif packet_id == EVENT_ADD:
+                self._parse_event_add(payload)
+            elif packet_id == BOUNDING_BOX:
+                for rec in _actor_vectors(payload):
+                    self.bounding_boxes[int(rec['id'])] = (rec['a'].astype(float) * CM_TO_M,
+                                                              rec['b'].astype(float) * 2 * CM_TO_M)
+
+    def _parse_event_add(self, payload):
+        total, = struct.unpack_from('<H', payload, 0)
+        offset = 2
+        for _ in range(total):
+            actor_id = _event_add_head.unpack_from(payload, offset)[0]
+            offset += _event_add_head.size
+            type_id, offset = _unpack_string(payload, offset)
+            attr_count, = struct.unpack_from('<H', payload, offset)
+            offset += 2
+            attributes = {}
+            for _ in range(attr_count):
+                offset += 1     # attribute type
+                key, offset = _unpack_string(payload, offset)
+                value, offset = _unpack_string(payload, offset)
+                attributes[key] = value
+            self.actors[actor_id] = {
+                'type_id': type_id,
+                'role_name': attributes.get('role_name', '')
+            }
+
+def _unpack_string(payload, offset):
+    length, = struct.unpack_from('<H', payload, offset)
+    offset += 2
+    return payload[offset:offset + length].decode('utf-8', errors='replace'), offset + length
+
+def _records(payload, dtype):
+    total, = struct.unpack_from('<H', payload, 0)
+    return np.frombuffer(payload, dtype=dtype, count=total, offset=2)
+
+def _actor_vectors(payload):
+    return _records(payload, ACTOR_VECTORS_DTYPE)
+
+def load_trace(path, hero_role="hero"):
+    """
+    Decode a recorder file into a Trace.
+    The ego is the vehicle whose role name is `hero_role`; every other vehicle becomes
+    `npc1`, `npc2`, ... in order of spawning.
+    Timestamps start at 0 at the first frame in which the ego exists (its spawn frame).
+    Recorder files do not contain accelerations, so the ego acceleration is derived from
+    its velocity. Collision events are stored in `metadata['collisions']`, and the U-turn/swerve
+    point in `metadata['uturn_point']`/`metadata['swerve_point']` (by the file name), if npc1 turns.
+    """
+    timestamps, ego_rows, npc_rows, collisions = [], [], {}, []
+    ego_id = None
+    with RecorderReader(path) as reader:
+        for frame in reader.frames():
+            if ego_id is None:
+                ego_id = next((actor_id for actor_id, actor in reader.actors.items()
+                               if actor['role_name'] == hero_role and actor_id in frame.positions), None)
+                if ego_id is None:
+                    continue
+            if ego_id not in frame.positions:
+                continue
+            row = len(timestamps)
+            timestamps.append(frame.elapsed)
+            ego_rows.append(_row(frame, ego_id))
+            for actor_id, actor in reader.actors.items():
+                if actor_id == ego_id or not actor['type_id'].startswith('vehicle.') \
+                        or actor_id not in frame.positions:
+                    continue
+                npc_rows.setdefault(actor_id, {})[row] = _row(frame, actor_id)
+            for actor1, actor2 in frame.collisions:
+                collisions.append((row, actor1, actor2))
+        bounding_boxes = reader.bounding_boxes
+        map_name = reader.map_name
+
+    if ego_id is None:
+        raise ValueError(f"No vehicle with role name '{hero_role}' in {path}")
+
+    timestamps = np.array(timestamps) - timestamps[0]
+    count = len(timestamps)
+    ego_rows = np.array(ego_rows)
+    ego_acc = np.gradient(ego_rows[:, 6:9], timestamps, axis=0) if count > 1 else np.zeros((count, 3))
+    ego = ActorTrack('ego', ego_rows[:, 0:3], ego_rows[:, 3:6], ego_rows[:, 6:9], ego_acc)
+
+    names = {ego_id: 'ego'}
+    vehicles = []
+    for j, actor_id in enumerate(sorted(npc_rows)):
+        rows = np.full((count, 9), np.nan)
+        for i, values in npc_rows[actor_id].items():
+            rows[i] = values
+        names[actor_id] = f'npc{j + 1}'
+        vehicles.append(ActorTrack(names[actor_id], rows[:, 0:3], rows[:, 3:6], rows[:, 6:9]))
+
+    sizes = []
+    for actor_id, name in names.items():
+        if actor_id in bounding_boxes:
+            center, size = bounding_boxes[actor_id]
+            sizes.append({'name': name,
+                          'center': {'x': float(center[0]), 'y': float(center[1]), 'z': float(center[2])},
+                          'size': {'x': float(size[0]), 'y': float(size[1]), 'z': float(size[2])}})
+
+    metadata = {
+        'map': map_name,
+        'collisions': [{'timestamp': float(timestamps[row]),
+                        'actors': [names.get(actor1, str(actor1)), names.get(actor2, str(actor2))]}
+                       for row, actor1, actor2 in collisions]
+    }
+    trace = Trace(timestamps, ego, vehicles, sizes, metadata)
+    name = os.path.basename(path)
+    key = SWERVE_KEY_STR if name.startswith('swerve') else UTURN_KEY_STR if name.startswith('uturn') else None
+    point = behavior_point(trace) if key else None
+    if point is not None:
+        metadata[key] = {'x': float(point[0]), 'y': float(point[1]), 'z': float(point[2])}
+    return trace
+
+def behavior_point(trace, turn_rate=TURN_RATE, min_speed=0.5):
+    """
+    The U-turn/swerve point of a trace: the front of npc1 at the last sample before its heading
+    starts to change while it moves (a swerve also starts by steering), as (x, y, z).
+    None if npc1 does not exist or does not turn.
+    """
+    if not any(item['name'] == 'npc1' for item in trace.sizes) or \
+            not any(vehicle.name == 'npc1' for vehicle in trace.vehicles) or len(trace) < 2:
+        return None
+    npc = trace.actor('npc1')
+    yaw_change = (np.diff(npc.rotation[:, 2]) + 180) % 360 - 180
+    rate = np.abs(yaw_change) / np.diff(trace.timestamps)
+    speed = np.linalg.norm(npc.velocity[:-1, :2], axis=1)
+    turning = np.flatnonzero((rate > turn_rate) & (speed > min_speed))
+    if not len(turning):
+        return None
+    (length, _), _ = trace.size_of('npc1')
+    x, y = trace.body_point('npc1', (length / 2, 0))[turning[0]]
+    return x, y, npc.position[turning[0], 2]
+
+def _row(frame, actor_id):
+    location, rotation = frame.positions[actor_id]
+    velocity = frame.velocities.get(actor_id, (np.nan, np.nan, np.nan))
+    return (*location, *rotation, *velocity)
+
+def is_valid_trace(path):
+    try:
+        with open(path, 'r') as f:
+            json.load(f)
+        return True
+    except (OSError, ValueError):
+        return False
+
+def convert(input_path, output_path=None, overwrite=False):
+    """
+    Decode one recorder file and write it as a JSON trace next to it (or to output_path).
+    An existing valid trace is kept unless `overwrite` is set, since decoded traces
+    lack part of the scenario metadata (the U-turn/swerve waypoints, of which only the first
+    point is rebuilt) of the original ones.
+    Return the path of the written trace, or None if it was kept.
+    """
+    if output_path is None:
+        output_path = os.path.splitext(input_path)[0] + ".json"
+    if not overwrite and is_valid_trace(output_path):
+        return None
+    trace = load_trace(input_path)
+    with open(output_path, 'w') as f:
+        json.dump(trace.to_dict(), f, indent=None)
+    return output_path
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Decode CARLA recorder files into JSON traces "
+                                                 "without a running simulator.")
+    parser.add_argument("path", help="Path to a .log recorder file or a folder containing .log files.")
+    parser.add_argument('-o', '--output',
+                        help='Output JSON file or folder (single input) or folder (folder input). '
+                             'By default, the trace is written next to the log file.')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Overwrite existing valid JSON traces '
+                             '(default: only write missing or corrupted ones)')
+
+    args = parser.parse_args()
+    if os.path.isfile(args.path):
+        out_path = args.output
+        if out_path and os.path.isdir(out_path):
+            out_path = os.path.join(out_path, Path(args.path).stem + ".json")
+        jobs = [(args.path, out_path)]
+    else:
+        out_dir = args.output if args.output else args.path
+        jobs = [(str(file), os.path.join(out_dir, file.stem + ".json"))
+                for file in sorted(Path(args.path).glob("*.log"))]
+    for log_path, out_path in jobs:
+        written = convert(log_path, out_path, args.overwrite)
+        if written:
+            print(f"Written: {written}")
+        else:
+            print(f"Skipped: {os.path.basename(log_path)} (a valid trace already exists)")
@@ -0,0 +1,355 @@
+"""
+Synthetic traces in the JSON trace schema (`groundtruth_kinematic`, `groundtruth_size`, `metadata`),
+for load and scaling tests of the loaders and metrics when the recorded traces are not available
+(most of them are stored with Git LFS).
+
+The motion comes either from the U-turn/swerve models of ../safety-benchmarks, stepped at the
+sample rate, or from a kinematic model of straight oncoming traffic. Before the scenario starts,
+the vehicles drive at constant speed, so traces can be made as long as needed.
+Traces are written entry by entry, so memory does not depend on their size.
+"""
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from utils import import_safety_benchmarks
+
+# timestamps generated and written together
+CHUNK = 4096
+
+class KinematicModel:
+    """
+    The ego drives along +x from (0, 0), optionally braking at a constant deceleration from brake_time.
+    NPCs come the other way in a parallel lane, one after the other, at constant speed.
+    Vehicles do not interact. At time 0 the front of the first NPC is dx0 ahead of the ego front.
+    """
+    key = 'waypoints'
+
+    def __init__(self, ve, vo, dx0, npcs=1, lateral=3.5, spacing=30.0, brake_time=None, decel=6.0,
+                 ego_size=(4.9, 2.2), npc_size=(4.0, 1.9)):
+        """
+        :param ve: ego speed in m/s
+        :param vo: NPC speed in m/s
+        :param dx0: longitudinal distance between the ego and the first NPC at time 0, in m
+        :param npcs: number of NPCs
+        :param lateral: lateral offset of the NPC lane, in m
+        :param spacing: longitudinal distance between consecutive NPCs, in m
+        :param brake_time: time at which the ego starts braking, None for no braking
+        :param decel: ego deceleration when braking, in m/s^2
+        :param ego_size: (length, width) in m
+        :param npc_size: (length, width) in m
+        """
+        self.ve = ve
+        self.vo = vo
+        self.npcs = npcs
+        self.lateral = lateral
+        self.brake_time = brake_time
+        self.decel = decel
+        self.sizes = [('ego', ego_size)] + [(f'npc{i + 1}', npc_size) for i in range(npcs)]
+        first = dx0 + (ego_size[0] + npc_size[0]) / 2
+        self.npc_x0 = first + spacing * np.arange(npcs)
+        self.point = (first - npc_size[0] / 2, lateral)
+
+    def states(self, times):
+        """
+        Return the states (actors, len(times), 6): x, y, heading (rad), vx, vy and longitudinal acceleration
+        of the centers of the vehicles, ego first.
+        """
+        states = np.zeros((1 + self.npcs, len(times), 6))
+        if self.brake_time is None:
+            braking = np.zeros_like(times)
+        else:
+            braking = np.clip(times - self.brake_time, 0, self.ve / self.decel)
+        states[0, :, 0] = self.ve * times - 0.5 * self.decel * braking ** 2
+        states[0, :, 3] = self.ve - self.decel * braking
+        if self.brake_time is not None:
+            states[0, :, 5] = np.where((times >= self.brake_time) & (states[0, :, 3] > 0), -self.decel, 0)
+        states[1:, :, 0] = self.npc_x0[:, None] - self.vo * times
+        states[1:, :, 1] = self.lateral
+        states[1:, :, 2] = np.pi
+        states[1:, :, 3] = -self.vo
+        return states
+
+class SimulationModel:
+    """
+    Motion of a U-turn or swerve scenario of safety-benchmarks, stepped once per sample.
+    The scenario starts at time 0; before, the vehicles keep their initial speeds and headings.
+    After a collision, both vehicles stay where they are, with zero velocity; so does the swerve NPC
+    after its last waypoint.
+    """
+    def __init__(self, scenario, sample_step, **params):
+        """
+        :param scenario: `uturn` or `swerve`
+        :param sample_step: simulation step, i.e., 1 / sample rate
+        :param params: arguments of make_simulation of the scenario (speeds in m/s), and env
+        """
+        self.key = f'{scenario}_point'
+        module = import_safety_benchmarks(f'{scenario}.{scenario}')
+        env = module.env_configs[params.pop('env', 'awsim')]
+        self.sim = module.make_simulation(sim_step=sample_step, env=env, **params)
+        self.step_count = 0
+        self.sample_step = sample_step
+        self.npc_stopped = False
+        self.sizes = [('ego', (env['ego_length'], env['ego_width'])),
+                      ('npc1', (env['npc_length'], env['npc_width']))]
+        self.initial = [self._state(self.sim.ego, self.sim.ego.speed, 0.0),
+                        self._state(self.sim.npc, self.sim.npc.speed, 0.0)]
+        npc = self.initial[1]
+        self.point = tuple(npc[:2] + env['npc_length'] / 2 * np.array((np.cos(npc[2]), np.sin(npc[2]))))
+
+    @staticmethod
+    def _state(vehicle, speed, acceleration):
+        x, y = vehicle.get_center()
+        return np.array((x, y, vehicle.heading, speed * np.cos(vehicle.heading),
+                         speed * np.sin(vehicle.heading), acceleration))
+
+    def states(self, times):
+        """
+        Same as KinematicModel.states; successive calls must be given successive times.
+        """
+        states = np.zeros((2, len(times), 6))
+        for i, t in enumerate(times):
+            if t < 0:
+                for actor, state in enumerate(self.initial):
+                    states[actor, i] = state
+                    states[actor, i, :2] += t * state[3:5]
+                continue
+            while not self.sim.collision and self.step_count * self.sample_step < t - self.sample_step / 2:
+                npc_center = self.sim.npc.get_center()
+                self.sim.step()
+                self.step_count += 1
+                # the swerve NPC is no longer moved after its last waypoint, but keeps its speed
+                self.npc_stopped = np.allclose(self.sim.npc.get_center(), npc_center)
+            if self.sim.collision:
+                states[0, i] = self._state(self.sim.ego, 0.0, 0.0)
+                states[1, i] = self._state(self.sim.npc, 0.0, 0.0)
+            else:
+                states[0, i] = self._state(self.sim.ego, self.sim.ego.speed, -self.sim.ego.decel)
+                states[1, i] = self._state(self.sim.npc, 0.0 if self.npc_stopped else self.sim.npc.speed, 0.0)
+        return states
+
+class TraceConfig:
+    def __init__(self, rate=100.0, duration=30.0, lead_in=10.0, noise=(0.0, 0.0, 0.0),
+                 extra_keys=0, acceleration=True, origin=(0.0, 0.0, 0.0), seed=0):
+        """
+        :param rate: sample rate in Hz
+        :param duration: trace length in s
+        :param lead_in: time before the scenario starts, in s
+        :param noise: standard deviations of the Gaussian noise on positions (m), headings (deg)
+                      and velocities (m/s)
+        :param extra_keys: number of additional vector entries (`extra1`, ...) per actor and timestamp,
+                           to emulate larger payloads
+        :param acceleration: write the ego acceleration, as the Autoware traces do
+        :param origin: (x, y, yaw in deg) of the scenario frame in the map frame
+        :param seed: seed of the noise and extra values
+        """
+        self.rate = rate
+        self.duration = duration
+        self.lead_in = lead_in
+        self.noise = noise
+        self.extra_keys = extra_keys
+        self.acceleration = acceleration
+        self.origin = origin
+        self.seed = seed
+
+def _vector(x, y, z=0.0):
+    return {'x': float(x), 'y': float(y), 'z': float(z)}
+
+def _kinematic(state, extra, acceleration):
+    x, y, heading, vx, vy, acc = state
+    entry = {
+        'pose': {
+            'position': _vector(x, y),
+            'rotation': _vector(0, 0, heading)
+        },
+        'twist': {
+            'linear': _vector(vx, vy)
+        }
+    }
+    if acceleration:
+        cos, sin = np.cos(np.radians(heading)), np.sin(np.radians(heading))
+        entry['acceleration'] = {'linear': _vector(acc * cos, acc * sin)}
+    for k, values in enumerate(extra):
+        entry[f'extra{k + 1}'] = _vector(*values)
+    return entry
+
+def _entry(timestamp, states, extra, acceleration):
+    return {
+        'timestamp': float(timestamp),
+        'groundtruth_ego': _kinematic(states[0], extra[0], acceleration),
+        'groundtruth_vehicles': [dict(_kinematic(state, values, False), name="NPC")
+                                 for state, values in zip(states[1:], extra[1:])]
+    }
+
+def to_map_frame(states, origin):
+    """
+    Transform states (actors, T, 6) from the scenario frame to the map frame,
+    with headings in degrees as in the traces.
+    """
+    x0, y0, yaw = origin
+    cos, sin = np.cos(np.radians(yaw)), np.sin(np.radians(yaw))
+    result = states.copy()
+    result[..., 0] = x0 + cos * states[..., 0] - sin * states[..., 1]
+    result[..., 1] = y0 + sin * states[..., 0] + cos * states[..., 1]
+    result[..., 2] = (np.degrees(states[..., 2]) + yaw + 180) % 360 - 180
+    result[..., 3] = cos * states[..., 3] - sin * states[..., 4]
+    result[..., 4] = sin * states[..., 3] + cos * states[..., 4]
+    return result
+
+def _add_noise(states, noise, rng):
+    position_noise, heading_noise, velocity_noise = noise
+    if position_noise:
+        states[..., 0:2] += rng.normal(0, position_noise, states[..., 0:2].shape)
+    if heading_noise:
+        states[..., 2] += rng.normal(0, heading_noise, states[..., 2].shape)
+    if velocity_noise:
+        states[..., 3:5] += rng.normal(0, velocity_noise, states[..., 3:5].shape)
+    return states
+
+def write_trace(path, model, config, metadata=None):
+    """
+    Write the trace of a model (KinematicModel or SimulationModel) as a JSON trace.
+    :return: number of entries
+    """
+    rng = np.random.default_rng(config.seed)
+    count = int(round(config.duration * config.rate))
+    point = to_map_frame(np.array([[[*model.point, 0, 0, 0, 0]]]), config.origin)[0, 0]
+
+    with open(path, 'w') as f:
+        f.write('{"groundtruth_kinematic": [')
+        for start in range(0, count, CHUNK):
+            index = np.arange(start, min(start + CHUNK, count))
+            times = index / config.rate
+            states = _add_noise(to_map_frame(model.states(times - config.lead_in), config.origin),
+                                config.noise, rng)
+            extra = rng.uniform(-1, 1, (len(states), len(times), config.extra_keys, 3))
+            for i, t in enumerate(times):
+                if start + i:
+                    f.write(', ')
+                f.write(json.dumps(_entry(t, states[:, i], extra[:, i], config.acceleration)))
+        sizes = [{'name': name, 'size': _vector(length, width, 1.5), 'center': _vector(0, 0, 0.75)}
+                 for name, (length, width) in model.sizes]
+        metadata = dict(metadata or {})
+        if model.key == 'waypoints':
+            metadata['waypoints'] = [_vector(point[0], point[1])]
+        else:
+            metadata[model.key] = _vector(point[0], point[1])
+        f.write(f'], "groundtruth_size": {json.dumps(sizes)}, "metadata": {json.dumps(metadata)}}}')
+    return count
+
+def entry_size(model, config, samples=100):
+    """
+    Estimate the number of bytes per entry of the traces of a model, from its first samples
+    (the model is stepped, so use a model that is not written afterwards).
+    """
+    rng = np.random.default_rng(config.seed)
+    times = np.arange(samples) / config.rate
+    states = _add_noise(to_map_frame(model.states(times - config.lead_in), config.origin), config.noise, rng)
+    extra = rng.uniform(-1, 1, (len(states), samples, config.extra_keys, 3))
+    size = sum(len(json.dumps(_entry(t, states[:, i], extra[:, i], config.acceleration)))
+               for i, t in enumerate(times))
+    return size / samples + 2
+
+def parse_range(text):
+    """
+    Parse a value `x` or a uniform sampling range `a:b`.
+    """
+    bounds = [float(part) for part in text.split(':')]
+    return (bounds[0], bounds[-1])
+
+def sample_params(cli_args, rng):
+    """
+    Draw the scenario parameters of one trace, speeds converted to m/s.
+    """
+    draw = lambda text: float(rng.uniform(*parse_range(text)))
+    params = {'ve': draw(cli_args.ve) / 3.6, 'vo': draw(cli_args.vo) / 3.6, 'dx0': draw(cli_args.dx)}
+    if cli_args.command == 'uturn':
+        params['rightmost_lane'] = cli_args.lane == 'rightmost'
+        params['env'] = cli_args.env
+    elif cli_args.command == 'swerve':
+        params.update(vy=draw(cli_args.vy), ny=draw(cli_args.ny), swerve_distance=draw(cli_args.swerve_distance),
+                      env=cli_args.env)
+    else:
+        params.update(npcs=cli_args.npcs, lateral=cli_args.lateral)
+        if cli_args.brake_time is not None:
+            params['brake_time'] = draw(cli_args.brake_time)
+    return params
+
+def make_model(scenario, params, rate):
+    if scenario == 'kinematic':
+        return KinematicModel(**params)
+    return SimulationModel(scenario, 1 / rate, **params)
+
+def _generate(task):
+    path, scenario, params, config = task
+    model = make_model(scenario, dict(params), config.rate)
+    count = write_trace(path, model, config, {'synthetic': dict(params, scenario=scenario)})
+    return path, count
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description='Generate synthetic traces in the JSON trace schema '
+                                                 'for load and scaling tests.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    uturn = subparsers.add_parser('uturn', help='U-turn scenarios of safety-benchmarks')
+    uturn.add_argument('--lane', default='rightmost', choices=['rightmost', 'adjacent'])
+
+    swerve = subparsers.add_parser('swerve', help='swerve scenarios of safety-benchmarks')
+    swerve.add_argument('--vy', default='0.6:1.6', help='NPC lateral velocity in m/s (default: 0.6:1.6)')
+    swerve.add_argument('--ny', default='1.8', help='lateral offset of the swerve in m (default: 1.8)')
+    swerve.add_argument('--swerve-distance', default='2.0', help='swerve distance in m (default: 2.0)')
+
+    kinematic = subparsers.add_parser('kinematic', help='straight oncoming traffic, without interaction')
+    kinematic.add_argument('--npcs', type=int, default=1, help='number of NPCs (default: 1)')
+    kinematic.add_argument('--lateral', type=float, default=3.5, help='lateral offset of the NPC lane in m')
+    kinematic.add_argument('--brake-time', help='time after the start at which the ego brakes (default: never)')
+
+    for subparser, dx_default in ((uturn, '9:50'), (swerve, '10:55'), (kinematic, '10:60')):
+        if subparser is not kinematic:
+            subparser.add_argument('--env', default='awsim', choices=['carla', 'carla_town07', 'awsim'],
+                                   help='environment configuration (default: awsim)')
+        subparser.add_argument('--ve', default='14:50', help='Ego speed in km/h (default: 14:50)')
+        subparser.add_argument('--vo', default='10' if subparser is not kinematic else '5:20',
+                               help='NPC speed in km/h')
+        subparser.add_argument('--dx', default=dx_default, help=f'initial distance in m (default: {dx_default})')
+        subparser.add_argument('-n', '--count', type=int, default=1, help='number of traces (default: 1)')
+        subparser.add_argument('-o', '--output', required=True, help='output folder')
+        subparser.add_argument('--rate', type=float, default=100, help='sample rate in Hz (default: 100)')
+        subparser.add_argument('--duration', type=float, default=30, help='trace length in s (default: 30)')
+        subparser.add_argument('--size-mb', type=float,
+                               help='approximate size of each trace in MB, sets the duration')
+        subparser.add_argument('--lead-in', type=float, default=10,
+                               help='time before the scenario starts in s (default: 10)')
+        subparser.add_argument('--noise', type=float, nargs=3, default=[0, 0, 0],
+                               metavar=('POSITION', 'HEADING', 'VELOCITY'),
+                               help='standard deviations of the noise, in m, deg and m/s (default: none)')
+        subparser.add_argument('--extra-keys', type=int, default=0,
+                               help='additional vector entries per actor and timestamp (default: 0)')
+        subparser.add_argument('--origin', type=float, nargs=3, default=[0, 0, 0], metavar=('X', 'Y', 'YAW'),
+                               help='pose of the scenario in the map frame, in m and deg (default: 0 0 0)')
+        subparser.add_argument('--seed', type=int, default=0)
+        subparser.add_argument('-j', '--jobs', type=int, default=1, help='parallel processes (default: 1)')
+    parser.epilog = 'Parameters are fixed values, or `a:b` ranges sampled uniformly per trace.'
+    return parser
+
+if __name__ == '__main__':
+    cli_args = cli_parser().parse_args()
+    os.makedirs(cli_args.output, exist_ok=True)
+    rng = np.random.default_rng(cli_args.seed)
+    prefix = 'swerve_sim' if cli_args.command == 'swerve' else 'uturn_sim'
+    tasks = []
+    for i in range(cli_args.count):
+        params = sample_params(cli_args, rng)
+        config = TraceConfig(cli_args.rate, cli_args.duration, cli_args.lead_in, cli_args.noise,
+                             cli_args.extra_keys, True, cli_args.origin, cli_args.seed + i)
+        if cli_args.size_mb:
+            config.duration = cli_args.size_mb * 1e6 / entry_size(make_model(cli_args.command, dict(params),
+                                                                              config.rate), config) / config.rate
+        tasks.append((os.path.join(cli_args.output, f'{prefix}{i + 1}.json'), cli_args.command, params, config))
+
+    with Pool(cli_args.jobs) as pool:
+        for path, count in pool.imap_unordered(_generate, tasks):
+            print(f"Written {path} ({count} entries, {os.path.getsize(path) / 1e6:.1f} MB)")
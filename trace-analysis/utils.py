@@ -1,5 +1,17 @@
+import hashlib
+import os
+import re
+import sys
+
 import numpy as np
 
+LFS_HEADER = b'version https://git-lfs.github.com/spec/v1'
+
+UTURN_FILE_PATTERN = r"(?!.*\.meta\.json$)uturn_[A-Za-z0-9_]+\.json"
+SWERVE_FILE_PATTERN = r"(?!.*\.meta\.json$)swerve_[A-Za-z0-9_]+\.json"
+
+SAFETY_BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'safety-benchmarks')
+
 def round_float(input):
     return round(float(input), 3)
 
@@ -70,4 +82,115 @@ def edges_intersect(A, B, C, D):
     """
     def ccw(X, Y, Z):
         return (Z[1]-X[1]) * (Y[0]-X[0]) > (Y[1]-X[1]) * (Z[0]-X[0])
-    return (ccw(A, C, D) != ccw(B, C, D)) and (ccw(A, B, C) != ccw(A, B, D))
\ No newline at end of file
+    return (ccw(A, C, D) != ccw(B, C, D)) and (ccw(A, B, C) != ccw(A, B, D))
+
+class SortAndSweep:
+    """
+    Broad phase over the actors of a trace: pairs of actors whose axis-aligned bounding boxes overlap,
+    or only the actors overlapping one of them (pairs_with, e.g., the ego).
+    Boxes are sorted by their minimum x and swept once, so the cost is near-linear in the number of actors.
+    The order is kept from one timestamp to the next and updated by insertion sort, which is fast
+    since the actors move little between timestamps.
+    """
+    def __init__(self):
+        self.order = []
+
+    def _sort(self, boxes):
+        if len(self.order) != len(boxes):
+            self.order = sorted(range(len(boxes)), key=lambda i: boxes[i][0])
+            return
+        order = self.order
+        for k in range(1, len(order)):
+            i = order[k]
+            j = k - 1
+            while j >= 0 and boxes[order[j]][0] > boxes[i][0]:
+                order[j + 1] = order[j]
+                j -= 1
+            order[j + 1] = i
+
+    def pairs(self, boxes):
+        """
+        :param boxes: list of (min x, min y, max x, max y), one per actor
+        :return: list of (i, j), i < j, of the overlapping boxes
+        """
+        self._sort(boxes)
+        pairs = []
+        active = []
+        for i in self.order:
+            min_x, min_y, max_x, max_y = boxes[i]
+            active = [j for j in active if boxes[j][2] >= min_x]
+            for j in active:
+                if boxes[j][1] <= max_y and min_y <= boxes[j][3]:
+                    pairs.append((min(i, j), max(i, j)))
+            active.append(i)
+        return pairs
+
+    def pairs_with(self, index, boxes):
+        """
+        :param index: actor whose overlapping boxes are searched
+        :param boxes: list of (min x, min y, max x, max y), one per actor
+        :return: sorted list of the other actors whose boxes overlap the one of `index`
+        """
+        self._sort(boxes)
+        min_x, min_y, max_x, max_y = boxes[index]
+        found = []
+        for j in self.order:
+            if boxes[j][0] > max_x:
+                break
+            if j != index and boxes[j][2] >= min_x and boxes[j][1] <= max_y and min_y <= boxes[j][3]:
+                found.append(j)
+        return sorted(found)
+
+def file_digest(path):
+    """
+    :return: (sha256, whether the file is a Git LFS pointer); the sha256 of a pointer is the object id
+    """
+    with open(path, 'rb') as f:
+        head = f.read(len(LFS_HEADER))
+        if head == LFS_HEADER:
+            oid = re.search(rb'oid sha256:([0-9a-f]+)', f.read(1024))
+            return (oid.group(1).decode() if oid else None), True
+        digest = hashlib.sha256(head)
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest(), False
+
+def is_trace_file(name):
+    """
+    Whether a file name is the one of a U-turn/swerve trace.
+    """
+    return bool(re.fullmatch(SWERVE_FILE_PATTERN, name) or re.fullmatch(UTURN_FILE_PATTERN, name))
+
+def trace_files(paths, recursive=False):
+    """
+    The U-turn/swerve traces (see is_trace_file) of the given folders, in order, and the other given paths.
+    :param paths: a path or a list of paths
+    :param recursive: also search the subfolders, except hidden ones
+    :return: list of the paths of the traces, as str
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(str(path))
+            continue
+        for folder, folders, names in os.walk(path):
+            folders[:] = sorted(name for name in folders if not name.startswith('.')) if recursive else []
+            files.extend(os.path.join(folder, name) for name in sorted(names) if is_trace_file(name))
+    return files
+
+def import_safety_benchmarks(module):
+    """
+    Import a module of safety-benchmarks, e.g., `common` or `uturn.uturn`. That folder has its own `utils`
+    module: the one of this folder is set aside during the import.
+    """
+    saved = sys.modules.pop('utils', None)
+    sys.path.insert(0, os.path.abspath(SAFETY_BENCHMARKS_DIR))
+    try:
+        return __import__(module, fromlist=['_'])
+    finally:
+        sys.path.pop(0)
+        sys.modules.pop('utils', None)
+        if saved is not None:
+            sys.modules['utils'] = saved
@@ -1,5 +1,6 @@
 import numpy as np
 import utils
+import profiling
 
 class Vehicle:
     """
@@ -39,6 +40,8 @@ class Vehicle:
 
     def get_vertices(self):
         """Return the 4 corner points of the vehicle in world coordinates."""
+        if profiling.active is not None:
+            profiling.active.count('vertices')
         width, length = self.size
         dx = width / 2
         dy = length / 2
@@ -73,4 +76,6 @@ class Vehicle:
 
     @classmethod
     def is_collision(self, veh1, veh2):
+        if profiling.active is not None:
+            profiling.active.count('narrow_phase')
         return utils.is_collision(veh1.get_vertices(), veh2.get_vertices())
\ No newline at end of file